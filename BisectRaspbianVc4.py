@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+# Script to find the commit that broke something between two builds
+# Copyright (C) 2015 Gottfried Haider
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+from BuildRaspbianVc4 import checkRoot, log, file_get_contents, file_put_contents, getMirrorDir, COMPONENTS
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+# scores of all candidates tried so far, bisecting the same builds again
+# picks up from there
+BISECT_FILE = "/usr/local/src/bisect-vc4.json"
+BISECT_LOG = "/tmp/bisect-vc4.log"
+PIN_FILE = "/tmp/bisect-vc4-pins.json"
+# each step needs a reboot to test these
+KERNELS = ["linux-2708", "linux-2709"]
+
+def getCommits(issue):
+	names = [c['name'] for c in COMPONENTS]
+	return dict([(name, issue[name]['commit']) for name in issue if name in names and isinstance(issue[name], dict) and 'commit' in issue[name]])
+
+def getRange(name, good, bad):
+	# commits after good up to bad, oldest first
+	repo = [c for c in COMPONENTS if c['name'] == name][0]['git'][0][1]
+	out = subprocess.check_output("git rev-list --reverse --first-parent --ancestry-path " + good + ".." + bad, shell=True, cwd=getMirrorDir(repo))
+	return out.decode().split()
+
+def getCandidateKey(pins):
+	return json.dumps(sorted(pins.items()))
+
+def runCheck(check, sketch, minFps):
+	# True if good
+	if check:
+		return subprocess.call(check, shell=True) == 0
+	tmp = tempfile.mkdtemp(prefix="bisect-vc4-")
+	try:
+		with open(tmp + "/processing-test3d.json", "w") as f:
+			f.write(json.dumps({ 'tests': [{ 'sketch': sketch, 'ignore': 0 }] }))
+		subprocess.call([sys.executable, SCRIPT_DIR + "/processing-test3d.py", "--batch"], cwd=tmp)
+		with open(tmp + "/processing-test3d.json") as f:
+			bench = json.load(f)['tests'][0].get('benchmark', {})
+		fps = bench.get('fps', {}).get('mean', 0)
+		log("%s ran at %.1f fps" % (sketch, fps))
+		return minFps <= fps
+	finally:
+		shutil.rmtree(tmp)
+
+def tryCandidate(state, pins, check, sketch, minFps):
+	# True if good, False if bad, None if it didn't build
+	key = getCandidateKey(pins)
+	if key in state['scores']:
+		log("Reusing earlier result")
+		return state['scores'][key]
+	file_put_contents(PIN_FILE, json.dumps(pins))
+	# only components whose fingerprint changed get installed again,
+	# from the builds of earlier candidates if possible, and otherwise
+	# built through ccache
+	ret = subprocess.call(SCRIPT_DIR + "/BuildRaspbianVc4.py --pin=" + PIN_FILE + " --persistent --cache >>" + BISECT_LOG + " 2>&1", shell=True)
+	if ret:
+		log("Failed building, skipping (see " + BISECT_LOG + ")")
+		score = None
+	else:
+		score = runCheck(check, sketch, minFps)
+	state['scores'][key] = score
+	file_put_contents(BISECT_FILE, json.dumps(state))
+	return score
+
+def bisectComponent(state, base, name, commits, check, sketch, minFps):
+	# commits[-1] is known to be bad with base, returns the first bad
+	# commit, or the range it is in if some did not build
+	lo = -1
+	hi = len(commits) - 1
+	skipped = []
+	while 1 < hi - lo:
+		todo = [i for i in range(lo + 1, hi) if i not in skipped]
+		if not todo:
+			break
+		mid = min(todo, key=lambda i: abs(i - (lo + hi) / 2.0))
+		log("Trying " + name + " " + commits[mid][:12] + " (" + str(hi - lo - 1) + " commits left)")
+		pins = dict(base)
+		pins[name] = commits[mid]
+		score = tryCandidate(state, pins, check, sketch, minFps)
+		if score is None:
+			skipped.append(mid)
+		elif score:
+			lo = mid
+		else:
+			hi = mid
+	return commits[lo + 1:hi + 1]
+
+def bisect(good, bad, check=None, sketch=None, minFps=0):
+	goodCommits = getCommits(good)
+	badCommits = getCommits(bad)
+	state = { 'good': goodCommits, 'bad': badCommits, 'scores': {} }
+	if os.path.exists(BISECT_FILE):
+		prev = json.loads(file_get_contents(BISECT_FILE))
+		if prev['good'] == goodCommits and prev['bad'] == badCommits:
+			state = prev
+	# in the order they get built in, so that dependencies come first
+	changed = [c['name'] for c in COMPONENTS if goodCommits.get(c['name']) != badCommits.get(c['name']) and c['name'] in goodCommits and c['name'] in badCommits]
+	for name in changed:
+		log("Changed " + name + ": " + goodCommits[name][:12] + ".." + badCommits[name][:12])
+	for name in [name for name in changed if name in KERNELS]:
+		log("Not bisecting " + name + ", testing each step would need a reboot")
+	changed = [name for name in changed if name not in KERNELS]
+	# going from the good build towards the bad one, one component at a
+	# time, the first one whose latest commit turns it bad is to blame
+	base = dict(goodCommits)
+	for name in KERNELS:
+		if name in badCommits:
+			# the kernel that is running anyway
+			base[name] = badCommits[name]
+	for name in changed:
+		pins = dict(base)
+		pins[name] = badCommits[name]
+		log("Trying " + name + " " + badCommits[name][:12])
+		score = tryCandidate(state, pins, check, sketch, minFps)
+		if score is None:
+			log("Could not build " + name + " " + badCommits[name][:12] + " with the others at the good build, giving up")
+			return None
+		if score:
+			base[name] = badCommits[name]
+			continue
+		commits = getRange(name, goodCommits[name], badCommits[name])
+		if not commits:
+			log(goodCommits[name][:12] + " is not an ancestor of " + badCommits[name][:12] + ", can't bisect " + name)
+			return name, [badCommits[name]]
+		first = bisectComponent(state, base, name, commits, check, sketch, minFps)
+		if len(first) == 1:
+			log("First bad commit in " + name + ": " + first[0])
+		else:
+			log("First bad commit in " + name + " is one of (some didn't build): " + " ".join(first))
+		return name, first
+	log("Nothing changed for the worse" if changed else "No components to bisect")
+	return None
+
+
+if __name__ == "__main__":
+	args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	opts = dict([arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg])
+	if len(args) != 2 or not ('check' in opts or ('sketch' in opts and 'min-fps' in opts)):
+		exit("Usage: " + sys.argv[0] + " GOOD-issue.json BAD-issue.json --check=COMMAND\n       " + sys.argv[0] + " GOOD-issue.json BAD-issue.json --sketch=SKETCH --min-fps=FPS")
+	checkRoot()
+	with open(args[0]) as f:
+		good = json.load(f)
+	with open(args[1]) as f:
+		bad = json.load(f)
+	bisect(good, bad, opts.get('check'), opts.get('sketch'), float(opts.get('min-fps', 0)))
+	log("The installed build is the last one tried, run BuildRaspbianVc4.py to go back to the latest")
@@ -13,6 +13,22 @@ import os
 import subprocess
 import re
 import json
+import hashlib
+import sys
+import time
+import multiprocessing
+import errno
+import select
+import threading
+import traceback
+import tempfile
+import bz2
+import shutil
+import stat
+try:
+	import Queue as queue
+except ImportError:
+	import queue
 
 LINUX_GIT_REPO_2708 = "https://github.com/raspberrypi/linux.git"
 LINUX_GIT_BRANCH_2708 = "rpi-4.4.y"
@@ -26,10 +42,124 @@ PROCESSING_VERSION = "3.0.2.4"
 XSERVER_GIT_REPO = "git://anongit.freedesktop.org/xorg/xserver"
 XSERVER_GIT_BRANCH = "master"
 DATA_DIR = os.path.dirname(os.path.realpath(__file__))
-MAKE_OPTS = "-j3 -l3"
+# number of jobs shared between all components building at the same time
+# (handed to make through a jobserver, so there is no -j in MAKE_OPTS),
+# 0 for one per CPU, either way the governor takes some away while
+# memory is tight
+MAKE_JOBS = 0
+MAKE_OPTS = "-l" + str(multiprocessing.cpu_count())
+# memory (in kB) an ordinary compile job is expected to need, linking
+# goes by what the component's linker used last time
+JOB_MEMORY = 200 * 1024
+# keep at least this much memory (in kB) available
+MEMORY_LOW = 64 * 1024
+LINKERS = ["ld", "ld.bfd", "ld.gold", "collect2"]
+GOVERNOR_INTERVAL = 2
 CLEANUP = 1
+# --cross builds for armhf on an x86-64 host, with the toolchain from
+# raspberrypi/tools, against a copy of the Raspbian image's filesystems
+# (see PackageRaspbianVc4.py), into which components also get installed
+CROSS = "--cross" in sys.argv[1:]
+CROSS_HOST = "arm-linux-gnueabihf"
+CROSS_TOOLCHAIN = "/usr/local/src/raspberrypi-tools/arm-bcm2708/gcc-linaro-arm-linux-gnueabihf-raspbian-x64/bin"
+# what the host needs to run the build, the components' packages get
+# installed into the sysroot
+CROSS_PACKAGES = ["build-essential", "autoconf", "automake", "libtool", "pkg-config", "bison", "flex", "gettext", "python-mako", "bc", "qemu-user-static"]
+SYSROOT = "/usr/local/src/sysroot-vc4"
+# the system components get installed into, paths below it are the same
+# either way
+ROOT = SYSROOT if CROSS else ""
+# bare repositories all sources get fetched into, and how many of them
+# get updated at the same time
+MIRROR_DIR = "/usr/local/src/mirror"
+PREFETCH_JOBS = 4
+# skip components whose fingerprint did not change since they got built
+INCREMENTAL = 1
+FINGERPRINT_FILE = ROOT + "/usr/local/src/fingerprint-vc4.json"
+# steps completed by the last run, with --resume those whose inputs did
+# not change get skipped (components resume from FINGERPRINT_FILE)
+JOURNAL_FILE = "/usr/local/src/journal-vc4.json"
+RESUME = "--resume" in sys.argv[1:]
+# --pin=FILE builds the commits in FILE ({ component: commit }) instead
+# of the latest ones, e.g. while bisecting
+PIN_FILE = ([arg[len("--pin="):] for arg in sys.argv[1:] if arg.startswith("--pin=")] or [None])[0]
+# peak memory etc of each component's last build
+HISTORY_FILE = "/usr/local/src/history-vc4.json"
+# wall time of the last runs of every step of both scripts, --plan
+# predicts from these what a run would take, without running anything,
+# and points out steps that lately took this much more (or less)
+TIMES_FILE = "/usr/local/src/times-vc4.json"
+TIMES_KEEP = 10
+PLAN = "--plan" in sys.argv[1:]
+PLAN_DRIFT = 0.25
+# output of every step, compressed one by one so that each can be read
+# without the others (see LogRaspbianVc4.py), with an index next to it
+STEP_LOG = "/tmp/BuildRaspbianVc4-log.bz2"
+# lines kept in the index of failed steps, and patterns of lines that
+# tell why
+LOG_TAIL = 40
+LOG_ERRORS = r'error|fatal|undefined reference|No such file|not found|cannot|Killed'
+# timeline of all steps, PackageRaspbianVc4.py merges this into its own
+TRACE_FILE = "/tmp/BuildRaspbianVc4-trace.json"
+# keep an out-of-tree build directory per component (the kernels always
+# have one) and compile through ccache rather than starting from scratch
+# every night (implies no CLEANUP),
+# also with --persistent (PackageRaspbianVc4.py passes it on)
+PERSISTENT_BUILD = 0 or "--persistent" in sys.argv[1:]
+BUILD_DIR = "/usr/local/src/build"
+# components install into a directory of their own first (DESTDIR), and
+# the files they installed are kept track of, to package exactly those
+STAGE_DIR = "/usr/local/src/stage"
+# --cache also keeps the staged install of every build, by fingerprint,
+# and installs a component from there rather than building the same
+# commits again (e.g. while bisecting), up to this many per component
+STAGE_CACHE = "--cache" in sys.argv[1:]
+STAGE_CACHE_DIR = "/usr/local/src/stage-cache"
+STAGE_CACHE_KEEP = 16
+FILES_DIR = ROOT + "/usr/local/src/files-vc4"
+CCACHE_DIR = "/usr/local/src/ccache"
+# size limit of each component's cache, unless the component sets its
+# own, beyond which ccache evicts the least recently used objects
+CCACHE_SIZE = "256M"
+# packages installed by the last run, skips asking dpkg again while its
+# status database stays the same (both relative to the root packages get
+# installed into)
+APT_FILE = "/usr/local/src/apt-vc4.json"
+DPKG_STATUS = "/var/lib/dpkg/status"
 
 issue = {}
+# every command run, see runStep(), and (time, name, value) samples
+steps = []
+counters = []
+history = {}
+# components currently building, by name
+building = {}
+# component the current thread is working on
+current = threading.local()
+# fingerprints of the components of this build, and of the ones that
+# are currently installed
+fingerprints = {}
+installed = {}
+journal = {}
+pins = {}
+# held while installing kernels to /boot and /lib/modules
+bootLock = threading.Lock()
+# held while merging a staged install into the system
+installLock = threading.Lock()
+# held shared by every component while it builds, and exclusively by the
+# ones that change the system under the others' feet, see 'exclusive'
+buildLock = threading.Condition()
+sharedBuilds = 0
+exclusiveBuild = False
+exclusiveWaiting = 0
+fingerprintLock = threading.Lock()
+historyLock = threading.Lock()
+timesLock = threading.Lock()
+stepLog = None
+stepLogLock = threading.Lock()
+jobServer = None
+jobServerSize = 0
+withheld = 0
 
 # helper functions
 def file_get_contents(fn):
@@ -40,19 +170,236 @@ def file_put_contents(fn, s):
 		with open(fn, 'w') as f:
 			f.write(s)
 
+def runStep(cmd, cwd=None):
+	# like subprocess.call, but records wall time as well as CPU time and
+	# peak RSS of the process tree (which getrusage can't tell apart
+	# when running builds in parallel, wait4 can)
+	start = time.time()
+	out = None
+	if stepLog:
+		out = tempfile.TemporaryFile()
+	# builds run in parallel threads, so never os.chdir() but pass cwd
+	# close_fds=False keeps the jobserver pipe open in make
+	p = subprocess.Popen(cmd, shell=True, cwd=cwd, close_fds=False, stdout=out, stderr=out)
+	while True:
+		try:
+			pid, status, ru = os.wait4(p.pid, 0)
+			break
+		except OSError as e:
+			if e.errno != errno.EINTR:
+				raise
+	if os.WIFSIGNALED(status):
+		p.returncode = -os.WTERMSIG(status)
+	else:
+		p.returncode = os.WEXITSTATUS(status)
+	steps.append({ 'cmd': cmd, 'component': getattr(current, 'component', None), 'thread': threading.current_thread().name, 'start': start, 'wall': time.time() - start, 'user': ru.ru_utime, 'sys': ru.ru_stime, 'maxrss': ru.ru_maxrss, 'status': p.returncode })
+	if out:
+		addStepLog(steps[-1], out)
+	return p.returncode
+
+def getStepLogIndex(fn):
+	return os.path.splitext(fn)[0] + ".json"
+
+def openStepLog(fn):
+	global stepLog
+	open(fn, 'wb').close()
+	stepLog = { 'fn': fn, 'steps': [] }
+	file_put_contents(getStepLogIndex(fn), json.dumps(stepLog['steps']))
+
+def addStepLog(step, out):
+	# compress on the side, and only append (and index) it under the lock
+	comp = bz2.BZ2Compressor(9)
+	size = 0
+	tail = []
+	errors = []
+	partial = b""
+	out.seek(0)
+	with tempfile.TemporaryFile() as seg:
+		while True:
+			data = out.read(1024 * 1024)
+			if not data:
+				break
+			size = size + len(data)
+			seg.write(comp.compress(data))
+			if step['status']:
+				lines = (partial + data).split(b"\n")
+				partial = lines.pop()
+				for line in lines:
+					line = line.decode('utf-8', 'replace')[:300]
+					tail = (tail + [line])[-LOG_TAIL:]
+					if re.search(LOG_ERRORS, line, re.IGNORECASE):
+						# the last ones, configure alone prints plenty
+						errors = (errors + [line])[-LOG_TAIL:]
+		seg.write(comp.flush())
+		out.close()
+		if partial:
+			line = partial.decode('utf-8', 'replace')[:300]
+			tail = (tail + [line])[-LOG_TAIL:]
+			if re.search(LOG_ERRORS, line, re.IGNORECASE):
+				errors = (errors + [line])[-LOG_TAIL:]
+		entry = { 'cmd': step['cmd'], 'component': step['component'], 'start': step['start'], 'wall': round(step['wall'], 2), 'status': step['status'], 'size': size }
+		if step['status']:
+			entry['tail'] = tail
+			entry['errors'] = errors
+		seg.seek(0)
+		with stepLogLock:
+			with open(stepLog['fn'], 'ab') as f:
+				f.seek(0, os.SEEK_END)
+				entry['offset'] = f.tell()
+				while True:
+					data = seg.read(1024 * 1024)
+					if not data:
+						break
+					f.write(data)
+				entry['length'] = f.tell() - entry['offset']
+			entry['step'] = len(stepLog['steps'])
+			stepLog['steps'].append(entry)
+			file_put_contents(getStepLogIndex(stepLog['fn']) + ".tmp", json.dumps(stepLog['steps']))
+			os.rename(getStepLogIndex(stepLog['fn']) + ".tmp", getStepLogIndex(stepLog['fn']))
+	if step['status']:
+		log("Step " + str(entry['step']) + " failed (" + str(step['status']) + "): " + step['cmd'])
+		for line in errors[-10:] or tail[-10:]:
+			log("  " + line)
+
+def checkCall(cmd, cwd=None):
+	ret = runStep(cmd, cwd)
+	if ret:
+		raise subprocess.CalledProcessError(ret, cmd)
+
+def call(cmd, cwd=None):
+	return runStep(cmd, cwd)
+
+def getStepStats(name):
+	# summary of a component's steps for issue-vc4.json
+	mine = [s for s in steps if s['component'] == name]
+	stats = {}
+	stats['user'] = round(sum([s['user'] for s in mine]), 2)
+	stats['sys'] = round(sum([s['sys'] for s in mine]), 2)
+	# in kB
+	stats['maxrss'] = max([s['maxrss'] for s in mine] or [0])
+	stats['steps'] = [{ 'cmd': s['cmd'], 'wall': round(s['wall'], 2), 'user': round(s['user'], 2), 'sys': round(s['sys'], 2), 'maxrss': s['maxrss'] } for s in mine]
+	return stats
+
+def getTraceEvents(steps, process, counters=[]):
+	# Chrome trace event format, which also loads in Perfetto
+	pid = os.getpid()
+	events = [{ 'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': { 'name': process } }]
+	for (t, name, value) in counters:
+		events.append({ 'name': name, 'ph': 'C', 'pid': pid, 'ts': int(t * 1000000), 'args': { name: value } })
+	threads = []
+	for s in steps:
+		if s['thread'] not in threads:
+			threads.append(s['thread'])
+			events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': len(threads), 'args': { 'name': s['thread'] } })
+		args = dict((key, s[key]) for key in ['cmd', 'user', 'sys', 'maxrss', 'status'])
+		events.append({ 'name': s['cmd'][:60], 'cat': s['component'] or process, 'ph': 'X', 'pid': pid, 'tid': threads.index(s['thread']) + 1, 'ts': int(s['start'] * 1000000), 'dur': int(s['wall'] * 1000000), 'args': args })
+	return events
+
+def writeTrace(fn):
+	file_put_contents(fn, json.dumps({ 'traceEvents': getTraceEvents(steps, "BuildRaspbianVc4", counters) }))
+
+def getMissingPackages(packages, root=""):
+	# one dpkg-query for all of them, packages it never heard of are
+	# simply missing from its output (and make it return 1)
+	admin = " --admindir=" + root + os.path.dirname(DPKG_STATUS)
+	out = subprocess.check_output("dpkg-query" + admin + " -W -f='${Package} ${Status}\\n' " + " ".join(packages) + " 2>/dev/null; true", shell=True)
+	installed = []
+	for line in out.decode().splitlines():
+		fields = line.split()
+		if fields and fields[-1] == "installed":
+			installed.append(fields[0].split(":")[0])
+	return [p for p in packages if p not in installed]
+
+def installPackages(packages, root=""):
+	# a single apt transaction for everything the build needs, rather than
+	# one per component, into the system at root (a sysroot's apt-get runs
+	# through qemu-arm-static)
+	packages = sorted(set(packages))
+	# dpkg's database only changes when something got (un)installed, so
+	# as long as it stays the same, so do the packages we found last time
+	known = []
+	if os.path.exists(root + APT_FILE):
+		cache = json.loads(file_get_contents(root + APT_FILE))
+		if cache['status'] == os.path.getmtime(root + DPKG_STATUS):
+			known = cache['packages']
+	if not [p for p in packages if p not in known]:
+		log("All " + str(len(packages)) + " packages already installed")
+		return
+	missing = getMissingPackages(packages, root)
+	if missing:
+		apt = "chroot " + root + " apt-get" if root else "apt-get"
+		checkCall(apt + " -y update")
+		checkCall(apt + " -y install " + " ".join(missing))
+		known = []
+	known = sorted(set(known + packages))
+	file_put_contents(root + APT_FILE, json.dumps({ 'packages': known, 'status': os.path.getmtime(root + DPKG_STATUS) }))
+
+def getPackages(components):
+	packages = []
+	for c in components:
+		packages.extend(c['apt'])
+	if PERSISTENT_BUILD and not CROSS:
+		packages.append("ccache")
+	return packages
+
+def getHostPackages():
+	# with --cross, the ones getPackages() returns go into the sysroot
+	packages = list(CROSS_PACKAGES)
+	if PERSISTENT_BUILD:
+		packages.append("ccache")
+	return packages
+
 def checkRoot():
 	if os.geteuid() != 0:
 		exit("You need to have root privileges to run this script")
 
-def updateHostApt():
-	subprocess.check_call("apt-get -y update", shell=True)
+def getSysrootBase():
+	# the image the sysroot was made from
+	if os.path.exists(SYSROOT + "/.vc4-base"):
+		return file_get_contents(SYSROOT + "/.vc4-base")
+	return None
+
+def makeSysroot(live, base):
+	# copy the Raspbian image mounted at live (/boot included), this
+	# also forgets about all components installed into the old one
+	log("Making " + SYSROOT + " from " + base)
+	checkCall("rm -rf " + SYSROOT)
+	checkCall("mkdir -p " + SYSROOT)
+	checkCall("cp -a " + live + "/. " + SYSROOT)
+	# for apt-get in a chroot, older binfmt setups need this inside
+	checkCall("cp /usr/bin/qemu-arm-static " + SYSROOT + "/usr/bin")
+	checkCall("cp /etc/resolv.conf " + SYSROOT + "/etc")
+	file_put_contents(SYSROOT + "/.vc4-base", base)
+
+def fixSysrootLinks():
+	# absolute symlinks (e.g. libm.so) would point into the host when the
+	# linker follows them, relative ones stay inside
+	for top in ["/lib", "/usr/lib"]:
+		for root, dirs, names in os.walk(SYSROOT + top):
+			for name in dirs + names:
+				path = os.path.join(root, name)
+				if os.path.islink(path) and os.readlink(path).startswith("/"):
+					target = os.path.relpath(SYSROOT + os.readlink(path), root)
+					os.remove(path)
+					os.symlink(target, path)
+
+def setupCross():
+	if getSysrootBase() is None:
+		exit("No sysroot in " + SYSROOT + ", run PackageRaspbianVc4.py --cross to make one from its Raspbian image")
+	# the toolchain comes with the raspberrypi-tools component, which
+	# everything else waits for
+	os.environ['PATH'] = CROSS_TOOLCHAIN + ":" + os.environ['PATH']
+	# only the sysroot's .pc files, with the sysroot in front of the
+	# paths in them
+	os.environ['PKG_CONFIG_SYSROOT_DIR'] = SYSROOT
+	os.environ['PKG_CONFIG_LIBDIR'] = ":".join([SYSROOT + dir + "/pkgconfig" for dir in ["/usr/local/lib", "/usr/local/share", "/usr/lib/" + CROSS_HOST, "/usr/lib", "/usr/share"]])
 
 def updateFirmware():
 	# mask_gpu_interrupt0 gets obsoleted by a post-Jesse firmware update
-	subprocess.check_call("SKIP_BACKUP=1 SKIP_WARNING=1 rpi-update", shell=True)
+	checkCall("SKIP_BACKUP=1 SKIP_WARNING=1 rpi-update")
 
 def updateConfigTxt():
-	txt = file_get_contents("/boot/config.txt")
+	txt = file_get_contents(ROOT + "/boot/config.txt")
 	added_comment = 0
 	match = re.findall(r'^# added for vc4 driver$', txt, re.MULTILINE)
 	if 0 < len(match):
@@ -84,23 +431,29 @@ def updateConfigTxt():
 			txt = txt.strip() + "\n\n" + "# added for vc4 driver\n"
 			added_comment = 1
 		txt = txt + "dtoverlay=vc4-kms-v3d\n"
-	file_put_contents("/boot/config.txt", txt)
+	file_put_contents(ROOT + "/boot/config.txt", txt)
 
 def updateLdConfig():
 	# this makes /usr/local/lib come before /{usr/,}lib/arm-linux-gnueabihf
-	if not os.path.exists("/etc/ld.so.conf.d/01-libc.conf"):
-		subprocess.check_call("mv /etc/ld.so.conf.d/libc.conf /etc/ld.so.conf.d/01-libc.conf", shell=True)
-	subprocess.check_call("ldconfig")
+	if not os.path.exists(ROOT + "/etc/ld.so.conf.d/01-libc.conf"):
+		checkCall("mv " + ROOT + "/etc/ld.so.conf.d/libc.conf " + ROOT + "/etc/ld.so.conf.d/01-libc.conf")
+	runLdconfig()
+
+def runLdconfig():
+	# a sysroot's libraries are found through -rpath-link instead, the
+	# image's cache gets rebuilt when packaging
+	if not CROSS:
+		checkCall("ldconfig")
 
 def enableCoredumps():
-	file_put_contents("/etc/security/limits.d/coredump.conf", "*\tsoft\tcore\tunlimited")
+	file_put_contents(ROOT + "/etc/security/limits.d/coredump.conf", "*\tsoft\tcore\tunlimited")
 
 def enableDebugEnvVars():
 	out = "export LIBGL_DEBUG=1\n"
 	out += "export MESA_DEBUG=1\n"
 	out += "export EGL_LOG_LEVEL=debug\n"
 	out += "export GLAMOR_DEBUG=1\n"
-	file_put_contents("/etc/profile.d/graphics-debug.sh", out)
+	file_put_contents(ROOT + "/etc/profile.d/graphics-debug.sh", out)
 
 def updateRcLocalForLeds():
 	# LEDs can only be controlled by the root user by default
@@ -111,399 +464,636 @@ def updateRcLocalForLeds():
 		rclocal = re.sub('exit 0\n', '# allow regular users to control the leds\nchmod -R a+rw /sys/class/leds/*\n\nexit 0\n', rclocal)
 		file_put_contents("/etc/rc.local", rclocal)
 
-def getGitInfo():
+def getGitInfo(src):
 	info = {}
-	info['commit'] = subprocess.check_output("git rev-parse HEAD", shell=True).rstrip()
-	info['branch'] = subprocess.check_output("git rev-parse --abbrev-ref HEAD", shell=True).rstrip()
-	info['url'] = subprocess.check_output("git config --get remote.origin.url", shell=True).rstrip()
+	info['commit'] = subprocess.check_output("git rev-parse HEAD", shell=True, cwd=src).rstrip()
+	info['branch'] = subprocess.check_output("git rev-parse --abbrev-ref HEAD", shell=True, cwd=src).rstrip()
+	info['url'] = subprocess.check_output("git config --get remote.origin.url", shell=True, cwd=src).rstrip()
 	return info
 
-def buildXorgMacros():
-	subprocess.check_call("apt-get -y install autoconf", shell=True)
-	if not os.path.exists("/usr/local/src/xorg-macros"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/util/macros /usr/local/src/xorg-macros", shell=True)
-	os.chdir("/usr/local/src/xorg-macros")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
+def getMirrorDir(repo):
+	path = re.sub(r'^[\w+]+://', '', repo).lstrip('/')
+	if not path.endswith(".git"):
+		path = path + ".git"
+	return MIRROR_DIR + "/" + path
+
+def updateMirror(repo):
+	mirror = getMirrorDir(repo)
+	if not os.path.exists(mirror):
+		log("Cloning " + repo)
+		checkCall("git clone --bare " + repo + " " + mirror)
+		# only branches, GitHub would also send every pull request
+		checkCall("git config remote.origin.fetch '+refs/heads/*:refs/heads/*'", mirror)
+		# working trees borrow objects from here, never prune them
+		checkCall("git config gc.pruneExpire never", mirror)
+	else:
+		log("Fetching " + repo)
+		# keep going with what we have on network errors
+		call("git fetch --prune origin", mirror)
+
+def updateSource(src, repo, branch, commit=None):
+	# this only talks to the local mirror, which is up to date by now
+	mirror = getMirrorDir(repo)
+	if not os.path.exists(src):
+		# like --reference, objects stay in the mirror
+		checkCall("git clone --shared --no-checkout " + mirror + " " + src)
+	checkCall("git remote set-url origin " + repo, src)
+	checkCall("git fetch --prune " + mirror + " '+refs/heads/*:refs/remotes/origin/*'", src)
+	if not branch:
+		# follow the default branch like git pull did
+		branch = subprocess.check_output("git symbolic-ref --short HEAD", shell=True, cwd=mirror).decode('utf-8').rstrip()
+	if commit:
+		# the mirror has it, as long as it was fetched at some point
+		checkCall("git checkout -f -B " + branch + " " + commit, src)
+	else:
+		checkCall("git checkout -f -B " + branch + " origin/" + branch, src)
+	return subprocess.check_output("git rev-parse HEAD", shell=True, cwd=src).decode('utf-8').rstrip()
+
+def getFingerprint(c, commits):
+	# anything that changes the installed files, including the
+	# fingerprints of the components this one got built against
+	data = [c['name'], commits, c.get('configure', ""), MAKE_OPTS]
+	data.append([fingerprints[dep] for dep in c['deps']])
+	return hashlib.sha1(json.dumps(data).encode('utf-8')).hexdigest()
+
+def loadPins():
+	global pins
+	if PIN_FILE:
+		pins = json.loads(file_get_contents(PIN_FILE))
+		for name in pins:
+			log("Pinning " + name + " to " + pins[name])
+
+def loadFingerprints():
+	global installed
+	if (INCREMENTAL or RESUME) and os.path.exists(FINGERPRINT_FILE):
+		installed = json.loads(file_get_contents(FINGERPRINT_FILE))
+
+def saveFingerprints():
+	s = json.dumps(installed, sort_keys=True, indent=4, separators=(',', ': '))
+	file_put_contents(FINGERPRINT_FILE + ".tmp", s)
+	os.rename(FINGERPRINT_FILE + ".tmp", FINGERPRINT_FILE)
+
+def loadJournal(fn):
+	# a run without --resume starts over
+	if RESUME and os.path.exists(fn):
+		return json.loads(file_get_contents(fn))
+	return {}
+
+def getCheckpoint(journal, name, inputs, outputs=[]):
+	# the step's entry if it completed before with the same inputs, and
+	# its output files are still around
+	done = journal.get(name)
+	if not RESUME or not done or done['inputs'] != inputs:
+		return None
+	for fn in outputs:
+		if not os.path.exists(fn):
+			return None
+	return done
+
+def saveJournal(fn, journal):
+	s = json.dumps(journal, sort_keys=True, indent=4, separators=(',', ': '))
+	file_put_contents(fn + ".tmp", s)
+	os.rename(fn + ".tmp", fn)
+
+def setCheckpoint(fn, journal, name, inputs, result=None):
+	journal[name] = { 'inputs': inputs, 'time': time.time(), 'result': result }
+	saveJournal(fn, journal)
+
+def runJournaled(name, inputs, func, *args):
+	if getCheckpoint(journal, name, inputs):
+		log("Skipping " + name + " (done before)")
+		return
+	timed(name, func, *args)
+	setCheckpoint(JOURNAL_FILE, journal, name, inputs)
+
+def getBuildDir(c):
+	if not PERSISTENT_BUILD:
+		return c['src']
+	build = BUILD_DIR + "/" + c['name']
+	checkCall("mkdir -p " + build)
+	# configure refuses to run out-of-tree if the source directory got
+	# configured before
+	if os.path.exists(c['src'] + "/config.status"):
+		checkCall("make distclean", c['src'])
+	return build
+
+def getStageDir(c):
+	return STAGE_DIR + "/" + c['name']
+
+def getFileListName(name):
+	return FILES_DIR + "/" + name + ".json"
+
+def loadFileList(name):
+	# everything the component installed, directories included
+	if not os.path.exists(getFileListName(name)):
+		return None
+	return json.loads(file_get_contents(getFileListName(name)))
+
+def getStagedFiles(stage):
+	files = []
+	for root, dirs, names in os.walk(stage):
+		for name in dirs + names:
+			files.append(os.path.join(root, name)[len(stage):])
+	return sorted(files)
+
+def copyMeta(src, dst, st):
+	try:
+		shutil.copystat(src, dst)
+		os.chown(dst, st.st_uid, st.st_gid)
+	except OSError:
+		# /boot is FAT
+		pass
+
+def copyStaged(stage, files, root=""):
+	# existing directories stay as they are (e.g. /home/pi), files get
+	# replaced rather than overwritten as binaries might be running, and
+	# hardlinks (mesa's drivers) stay hardlinks
+	linked = {}
+	for name in files:
+		src = stage + name
+		path = root + name
+		st = os.lstat(src)
+		if stat.S_ISDIR(st.st_mode):
+			if not os.path.isdir(path):
+				os.mkdir(path)
+				copyMeta(src, path, st)
+			continue
+		tmp = os.path.join(os.path.dirname(path), ".vc4-" + os.path.basename(path))
+		if os.path.lexists(tmp):
+			os.remove(tmp)
+		if stat.S_ISLNK(st.st_mode):
+			os.symlink(os.readlink(src), tmp)
+		elif (st.st_dev, st.st_ino) in linked:
+			os.link(linked[(st.st_dev, st.st_ino)], tmp)
+		else:
+			shutil.copyfile(src, tmp)
+			copyMeta(src, tmp, st)
+			linked[(st.st_dev, st.st_ino)] = path
+		os.rename(tmp, path)
+
+def mergeStage(c, keep=False):
+	# copy a staged install into the system, and remove what an earlier
+	# build of the component installed but this one didn't, keep: leave
+	# the staged install around to be merged again
+	stage = getStageDir(c)
+	files = getStagedFiles(stage)
+	with installLock:
+		old = loadFileList(c['name']) or []
+		others = set()
+		for other in COMPONENTS:
+			if other['name'] != c['name']:
+				others.update(loadFileList(other['name']) or [])
+		stale = sorted(set(old) - set(files) - others, reverse=True)
+		for path in [ROOT + name for name in stale]:
+			if os.path.islink(path) or os.path.isfile(path):
+				os.remove(path)
+			elif os.path.isdir(path):
+				try:
+					os.rmdir(path)
+				except OSError:
+					# something else put files there
+					pass
+		copyStaged(stage, files, ROOT)
+		checkCall("mkdir -p " + FILES_DIR)
+		file_put_contents(getFileListName(c['name']) + ".tmp", json.dumps(files, indent=0))
+		os.rename(getFileListName(c['name']) + ".tmp", getFileListName(c['name']))
+	if STAGE_CACHE:
+		cache = getStageCacheDir(c)
+		if not os.path.exists(cache + "/issue.json"):
+			# hardlinks, as neither gets changed afterwards
+			checkCall("rm -rf " + cache + " && mkdir -p " + cache + " && cp -al " + stage + " " + cache + "/stage")
+	if not keep:
+		checkCall("rm -rf " + stage)
+	log("Installed " + str(len(files)) + " files of " + c['name'] + (", removed " + str(len(stale)) + " old ones" if stale else ""))
+
+def getStageCacheDir(c):
+	return STAGE_CACHE_DIR + "/" + c['name'] + "/" + fingerprints[c['name']]
+
+def isStageCached(c):
+	# issue.json gets written last
+	return STAGE_CACHE and os.path.exists(getStageCacheDir(c) + "/issue.json")
+
+def saveStageCache(c):
+	cache = getStageCacheDir(c)
+	if not os.path.isdir(cache + "/stage"):
+		return
+	file_put_contents(cache + "/issue.json", json.dumps(issue[c['name']]))
+	# the least recently used ones go
+	dirs = [os.path.join(STAGE_CACHE_DIR, c['name'], name) for name in os.listdir(STAGE_CACHE_DIR + "/" + c['name'])]
+	dirs = sorted([d for d in dirs if os.path.exists(d + "/issue.json")], key=lambda d: os.path.getmtime(d + "/issue.json"))
+	for d in dirs[:max(0, len(dirs) - STAGE_CACHE_KEEP)]:
+		checkCall("rm -rf " + d)
+
+def installStageCache(c):
+	cache = getStageCacheDir(c)
+	checkCall("mkdir -p " + STAGE_DIR + " && cp -al " + cache + "/stage " + getStageDir(c))
+	if 'install' in c:
+		c['install'](c)
+	else:
+		mergeStage(c)
+	runLdconfig()
+	issue[c['name']] = json.loads(file_get_contents(cache + "/issue.json"))
+	# counts as used
+	os.utime(cache + "/issue.json", None)
+
+def getCacheDir(c):
+	return CCACHE_DIR + "/" + c['name']
+
+def getBuildEnv(c):
+	# configure remembers CC, CXX and LDFLAGS for make
+	if not PERSISTENT_BUILD and not CROSS:
+		return ""
+	env = ""
+	cc = "gcc"
+	cxx = "g++"
+	if CROSS:
+		cc = CROSS_HOST + "-gcc --sysroot=" + SYSROOT
+		cxx = CROSS_HOST + "-g++ --sysroot=" + SYSROOT
+		# for the libraries of libraries, which only ld.so would look for
+		# in /usr/local/lib
+		env = "LDFLAGS=\"" + " ".join(["-Wl,-rpath-link," + SYSROOT + dir for dir in ["/usr/local/lib", "/lib/" + CROSS_HOST, "/usr/lib/" + CROSS_HOST]]) + "\" "
+	if PERSISTENT_BUILD:
+		env = env + "CCACHE_DIR=" + getCacheDir(c) + " "
+		cc = "ccache " + cc
+		cxx = "ccache " + cxx
+	return env + "CC=\"" + cc + "\" CXX=\"" + cxx + "\" "
+
+def getAutogen(c):
+	# xorg-macros.m4 gets installed outside of the regular search path of
+	# aclocal, libtool finds the .la files in the sysroot with --with-sysroot
+	configure = c['configure']
+	if CROSS:
+		configure = configure + " --host=" + CROSS_HOST + " --with-sysroot=" + SYSROOT
+	return getBuildEnv(c) + "ACLOCAL_PATH=" + ROOT + "/usr/local/share/aclocal " + c['src'] + "/autogen.sh " + configure
+
+def getKernelBuildDir(c):
+	# the kernels' objects are kept between runs either way, in an O=
+	# directory, as they take the longest to build
+	build = BUILD_DIR + "/" + c['name']
+	checkCall("mkdir -p " + build)
+	return build
+
+def getKernelMake(c, build):
+	kmake = "make"
+	cc = "gcc"
+	if CROSS:
+		kmake = "make ARCH=arm CROSS_COMPILE=" + CROSS_TOOLCHAIN + "/" + CROSS_HOST + "-"
+		cc = CROSS_TOOLCHAIN + "/" + CROSS_HOST + "-gcc"
+	kmake = kmake + " O=" + build
+	if not PERSISTENT_BUILD:
+		return kmake
+	# kbuild ignores CC from the environment
+	return "CCACHE_DIR=" + getCacheDir(c) + " " + kmake + " CC=\"ccache " + cc + "\""
+
+def resetCacheStats(c):
+	checkCall("CCACHE_DIR=" + getCacheDir(c) + " ccache -M " + c.get('ccache', CCACHE_SIZE) + " -z >/dev/null")
+
+def getCacheStats(c):
+	out = subprocess.check_output("CCACHE_DIR=" + getCacheDir(c) + " ccache -s", shell=True).decode('utf-8')
+	# ccache 3.x
+	hits = re.findall(r'^cache hit \((?:direct|preprocessed)\)\s+(\d+)', out, re.MULTILINE)
+	misses = re.findall(r'^cache miss\s+(\d+)', out, re.MULTILINE)
+	# ccache 4.x
+	if not hits:
+		hits = re.findall(r'^\s*Hits:\s+(\d+)', out, re.MULTILINE)[:1]
+		misses = re.findall(r'^\s*Misses:\s+(\d+)', out, re.MULTILINE)[:1]
+	hits = sum([int(n) for n in hits])
+	misses = sum([int(n) for n in misses])
+	return (hits, misses)
+
+def buildXorgMacros(c):
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
 	# has no make all, make clean
-	subprocess.check_call("make install", shell=True)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
 	# move .pc file to standard path
-	subprocess.check_call("mkdir -p /usr/local/lib/pkgconfig", shell=True)
-	subprocess.check_call("mv /usr/local/share/pkgconfig/xorg-macros.pc /usr/local/lib/pkgconfig", shell=True)
-	issue['xorg-macros'] = getGitInfo()
-
-def buildXcbProto():
-	if not os.path.exists("/usr/local/src/xcb-proto"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xcb/proto /usr/local/src/xcb-proto", shell=True)
-	os.chdir("/usr/local/src/xcb-proto")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	checkCall("mkdir -p " + getStageDir(c) + "/usr/local/lib/pkgconfig", build)
+	checkCall("mv " + getStageDir(c) + "/usr/local/share/pkgconfig/xorg-macros.pc " + getStageDir(c) + "/usr/local/lib/pkgconfig", build)
+	mergeStage(c)
+	issue['xorg-macros'] = getGitInfo(c['src'])
+
+def buildXcbProto(c):
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	issue['xcb-proto'] = getGitInfo()
+		checkCall("make clean", build)
+	issue['xcb-proto'] = getGitInfo(c['src'])
 
-def buildLibXcb():
+def buildLibXcb(c):
 	# needed to prevent xcb_poll_for_special_event linker error when installing mesa
-	subprocess.check_call("apt-get -y install libtool libpthread-stubs0-dev libxau-dev", shell=True)
-	if not os.path.exists("/usr/local/src/libxcb"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xcb/libxcb /usr/local/src/libxcb", shell=True)
-	os.chdir("/usr/local/src/libxcb")
-	subprocess.call("git pull", shell=True)
-	# xorg-macros.m4 got installed outside of the regular search path of aclocal
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	subprocess.check_call("ldconfig", shell=True)
-	issue['libxcb'] = getGitInfo()
-
-def buildGlProto():
-	if not os.path.exists("/usr/local/src/glproto"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/proto/glproto /usr/local/src/glproto", shell=True)
-	os.chdir("/usr/local/src/glproto")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
+		checkCall("make clean", build)
+	runLdconfig()
+	issue['libxcb'] = getGitInfo(c['src'])
+
+def buildGlProto(c):
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
 	# has no make all, make clean
-	subprocess.check_call("make install", shell=True)
-	issue['glproto'] = getGitInfo()
-
-def buildLibDrm():
-	subprocess.check_call("apt-get -y install libudev-dev", shell=True)
-	if not os.path.exists("/usr/local/src/libdrm"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/mesa/drm /usr/local/src/libdrm", shell=True)
-	os.chdir("/usr/local/src/libdrm")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local --disable-amdgpu --disable-freedreno --disable-vmwgfx --disable-radeon --disable-nouveau", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
+	issue['glproto'] = getGitInfo(c['src'])
+
+def buildLibDrm(c):
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	subprocess.check_call("ldconfig", shell=True)
-	issue['libdrm'] = getGitInfo()
-
-def buildDri2Proto():
-	if not os.path.exists("/usr/local/src/dri2proto"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/proto/dri2proto /usr/local/src/dri2proto", shell=True)
-	os.chdir("/usr/local/src/dri2proto")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
+		checkCall("make clean", build)
+	runLdconfig()
+	issue['libdrm'] = getGitInfo(c['src'])
+
+def buildDri2Proto(c):
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
 	# has no make all, make clean
-	subprocess.check_call("make install", shell=True)
-	issue['dri2proto'] = getGitInfo()
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
+	issue['dri2proto'] = getGitInfo(c['src'])
 
-def buildDri3Proto():
+def buildDri3Proto(c):
 	# unavailable in raspbian
-	if not os.path.exists("/usr/local/src/dri3proto"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/proto/dri3proto /usr/local/src/dri3proto", shell=True)
-	os.chdir("/usr/local/src/dri3proto")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
 	# has no make all, make clean
-	subprocess.check_call("make install", shell=True)
-	issue['dri3proto'] = getGitInfo()
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
+	issue['dri3proto'] = getGitInfo(c['src'])
 
-def buildPresentProto():
+def buildPresentProto(c):
 	# unavailable in raspbian
-	if not os.path.exists("/usr/local/src/presentproto"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/proto/presentproto /usr/local/src/presentproto", shell=True)
-	os.chdir("/usr/local/src/presentproto")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
 	# has no make all, make clean
-	subprocess.check_call("make install", shell=True)
-	issue['presentproto'] = getGitInfo()
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
+	issue['presentproto'] = getGitInfo(c['src'])
 
-def buildLibXShmFence():
+def buildLibXShmFence(c):
 	# unavailable in raspbian
-	if not os.path.exists("/usr/local/src/libxshmfence"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/lib/libxshmfence /usr/local/src/libxshmfence", shell=True)
-	os.chdir("/usr/local/src/libxshmfence")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	subprocess.check_call("ldconfig", shell=True)
-	issue['libxshmfence'] = getGitInfo()
+		checkCall("make clean", build)
+	runLdconfig()
+	issue['libxshmfence'] = getGitInfo(c['src'])
 
-def buildMesa():
+def buildMesa(c):
 	# XXX: compile libvdpau from sources (needs to be >= 1.1 but the packaged one is 0.4.1, re-add --enable-vdpau)
-	subprocess.check_call("apt-get -y install bison flex python-mako libx11-dev libx11-xcb-dev libxext-dev libxdamage-dev libxfixes-dev libudev-dev libexpat-dev gettext libomxil-bellagio-dev", shell=True)
-	if not os.path.exists("/usr/local/src/mesa"):
-		subprocess.check_call("git clone " + MESA_GIT_REPO + " /usr/local/src/mesa", shell=True)
-	os.chdir("/usr/local/src/mesa")
-	subprocess.check_call("git remote set-url origin " + MESA_GIT_REPO, shell=True)
-	subprocess.call("git fetch", shell=True)
-	subprocess.check_call("git checkout -f -B " + MESA_GIT_BRANCH + " origin/" + MESA_GIT_BRANCH, shell=True)
+	build = getBuildDir(c)
 	# workaround https://bugs.freedesktop.org/show_bug.cgi?id=80848
-	if not os.path.exists("/usr/lib/arm-linux-gnueabihf/tmp-libxcb"):
-		subprocess.call("mkdir /usr/lib/arm-linux-gnueabihf/tmp-libxcb", shell=True)
-		subprocess.check_call("mv /usr/lib/arm-linux-gnueabihf/libxcb* /usr/lib/arm-linux-gnueabihf/tmp-libxcb", shell=True)
-	subprocess.check_call("ldconfig", shell=True)
-	# XXX: unsure if swrast is needed
-	# --enable-glx-tls matches Raspbian's config
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local --with-gallium-drivers=vc4 --enable-gles1 --enable-gles2 --with-egl-platforms=x11,drm --with-dri-drivers=swrast --enable-dri3 --enable-glx-tls --enable-omx", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	# (mesa is 'exclusive', so nothing else builds while Raspbian's
+	# libxcb is gone)
+	libs = ROOT + "/usr/lib/arm-linux-gnueabihf"
+	if not os.path.exists(libs + "/tmp-libxcb"):
+		call("mkdir " + libs + "/tmp-libxcb", build)
+		checkCall("mv " + libs + "/libxcb* " + libs + "/tmp-libxcb", build)
+	runLdconfig()
+	try:
+		# XXX: unsure if swrast is needed
+		# --enable-glx-tls matches Raspbian's config
+		checkCall(getAutogen(c), build)
+		checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+		checkCall("make install DESTDIR=" + getStageDir(c), build)
+	finally:
+		# undo workaround, also when the build failed
+		checkCall("mv " + libs + "/tmp-libxcb/* " + libs, build)
+		checkCall("rmdir " + libs + "/tmp-libxcb", build)
+		runLdconfig()
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	# undo workaround
-	subprocess.check_call("mv /usr/lib/arm-linux-gnueabihf/tmp-libxcb/* /usr/lib/arm-linux-gnueabihf", shell=True)
-	subprocess.check_call("rmdir /usr/lib/arm-linux-gnueabihf/tmp-libxcb", shell=True)
-	subprocess.check_call("ldconfig", shell=True)
-	issue['mesa'] = getGitInfo()
-
-def buildXTrans():
+		checkCall("make clean", build)
+	issue['mesa'] = getGitInfo(c['src'])
+
+def buildXTrans(c):
 	# xserver: Requested 'xtrans >= 1.3.5' but version of XTrans is 1.2.7
-	if not os.path.exists("/usr/local/src/libxtrans"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/lib/libxtrans /usr/local/src/libxtrans", shell=True)
-	os.chdir("/usr/local/src/libxtrans")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
 	# move .pc file to standard path
-	subprocess.check_call("mv /usr/local/share/pkgconfig/xtrans.pc /usr/local/lib/pkgconfig", shell=True)
+	checkCall("mkdir -p " + getStageDir(c) + "/usr/local/lib/pkgconfig", build)
+	checkCall("mv " + getStageDir(c) + "/usr/local/share/pkgconfig/xtrans.pc " + getStageDir(c) + "/usr/local/lib/pkgconfig", build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	issue['xtrans'] = getGitInfo()
+		checkCall("make clean", build)
+	issue['xtrans'] = getGitInfo(c['src'])
 
-def buildXProto():
+def buildXProto(c):
 	# xserver: Requested 'xproto >= 7.0.26' but version of Xproto is 7.0.23
-	if not os.path.exists("/usr/local/src/xproto"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/proto/xproto /usr/local/src/xproto", shell=True)
-	os.chdir("/usr/local/src/xproto")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	issue['xproto'] = getGitInfo()
+		checkCall("make clean", build)
+	issue['xproto'] = getGitInfo(c['src'])
 
-def buildXExtProto():
+def buildXExtProto(c):
 	# xserver: Requested 'xextproto >= 7.2.99.901' but version of XExtProto is 7.2.1
-	if not os.path.exists("/usr/local/src/xextproto"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/proto/xextproto /usr/local/src/xextproto", shell=True)
-	os.chdir("/usr/local/src/xextproto")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	issue['xextproto'] = getGitInfo()
+		checkCall("make clean", build)
+	issue['xextproto'] = getGitInfo(c['src'])
 
-def buildInputProto():
+def buildInputProto(c):
 	# xserver: Requested 'inputproto >= 2.3' but version of InputProto is 2.2
-	if not os.path.exists("/usr/local/src/inputproto"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/proto/inputproto /usr/local/src/inputproto", shell=True)
-	os.chdir("/usr/local/src/inputproto")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	issue['inputproto'] = getGitInfo()
+		checkCall("make clean", build)
+	issue['inputproto'] = getGitInfo(c['src'])
 
-def buildRandrProto():
+def buildRandrProto(c):
 	# xserver: Requested 'randrproto >= 1.4.0' but version of RandrProto is 1.3.2
-	if not os.path.exists("/usr/local/src/randrproto"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/proto/randrproto /usr/local/src/randrproto", shell=True)
-	os.chdir("/usr/local/src/randrproto")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
 	# has no make all, make clean
-	subprocess.check_call("make install", shell=True)
-	issue['randrproto'] = getGitInfo()
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
+	issue['randrproto'] = getGitInfo(c['src'])
 
-def buildFontsProto():
+def buildFontsProto(c):
 	# xserver: Requested 'fontsproto >= 2.1.3' but version of FontsProto is 2.1.2
-	if not os.path.exists("/usr/local/src/fontsproto"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/proto/fontsproto /usr/local/src/fontsproto", shell=True)
-	os.chdir("/usr/local/src/fontsproto")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	issue['fontsproto'] = getGitInfo()
+		checkCall("make clean", build)
+	issue['fontsproto'] = getGitInfo(c['src'])
 
-def buildLibEpoxy():
+def buildLibEpoxy(c):
 	# xserver: needed for glamor, unavailable in raspbian
-	if not os.path.exists("/usr/local/src/libepoxy"):
-		subprocess.check_call("git clone https://github.com/anholt/libepoxy.git /usr/local/src/libepoxy", shell=True)
-	os.chdir("/usr/local/src/libepoxy")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	subprocess.check_call("ldconfig", shell=True)
-	issue['libepoxy'] = getGitInfo()
-
-def buildXServer():
-	subprocess.check_call("apt-get -y install libpixman-1-dev libssl-dev x11proto-xcmisc-dev x11proto-bigreqs-dev x11proto-render-dev x11proto-video-dev x11proto-composite-dev x11proto-record-dev x11proto-scrnsaver-dev x11proto-resource-dev x11proto-xf86dri-dev x11proto-xinerama-dev libxkbfile-dev libxfont-dev libpciaccess-dev libxcb-keysyms1-dev", shell=True)
-	# without libxcb-keysyms1-dev compiling fails with "Keyboard.c:21:29: fatal error: xcb/xcb_keysyms.h: No such file or directory compilation terminated.
-	if not os.path.exists("/usr/local/src/xserver"):
-		subprocess.check_call("git clone " + XSERVER_GIT_REPO + " /usr/local/src/xserver", shell=True)
-	os.chdir("/usr/local/src/xserver")
-	subprocess.check_call("git remote set-url origin " + XSERVER_GIT_REPO, shell=True)
-	subprocess.call("git fetch", shell=True)
-	subprocess.check_call("git checkout -f -B " + XSERVER_GIT_BRANCH + " origin/" + XSERVER_GIT_BRANCH, shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local --enable-glamor --enable-dri2 --enable-dri3 --enable-present --disable-unit-tests", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+		checkCall("make clean", build)
+	runLdconfig()
+	issue['libepoxy'] = getGitInfo(c['src'])
+
+def buildXServer(c):
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	stage = getStageDir(c)
 	# copy xorg.conf
-	subprocess.call("mkdir /usr/local/etc/X11", shell=True)
-	subprocess.check_call("cp "+DATA_DIR+"/xorg.conf /usr/local/etc/X11", shell=True)
+	call("mkdir -p " + stage + "/usr/local/etc/X11", build)
+	checkCall("cp "+DATA_DIR+"/xorg.conf " + stage + "/usr/local/etc/X11", build)
 	# workaround "XKB: Couldn't open rules file /usr/local/share/X11/xkb/rules/$"
-	subprocess.call("ln -s /usr/share/X11/xkb/rules /usr/local/share/X11/xkb/rules", shell=True)
+	call("ln -s /usr/share/X11/xkb/rules " + stage + "/usr/local/share/X11/xkb/rules", build)
 	# workaround "XKB: Failed to compile keymap"
-	subprocess.call("ln -s /usr/bin/xkbcomp /usr/local/bin/xkbcomp", shell=True)
+	call("ln -s /usr/bin/xkbcomp " + stage + "/usr/local/bin/xkbcomp", build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	issue['xserver'] = getGitInfo()
-
-def buildMesaDemos():
-	# this needs libglew1.7 to run
-	subprocess.check_call("apt-get -y install libglew-dev", shell=True)
-	if not os.path.exists("/usr/local/src/mesa-demos"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/mesa/demos /usr/local/src/mesa-demos", shell=True)
-	os.chdir("/usr/local/src/mesa-demos")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local --without-glut", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+		checkCall("make clean", build)
+	issue['xserver'] = getGitInfo(c['src'])
+
+def buildMesaDemos(c):
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	subprocess.check_call("ldconfig", shell=True)
-	issue['mesa-demos'] = getGitInfo()
+		checkCall("make clean", build)
+	runLdconfig()
+	issue['mesa-demos'] = getGitInfo(c['src'])
 
-def buildLibEvdev():
+def buildLibEvdev(c):
 	# >= 0.4 needed for xf86-input-evdev
-	if not os.path.exists("/usr/local/src/libevdev"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/libevdev /usr/local/src/libevdev", shell=True)
-	os.chdir("/usr/local/src/libevdev")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	subprocess.check_call("ldconfig", shell=True)
-	issue['libevdev'] = getGitInfo()
+		checkCall("make clean", build)
+	runLdconfig()
+	issue['libevdev'] = getGitInfo(c['src'])
 
-def buildInputEvdev():
+def buildInputEvdev(c):
 	# ABI major version on raspbian is 16 (vs. currently 22), so build evdev module
-	subprocess.check_call("apt-get -y install libmtdev-dev", shell=True)
-	if not os.path.exists("/usr/local/src/xf86-input-evdev"):
-		subprocess.check_call("git clone git://anongit.freedesktop.org/xorg/driver/xf86-input-evdev /usr/local/src/xf86-input-evdev", shell=True)
-	os.chdir("/usr/local/src/xf86-input-evdev")
-	subprocess.call("git pull", shell=True)
-	subprocess.check_call("ACLOCAL_PATH=/usr/local/share/aclocal ./autogen.sh --prefix=/usr/local", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("make install", shell=True)
+	build = getBuildDir(c)
+	checkCall(getAutogen(c), build)
+	checkCall(getBuildEnv(c) + "make " + MAKE_OPTS, build)
+	checkCall("make install DESTDIR=" + getStageDir(c), build)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("make clean", shell=True)
-	issue['xf86-input-evdev'] = getGitInfo()
+		checkCall("make clean", build)
+	issue['xf86-input-evdev'] = getGitInfo(c['src'])
 
-def buildLinux():
-	# install dependencies
-	# (menuconfig additionally needs ncurses-dev)
-	subprocess.check_call("apt-get -y install bc", shell=True)
-	if not os.path.exists("/usr/local/src/raspberrypi-tools"):
-		subprocess.check_call("git clone https://github.com/raspberrypi/tools /usr/local/src/raspberrypi-tools", shell=True)
-	os.chdir("/usr/local/src/raspberrypi-tools")
-	subprocess.call("git pull", shell=True)
-	# get up-to-date git tree
-	if not os.path.exists("/usr/local/src/linux"):
-		subprocess.check_call("git clone " + LINUX_GIT_REPO_2708 + " /usr/local/src/linux ", shell=True)
-	issue['raspberrypi-tools'] = getGitInfo()
-	os.chdir("/usr/local/src/linux")
+def buildRaspberryPiTools(c):
+	# only needed for mkknlimg, installs nothing
+	mergeStage(c)
+	issue['raspberrypi-tools'] = getGitInfo(c['src'])
+
+def buildLinux2708(c):
 	# compile a downstream kernel for 2708
-	subprocess.check_call("git remote set-url origin " + LINUX_GIT_REPO_2708, shell=True)
-	subprocess.call("git fetch", shell=True)
-	subprocess.check_call("git checkout -f -B " + LINUX_GIT_BRANCH_2708 + " origin/" + LINUX_GIT_BRANCH_2708, shell=True)
-	subprocess.check_call("make mrproper", shell=True)
+	src = c['src']
+	build = getKernelBuildDir(c)
+	kmake = getKernelMake(c, build)
+	# kbuild refuses O= builds from a configured source tree, this
+	# leaves the objects in the build directory alone
+	checkCall("make mrproper", src)
 	#subprocess.check_call("cp " + DATA_DIR + "/config-2708 .config", shell=True)
-	subprocess.check_call("make bcmrpi_defconfig", shell=True)
+	checkCall(kmake + " bcmrpi_defconfig", src)
 	# change localversion
-	subprocess.check_call("sed -i 's/CONFIG_LOCALVERSION=\"\"/CONFIG_LOCALVERSION=\"-2708\"/' .config", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	# remove old kernel versions
-	subprocess.check_call("rm -rf /lib/modules/*-2708*", shell=True)
-	subprocess.check_call("make modules_install", shell=True)
-	subprocess.check_call("cp arch/arm/boot/dts/bcm2708-rpi-b.dtb /boot/bcm2708-rpi-b.dtb", shell=True)
-	subprocess.check_call("cp arch/arm/boot/dts/bcm2708-rpi-b-plus.dtb /boot/bcm2708-rpi-b-plus.dtb", shell=True)
-	subprocess.check_call("cp arch/arm/boot/dts/bcm2708-rpi-cm.dtb /boot/bcm2708-rpi-cm.dtb", shell=True)
-	# this signals to the bootloader that device tree is supported
-	subprocess.check_call("/usr/local/src/raspberrypi-tools/mkimage/mkknlimg --dtok arch/arm/boot/zImage arch/arm/boot/zImage", shell=True)
-	subprocess.check_call("cp arch/arm/boot/zImage /boot/kernel.img", shell=True)
-	subprocess.check_call("cp .config /boot/kernel.img-config", shell=True)
-	issue['linux-2708'] = getGitInfo()
+	checkCall("sed -i 's/CONFIG_LOCALVERSION=\"\"/CONFIG_LOCALVERSION=\"-2708\"/' .config", build)
+	checkCall(kmake + " " + MAKE_OPTS, src)
+	stage = getStageDir(c)
+	checkCall(kmake + " modules_install INSTALL_MOD_PATH=" + stage, src)
+	checkCall("mkdir -p " + stage + "/boot", build)
+	checkCall("cp arch/arm/boot/dts/bcm2708-rpi-b.dtb " + stage + "/boot/bcm2708-rpi-b.dtb", build)
+	checkCall("cp arch/arm/boot/dts/bcm2708-rpi-b-plus.dtb " + stage + "/boot/bcm2708-rpi-b-plus.dtb", build)
+	checkCall("cp arch/arm/boot/dts/bcm2708-rpi-cm.dtb " + stage + "/boot/bcm2708-rpi-cm.dtb", build)
+	# this signals to the bootloader that device tree is supported,
+	# written to the staged install so that the zImage in the build
+	# directory stays as make left it for the next run
+	checkCall("/usr/local/src/raspberrypi-tools/mkimage/mkknlimg --dtok arch/arm/boot/zImage " + stage + "/boot/kernel.img", build)
+	checkCall("cp .config " + stage + "/boot/kernel.img-config", build)
+	installLinux2708(c)
+	issue['linux-2708'] = getGitInfo(src)
+
+def installLinux2708(c):
+	with bootLock:
+		# remove old kernel versions
+		checkCall("rm -rf " + ROOT + "/lib/modules/*-2708*")
+		mergeStage(c, True)
+
+def buildLinux2709(c):
 	# compile a downstream kernel for 2709
-	subprocess.check_call("git remote set-url origin " + LINUX_GIT_REPO_2709, shell=True)
-	subprocess.call("git fetch", shell=True)
-	subprocess.check_call("git checkout -f -B " + LINUX_GIT_BRANCH_2709 + " origin/" + LINUX_GIT_BRANCH_2709, shell=True)
-	subprocess.check_call("make mrproper", shell=True)
+	src = c['src']
+	build = getKernelBuildDir(c)
+	kmake = getKernelMake(c, build)
+	checkCall("make mrproper", src)
 	#subprocess.check_call("cp " + DATA_DIR + "/config-2709 .config", shell=True)
-	subprocess.check_call("make bcm2709_defconfig", shell=True)
+	checkCall(kmake + " bcm2709_defconfig", src)
 	# change localversion
-	subprocess.check_call("sed -i 's/CONFIG_LOCALVERSION=\"-v7\"/CONFIG_LOCALVERSION=\"-2709\"/' .config", shell=True)
-	subprocess.check_call("make " + MAKE_OPTS, shell=True)
-	subprocess.check_call("rm -rf /lib/modules/*-2709*", shell=True)
-	subprocess.check_call("make modules_install", shell=True)
-	subprocess.check_call("cp arch/arm/boot/dts/bcm2709-rpi-2-b.dtb /boot/bcm2709-rpi-2-b.dtb", shell=True)
-	subprocess.check_call("cp arch/arm/boot/dts/bcm2710-rpi-3-b.dtb /boot/bcm2710-rpi-3-b.dtb", shell=True)
-	# overlays are automatically generated with DT-enabled configs
-	subprocess.check_call("rm -rf /boot/overlays/*.dtb", shell=True)
-	subprocess.check_call("rm -rf /boot/overlays/*.dtbo", shell=True)
-	subprocess.check_call("cp arch/arm/boot/dts/overlays/*.dtbo /boot/overlays", shell=True)
-	subprocess.check_call("/usr/local/src/raspberrypi-tools/mkimage/mkknlimg --dtok arch/arm/boot/zImage arch/arm/boot/zImage", shell=True)
-	subprocess.check_call("cp arch/arm/boot/zImage /boot/kernel7.img", shell=True)
-	subprocess.check_call("cp .config /boot/kernel7.img-config", shell=True)
-	if CLEANUP:
-		subprocess.check_call("make mrproper", shell=True)
-	issue['linux-2709'] = getGitInfo()
-
-def buildExtraProcessing():
-	subprocess.check_call("apt-get -y install ant", shell=True)
-	# Processing expects this directory to exist as as well
-	if not os.path.exists("/usr/local/src/processing-docs"):
-		subprocess.check_call("git clone https://github.com/processing/processing-docs.git /usr/local/src/processing-docs", shell=True)
-	os.chdir("/usr/local/src/processing-docs")
-	subprocess.call("git pull", shell=True)
-	if not os.path.exists("/usr/local/src/processing"):
-		subprocess.check_call("git clone " + PROCESSING_GIT_REPO + " /usr/local/src/processing", shell=True)
-	os.chdir("/usr/local/src/processing")
-	subprocess.check_call("git remote set-url origin " + PROCESSING_GIT_REPO, shell=True)
-	subprocess.call("git fetch", shell=True)
-	subprocess.check_call("git checkout -f -B " + PROCESSING_GIT_BRANCH + " origin/" + PROCESSING_GIT_BRANCH, shell=True)
-	os.chdir("/usr/local/src/processing/build")
+	checkCall("sed -i 's/CONFIG_LOCALVERSION=\"-v7\"/CONFIG_LOCALVERSION=\"-2709\"/' .config", build)
+	checkCall(kmake + " " + MAKE_OPTS, src)
+	stage = getStageDir(c)
+	checkCall(kmake + " modules_install INSTALL_MOD_PATH=" + stage, src)
+	checkCall("mkdir -p " + stage + "/boot/overlays", build)
+	checkCall("cp arch/arm/boot/dts/bcm2709-rpi-2-b.dtb " + stage + "/boot/bcm2709-rpi-2-b.dtb", build)
+	checkCall("cp arch/arm/boot/dts/bcm2710-rpi-3-b.dtb " + stage + "/boot/bcm2710-rpi-3-b.dtb", build)
+	checkCall("cp arch/arm/boot/dts/overlays/*.dtbo " + stage + "/boot/overlays", build)
+	checkCall("/usr/local/src/raspberrypi-tools/mkimage/mkknlimg --dtok arch/arm/boot/zImage " + stage + "/boot/kernel7.img", build)
+	checkCall("cp .config " + stage + "/boot/kernel7.img-config", build)
+	installLinux2709(c)
+	issue['linux-2709'] = getGitInfo(src)
+
+def installLinux2709(c):
+	with bootLock:
+		checkCall("rm -rf " + ROOT + "/lib/modules/*-2709*")
+		# overlays are automatically generated with DT-enabled configs
+		checkCall("rm -rf " + ROOT + "/boot/overlays/*.dtb")
+		checkCall("rm -rf " + ROOT + "/boot/overlays/*.dtbo")
+		mergeStage(c, True)
+
+def buildExtraProcessing(c):
+	src = c['src'] + "/build"
 	# we could build Processing with a more recent Java version
-	subprocess.check_call("ant linux-build", shell=True)
-	# this also removes previous versions
-	subprocess.check_call("rm -rf /usr/local/lib/processing*", shell=True)
-	subprocess.check_call("mv linux/work /usr/local/lib/processing-" + PROCESSING_VERSION, shell=True)
-	subprocess.check_call("chown root:root -R /usr/local/lib/processing-" + PROCESSING_VERSION, shell=True)
-	subprocess.check_call("ln -sf processing-" + PROCESSING_VERSION + " /usr/local/lib/processing", shell=True)
-	subprocess.check_call("ln -sf /usr/local/lib/processing/processing /usr/local/bin/processing", shell=True)
-	subprocess.check_call("ln -sf /usr/local/lib/processing/processing-java /usr/local/bin/processing-java", shell=True)
-	subprocess.check_call("mkdir -p /usr/local/share/applications", shell=True)
-	subprocess.check_call("cp -f linux/processing.desktop /usr/local/share/applications", shell=True)
+	checkCall("ant linux-build", src)
+	stage = getStageDir(c)
+	checkCall("mkdir -p " + stage + "/usr/local/lib " + stage + "/usr/local/bin " + stage + "/usr/local/share/applications " + stage + "/home/pi", src)
+	checkCall("mv linux/work " + stage + "/usr/local/lib/processing-" + PROCESSING_VERSION, src)
+	checkCall("chown root:root -R " + stage + "/usr/local/lib/processing-" + PROCESSING_VERSION, src)
+	checkCall("ln -sf processing-" + PROCESSING_VERSION + " " + stage + "/usr/local/lib/processing", src)
+	checkCall("ln -sf /usr/local/lib/processing/processing " + stage + "/usr/local/bin/processing", src)
+	checkCall("ln -sf /usr/local/lib/processing/processing-java " + stage + "/usr/local/bin/processing-java", src)
+	checkCall("cp -f linux/processing.desktop " + stage + "/usr/local/share/applications", src)
 	# update .desktop file
-	desktop = file_get_contents("/usr/local/share/applications/processing.desktop")
+	desktop = file_get_contents(stage + "/usr/local/share/applications/processing.desktop")
 	desktop = re.sub('@version@', PROCESSING_VERSION, desktop)
 	desktop = re.sub('/opt/processing', '/usr/local/lib/processing', desktop)
-	file_put_contents("/usr/local/share/applications/processing.desktop", desktop)
+	file_put_contents(stage + "/usr/local/share/applications/processing.desktop", desktop)
 	# inject nightly OpenJFX build (FX2D not working on Raspbian as of 3.0a9, stock or mesa)
 	# this also copies a gstreamer-lite.so btw
 	#subprocess.check_call("wget -q http://108.61.191.178/openjfx-8-sdk-overlay-linux-armv6hf.zip", shell=True)
@@ -514,57 +1104,660 @@ def buildExtraProcessing():
 	#os.chdir("/usr/local/src/processing/build")
 	#subprocess.check_call("rm -rf openjfx*", shell=True)
 	# copy the test script
-	subprocess.check_call("cp -f " + DATA_DIR + "/processing-test3d.* /home/pi", shell=True)
-	subprocess.check_call("chown pi:pi /home/pi/processing-test3d.*", shell=True)
+	checkCall("cp -f " + DATA_DIR + "/processing-test3d.* " + stage + "/home/pi", src)
+	checkCall("chown pi:pi " + stage + "/home/pi/processing-test3d.*", src)
+	# this also removes previous versions
+	checkCall("rm -rf " + ROOT + "/usr/local/lib/processing*", src)
+	mergeStage(c)
 	if CLEANUP:
-		subprocess.check_call("ant clean", shell=True)
+		checkCall("ant clean", src)
 	# this is currently not working for some reason
-	issue['processing'] = getGitInfo()
+	issue['processing'] = getGitInfo(c['src'])
+
+# name: key in issue-vc4.json
+# deps: components that need to be installed before this one
+# git: (directory, repository, branch) to update before building, with
+#      branch None for the repository's default branch
+# configure: flags passed to autogen.sh
+# apt: Raspbian packages needed to build, all installed up front in one go
+# ccache: size of the compiler cache with PERSISTENT_BUILD (CCACHE_SIZE)
+# exclusive: nothing else builds at the same time
+# install: merges the staged install, which gets kept, into the system
+#          again when the build is skipped (the kernels, as
+#          PackageRaspbianVc4.py puts Raspbian's back into /boot)
+COMPONENTS = [
+	# build Processing first since chances are that I screwed up somewhere
+	{ 'name': 'processing', 'build': buildExtraProcessing, 'deps': [],
+		'git': [("/usr/local/src/processing", PROCESSING_GIT_REPO, PROCESSING_GIT_BRANCH),
+			# Processing expects this directory to exist as as well
+			("/usr/local/src/processing-docs", "https://github.com/processing/processing-docs.git", None)],
+		'apt': ["ant"] },
+	# mesa and friends
+	{ 'name': 'xorg-macros', 'build': buildXorgMacros, 'deps': [],
+		'git': [("/usr/local/src/xorg-macros", "git://anongit.freedesktop.org/xorg/util/macros", None)],
+		'apt': ["autoconf"],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'xcb-proto', 'build': buildXcbProto, 'deps': ['xorg-macros'],
+		'git': [("/usr/local/src/xcb-proto", "git://anongit.freedesktop.org/xcb/proto", None)],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'libxcb', 'build': buildLibXcb, 'deps': ['xorg-macros', 'xcb-proto'],
+		'git': [("/usr/local/src/libxcb", "git://anongit.freedesktop.org/xcb/libxcb", None)],
+		'apt': ["libtool", "libpthread-stubs0-dev", "libxau-dev"],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'glproto', 'build': buildGlProto, 'deps': ['xorg-macros'],
+		'git': [("/usr/local/src/glproto", "git://anongit.freedesktop.org/xorg/proto/glproto", None)],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'libdrm', 'build': buildLibDrm, 'deps': ['xorg-macros'],
+		'git': [("/usr/local/src/libdrm", "git://anongit.freedesktop.org/mesa/drm", None)],
+		'apt': ["libudev-dev"],
+		'configure': "--prefix=/usr/local --disable-amdgpu --disable-freedreno --disable-vmwgfx --disable-radeon --disable-nouveau" },
+	{ 'name': 'dri2proto', 'build': buildDri2Proto, 'deps': ['xorg-macros'],
+		'git': [("/usr/local/src/dri2proto", "git://anongit.freedesktop.org/xorg/proto/dri2proto", None)],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'dri3proto', 'build': buildDri3Proto, 'deps': ['xorg-macros'],
+		'git': [("/usr/local/src/dri3proto", "git://anongit.freedesktop.org/xorg/proto/dri3proto", None)],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'presentproto', 'build': buildPresentProto, 'deps': ['xorg-macros'],
+		'git': [("/usr/local/src/presentproto", "git://anongit.freedesktop.org/xorg/proto/presentproto", None)],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'libxshmfence', 'build': buildLibXShmFence, 'deps': ['xorg-macros'],
+		'git': [("/usr/local/src/libxshmfence", "git://anongit.freedesktop.org/xorg/lib/libxshmfence", None)],
+		'configure': "--prefix=/usr/local" },
+	# moves Raspbian's libxcb aside while building
+	{ 'name': 'mesa', 'build': buildMesa, 'deps': ['libxcb', 'glproto', 'libdrm', 'dri2proto', 'dri3proto', 'presentproto', 'libxshmfence'], 'exclusive': 1,
+		'git': [("/usr/local/src/mesa", MESA_GIT_REPO, MESA_GIT_BRANCH)],
+		'apt': ["bison", "flex", "python-mako", "libx11-dev", "libx11-xcb-dev", "libxext-dev", "libxdamage-dev", "libxfixes-dev", "libudev-dev", "libexpat-dev", "gettext", "libomxil-bellagio-dev"],
+		'ccache': "1G",
+		'configure': "--prefix=/usr/local --with-gallium-drivers=vc4 --enable-gles1 --enable-gles2 --with-egl-platforms=x11,drm --with-dri-drivers=swrast --enable-dri3 --enable-glx-tls --enable-omx" },
+	# xserver and friends, after mesa as it gets built against Raspbian's
+	# X headers
+	{ 'name': 'xtrans', 'build': buildXTrans, 'deps': ['xorg-macros', 'mesa'],
+		'git': [("/usr/local/src/libxtrans", "git://anongit.freedesktop.org/xorg/lib/libxtrans", None)],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'xproto', 'build': buildXProto, 'deps': ['xorg-macros', 'mesa'],
+		'git': [("/usr/local/src/xproto", "git://anongit.freedesktop.org/xorg/proto/xproto", None)],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'xextproto', 'build': buildXExtProto, 'deps': ['xorg-macros', 'mesa'],
+		'git': [("/usr/local/src/xextproto", "git://anongit.freedesktop.org/xorg/proto/xextproto", None)],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'inputproto', 'build': buildInputProto, 'deps': ['xorg-macros', 'mesa'],
+		'git': [("/usr/local/src/inputproto", "git://anongit.freedesktop.org/xorg/proto/inputproto", None)],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'randrproto', 'build': buildRandrProto, 'deps': ['xorg-macros', 'mesa'],
+		'git': [("/usr/local/src/randrproto", "git://anongit.freedesktop.org/xorg/proto/randrproto", None)],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'fontsproto', 'build': buildFontsProto, 'deps': ['xorg-macros', 'mesa'],
+		'git': [("/usr/local/src/fontsproto", "git://anongit.freedesktop.org/xorg/proto/fontsproto", None)],
+		'configure': "--prefix=/usr/local" },
+	# libepoxy picks up EGL/GLES support from the installed mesa
+	{ 'name': 'libepoxy', 'build': buildLibEpoxy, 'deps': ['xorg-macros', 'mesa', 'xtrans', 'xproto', 'xextproto', 'inputproto', 'randrproto', 'fontsproto'],
+		'git': [("/usr/local/src/libepoxy", "https://github.com/anholt/libepoxy.git", None)],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'xserver', 'build': buildXServer, 'deps': ['mesa', 'xtrans', 'xproto', 'xextproto', 'inputproto', 'randrproto', 'fontsproto', 'libepoxy'],
+		'git': [("/usr/local/src/xserver", XSERVER_GIT_REPO, XSERVER_GIT_BRANCH)],
+		# without libxcb-keysyms1-dev compiling fails with "Keyboard.c:21:29: fatal error: xcb/xcb_keysyms.h: No such file or directory compilation terminated.
+		'apt': ["libpixman-1-dev", "libssl-dev", "x11proto-xcmisc-dev", "x11proto-bigreqs-dev", "x11proto-render-dev", "x11proto-video-dev", "x11proto-composite-dev", "x11proto-record-dev", "x11proto-scrnsaver-dev", "x11proto-resource-dev", "x11proto-xf86dri-dev", "x11proto-xinerama-dev", "libxkbfile-dev", "libxfont-dev", "libpciaccess-dev", "libxcb-keysyms1-dev"],
+		'ccache': "512M",
+		'configure': "--prefix=/usr/local --enable-glamor --enable-dri2 --enable-dri3 --enable-present --disable-unit-tests" },
+	# glxgears and friends
+	{ 'name': 'mesa-demos', 'build': buildMesaDemos, 'deps': ['mesa', 'xproto', 'xextproto'],
+		'git': [("/usr/local/src/mesa-demos", "git://anongit.freedesktop.org/mesa/demos", None)],
+		# this needs libglew1.7 to run
+		'apt': ["libglew-dev"],
+		'configure': "--prefix=/usr/local --without-glut" },
+	# xserver modules
+	{ 'name': 'libevdev', 'build': buildLibEvdev, 'deps': ['xorg-macros'],
+		'git': [("/usr/local/src/libevdev", "git://anongit.freedesktop.org/libevdev", None)],
+		'configure': "--prefix=/usr/local" },
+	{ 'name': 'xf86-input-evdev', 'build': buildInputEvdev, 'deps': ['xserver', 'libevdev'],
+		'git': [("/usr/local/src/xf86-input-evdev", "git://anongit.freedesktop.org/xorg/driver/xf86-input-evdev", None)],
+		'apt': ["libmtdev-dev"],
+		'configure': "--prefix=/usr/local" },
+]
+COMPONENTS.append({ 'name': 'raspberrypi-tools', 'build': buildRaspberryPiTools, 'deps': [],
+	'git': [("/usr/local/src/raspberrypi-tools", "https://github.com/raspberrypi/tools", None)] })
+if CROSS:
+	# ant would bundle the JRE of the machine it runs on, everything else
+	# gets compiled with the toolchain in raspberrypi/tools
+	COMPONENTS = [c for c in COMPONENTS if c['name'] != 'processing']
+	for c in COMPONENTS:
+		if c['name'] != 'raspberrypi-tools':
+			c['deps'].append('raspberrypi-tools')
+# build kernels last to minimize window where we would boot an
+# untested kernel on power outage etc, both from their own working tree
+# so that they can build at the same time
+userland = [c['name'] for c in COMPONENTS]
+COMPONENTS.append({ 'name': 'linux-2708', 'build': buildLinux2708, 'install': installLinux2708, 'deps': userland,
+	'git': [("/usr/local/src/linux-2708", LINUX_GIT_REPO_2708, LINUX_GIT_BRANCH_2708)],
+	# (menuconfig additionally needs ncurses-dev)
+	'apt': ["bc"],
+	'ccache': "1G" })
+COMPONENTS.append({ 'name': 'linux-2709', 'build': buildLinux2709, 'install': installLinux2709, 'deps': userland,
+	'git': [("/usr/local/src/linux-2709", LINUX_GIT_REPO_2709, LINUX_GIT_BRANCH_2709)],
+	'apt': ["bc"],
+	'ccache': "1G" })
+for c in COMPONENTS:
+	# the first repository is the one the component gets built in
+	c['src'] = c['git'][0][0]
+	c.setdefault('apt', [])
+
+def log(s):
+	sys.stdout.write(s + "\n")
+	sys.stdout.flush()
+
+def startJobServer(jobs):
+	# GNU make jobserver: every byte in the pipe is one job slot, make
+	# picks up the pipe from MAKEFLAGS instead of its own -j
+	r, w = os.pipe()
+	if hasattr(os, 'set_inheritable'):
+		os.set_inheritable(r, True)
+		os.set_inheritable(w, True)
+	os.write(w, b'+' * jobs)
+	os.environ['MAKEFLAGS'] = "-j --jobserver-fds=%d,%d --jobserver-auth=%d,%d" % (r, w, r, w)
+	return (r, w)
+
+def acquireJob(timeout=None):
+	# newer makes switch the (shared) pipe to non-blocking mode
+	while True:
+		if not select.select([jobServer[0]], [], [], timeout)[0]:
+			return False
+		try:
+			os.read(jobServer[0], 1)
+			return True
+		except OSError as e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+def releaseJob():
+	os.write(jobServer[1], b'+')
+
+def setJobs(jobs):
+	# take job slots out of circulation as they become free, or put
+	# them back
+	global withheld
+	while withheld < jobServerSize - jobs and acquireJob(0):
+		withheld += 1
+	while 0 < withheld and jobServerSize - withheld < jobs:
+		releaseJob()
+		withheld -= 1
+
+def getMemInfo():
+	info = {}
+	for line in file_get_contents("/proc/meminfo").split("\n"):
+		match = re.match(r'^(\w+):\s+(\d+)', line)
+		if match:
+			info[match.group(1)] = int(match.group(2))
+	# MemAvailable is missing before Linux 3.14
+	if 'MemAvailable' not in info:
+		info['MemAvailable'] = info['MemFree'] + info.get('Buffers', 0) + info.get('Cached', 0)
+	return info
+
+def getSwapOuts():
+	match = re.search(r'^pswpout (\d+)', file_get_contents("/proc/vmstat"), re.MULTILINE)
+	if match:
+		return int(match.group(1))
+	return 0
+
+def getLinkingComponents():
+	# components with a linker running in their directories
+	names = []
+	for pid in os.listdir("/proc"):
+		if not pid.isdigit():
+			continue
+		try:
+			if file_get_contents("/proc/" + pid + "/comm").strip() not in LINKERS:
+				continue
+			cwd = os.readlink("/proc/" + pid + "/cwd")
+		except (IOError, OSError):
+			# gone already
+			continue
+		for name, c in list(building.items()):
+			for dir in [c['src'], BUILD_DIR + "/" + name]:
+				if cwd == dir or cwd.startswith(dir + "/"):
+					names.append(name)
+	return names
+
+def getTargetJobs(baseline):
+	# as many jobs as fit into the memory that was available when we
+	# started, sized after the biggest job that could be running:
+	# linking a component known to need a lot of memory for it, or
+	# an ordinary compile job
+	perJob = JOB_MEMORY
+	for name in getLinkingComponents():
+		perJob = max(perJob, history.get(name, {}).get('maxrss', 0))
+	return max(1, min(jobServerSize, baseline // perJob))
+
+def governJobs():
+	# swapping makes a build slower than running it serially, so
+	# back off one slot at a time while memory is short
+	baseline = getMemInfo()['MemAvailable']
+	swapOuts = getSwapOuts()
+	squeeze = jobServerSize
+	jobs = 0
+	while True:
+		available = getMemInfo()['MemAvailable']
+		swapped = getSwapOuts() - swapOuts
+		swapOuts = swapOuts + swapped
+		if available < MEMORY_LOW or swapped:
+			squeeze = max(1, min(squeeze, jobServerSize - withheld) - 1)
+		elif 2 * MEMORY_LOW < available:
+			squeeze = min(jobServerSize, squeeze + 1)
+		target = min(getTargetJobs(baseline), squeeze)
+		if target != jobs:
+			log("Job slots: %d (%d MB available)" % (target, available // 1024))
+			jobs = target
+		setJobs(jobs)
+		counters.append((time.time(), 'jobs', jobServerSize - withheld))
+		counters.append((time.time(), 'available MB', available // 1024))
+		time.sleep(GOVERNOR_INTERVAL)
+
+def startGovernor():
+	t = threading.Thread(target=governJobs, name="governor")
+	t.daemon = True
+	t.start()
+
+def loadHistory():
+	global history
+	if os.path.exists(HISTORY_FILE):
+		history = json.loads(file_get_contents(HISTORY_FILE))
+
+def saveHistory():
+	s = json.dumps(history, sort_keys=True, indent=4, separators=(',', ': '))
+	file_put_contents(HISTORY_FILE + ".tmp", s)
+	os.rename(HISTORY_FILE + ".tmp", HISTORY_FILE)
+
+def loadTimes():
+	if os.path.exists(TIMES_FILE):
+		return json.loads(file_get_contents(TIMES_FILE))
+	return {}
+
+def addTime(name, wall):
+	# read every time, PackageRaspbianVc4.py and the build it runs both
+	# add to it
+	with timesLock:
+		times = loadTimes()
+		times[name] = (times.get(name, []) + [round(wall, 2)])[-TIMES_KEEP:]
+		s = json.dumps(times, sort_keys=True, indent=4, separators=(',', ': '))
+		file_put_contents(TIMES_FILE + ".tmp", s)
+		os.rename(TIMES_FILE + ".tmp", TIMES_FILE)
+
+def timed(name, func, *args):
+	start = time.time()
+	ret = func(*args)
+	addTime(name, time.time() - start)
+	return ret
+
+def getRepos(components):
+	repos = []
+	for c in components:
+		for (src, repo, branch) in c['git']:
+			if repo not in repos:
+				repos.append(repo)
+	return repos
+
+def prefetchWorker(todo, events):
+	while True:
+		try:
+			repo = todo.get_nowait()
+		except queue.Empty:
+			return
+		try:
+			timed("fetch " + repo, updateMirror, repo)
+		except Exception:
+			# the component using it will fail when updating its source
+			traceback.print_exc()
+		events.put(('fetched', repo, None))
+
+def prefetchSources(components):
+	# update all mirrors in the background, in the order of components,
+	# while the scheduler starts building whatever got fetched already
+	events = queue.Queue()
+	todo = queue.Queue()
+	repos = getRepos(components)
+	# pinned commits were fetched before, no need to ask the network
+	unpinned = getRepos([{ 'git': c['git'][1:] if c['name'] in pins else c['git'] } for c in components])
+	for repo in repos:
+		if repo not in unpinned and os.path.exists(getMirrorDir(repo)):
+			events.put(('fetched', repo, None))
+		else:
+			todo.put(repo)
+	for i in range(min(PREFETCH_JOBS, len(repos))):
+		t = threading.Thread(target=prefetchWorker, name="prefetch-" + str(i + 1), args=(todo, events))
+		t.daemon = True
+		t.start()
+	return events
+
+def isUnchanged(c):
+	# whether the component can be skipped, with fingerprints[] set
+	prev = installed.get(c['name'])
+	if not (INCREMENTAL or RESUME) or not prev or prev['fingerprint'] != fingerprints[c['name']]:
+		return False
+	# without the list of its files it can't be packaged
+	if loadFileList(c['name']) is None:
+		return False
+	# nor installed again without its staged install
+	return 'install' not in c or os.path.isdir(getStageDir(c))
+
+def acquireBuild(exclusive):
+	global sharedBuilds, exclusiveBuild, exclusiveWaiting
+	with buildLock:
+		if exclusive:
+			# new builds wait as well, so that this one gets its turn
+			exclusiveWaiting += 1
+			while exclusiveBuild or sharedBuilds:
+				buildLock.wait()
+			exclusiveWaiting -= 1
+			exclusiveBuild = True
+		else:
+			while exclusiveBuild or exclusiveWaiting:
+				buildLock.wait()
+			sharedBuilds += 1
+
+def releaseBuild(exclusive):
+	global sharedBuilds, exclusiveBuild
+	with buildLock:
+		if exclusive:
+			exclusiveBuild = False
+		else:
+			sharedBuilds -= 1
+		buildLock.notify_all()
+
+def runComponent(c, events):
+	# the slot taken by the scheduler stands for the implicit job of
+	# the toplevel make (or the configure script, install etc)
+	try:
+		current.component = c['name']
+		building[c['name']] = c
+		start = time.time()
+		# pins are for the repository the component gets built in
+		commits = [updateSource(src, repo, branch, pins.get(c['name']) if src == c['src'] else None) for (src, repo, branch) in c['git']]
+		fingerprints[c['name']] = getFingerprint(c, commits)
+		prev = installed.get(c['name'])
+		skipped = isUnchanged(c)
+		cached = not skipped and isStageCached(c)
+		if skipped:
+			log("Skipping " + c['name'] + " (unchanged)")
+			issue[c['name']] = dict(prev['issue'])
+			if 'install' in c:
+				c['install'](c)
+		else:
+			# a half-installed component must not match anymore
+			with fingerprintLock:
+				installed.pop(c['name'], None)
+				saveFingerprints()
+			# left over from a build that failed
+			checkCall("rm -rf " + getStageDir(c))
+			if cached:
+				log("Installing " + c['name'] + " from " + getStageCacheDir(c))
+				installStageCache(c)
+			else:
+				log("Building " + c['name'])
+				if PERSISTENT_BUILD:
+					resetCacheStats(c)
+				acquireBuild(c.get('exclusive'))
+				try:
+					c['build'](c)
+				finally:
+					releaseBuild(c.get('exclusive'))
+				log("Finished " + c['name'])
+				if PERSISTENT_BUILD:
+					hits, misses = getCacheStats(c)
+					if hits + misses:
+						log("ccache %s: %d hits, %d misses (%d%%)" % (c['name'], hits, misses, 100 * hits / (hits + misses)))
+				if STAGE_CACHE:
+					saveStageCache(c)
+			with fingerprintLock:
+				installed[c['name']] = { 'fingerprint': fingerprints[c['name']], 'issue': dict(issue[c['name']]) }
+				saveFingerprints()
+		issue[c['name']]['stats'] = getStepStats(c['name'])
+		issue[c['name']]['stats']['wall'] = round(time.time() - start, 2)
+		if skipped:
+			# times don't say anything about building it then
+			issue[c['name']]['stats']['skipped'] = 1
+			addTime("skip " + c['name'], issue[c['name']]['stats']['wall'])
+		elif cached:
+			issue[c['name']]['stats']['cached'] = 1
+		else:
+			addTime(c['name'], issue[c['name']]['stats']['wall'])
+			stats = issue[c['name']]['stats']
+			with historyLock:
+				history[c['name']] = { 'wall': stats['wall'], 'user': stats['user'], 'sys': stats['sys'], 'maxrss': stats['maxrss'] }
+				saveHistory()
+		events.put(('built', c['name'], None))
+	except Exception as e:
+		traceback.print_exc()
+		events.put(('built', c['name'], e))
+	finally:
+		building.pop(c['name'], None)
+		releaseJob()
+
+def buildComponents(components, jobs, events):
+	global jobServer, jobServerSize
+	if not jobs:
+		jobs = multiprocessing.cpu_count()
+	jobServer = startJobServer(jobs)
+	jobServerSize = jobs
+	startGovernor()
+	names = [c['name'] for c in components]
+	for c in components:
+		for dep in c['deps']:
+			if dep not in names:
+				raise Exception(c['name'] + " depends on unknown component " + dep)
+	pending = list(components)
+	# repositories still being fetched by prefetchSources()
+	fetching = getRepos(components)
+	done = []
+	failed = []
+	running = 0
+	while pending or running:
+		# start whatever is ready, in the order of components
+		ready = [c for c in pending if all(dep in done for dep in c['deps']) and all(repo not in fetching for (src, repo, branch) in c['git'])]
+		if ready and not failed:
+			acquireJob()
+			pending.remove(ready[0])
+			t = threading.Thread(target=runComponent, name=ready[0]['name'], args=(ready[0], events))
+			t.daemon = True
+			t.start()
+			running += 1
+			continue
+		if not running and (failed or not fetching):
+			# nothing can make progress anymore
+			break
+		# wait for a build or fetch to finish, and collect the ones
+		# that finished in the meantime
+		event = events.get()
+		while event:
+			kind, name, error = event
+			if kind == 'fetched':
+				fetching.remove(name)
+			else:
+				running -= 1
+				if error is None:
+					done.append(name)
+				else:
+					failed.append(name)
+			try:
+				event = events.get_nowait()
+			except queue.Empty:
+				event = None
+	if failed:
+		exit("Failed building " + ", ".join(failed))
+	if pending:
+		exit("Could not build " + ", ".join([c['name'] for c in pending]))
 
 def buildIssueJson():
-	os.chdir(os.path.dirname(os.path.realpath(__file__)))
-	issue['vc4-buildbot'] = getGitInfo()
+	issue['vc4-buildbot'] = getGitInfo(os.path.dirname(os.path.realpath(__file__)))
 	s = json.dumps(issue, sort_keys=True, indent=4, separators=(',', ': '))
-	file_put_contents("/boot/issue-vc4.json", s)
-
-
-checkRoot()
-updateHostApt()
-updateFirmware()
-updateConfigTxt()
-updateLdConfig()
-enableCoredumps()
-#updateRcLocalForLeds()
-enableDebugEnvVars()
-# build Processing first since chances are that I screwed up somewhere
-buildExtraProcessing()
-# mesa and friends
-buildXorgMacros()
-buildXcbProto()
-buildLibXcb()
-buildGlProto()
-buildLibDrm()
-buildDri2Proto()
-buildDri3Proto()
-buildPresentProto()
-buildLibXShmFence()
-buildMesa()
-# xserver and friends
-buildXTrans()
-buildXProto()
-buildXExtProto()
-buildInputProto()
-buildRandrProto()
-buildFontsProto()
-buildLibEpoxy()
-buildXServer()
-# glxgears and friends
-buildMesaDemos()
-# xserver modules
-buildLibEvdev()
-buildInputEvdev()
-# build kernel last to minimize window where we would boot an
-# untested kernel on power outage etc
-buildLinux()
-
-buildIssueJson()
+	file_put_contents(ROOT + "/boot/issue-vc4.json", s)
+
+def getMedian(values):
+	values = sorted(values)
+	return (values[(len(values) - 1) // 2] + values[len(values) // 2]) / 2.0
+
+def getEstimate(times, key):
+	if not times.get(key):
+		return None
+	return getMedian(times[key])
+
+def getDrift(times, key):
+	# how much the last run differed from the ones before
+	if len(times.get(key, [])) < 3:
+		return None
+	before = getMedian(times[key][:-1])
+	if not before:
+		return None
+	return times[key][-1] / before - 1
+
+def formatDuration(s):
+	if s is None:
+		return "?"
+	s = int(round(s))
+	if 3600 <= s:
+		return "%dh%02dm" % (s // 3600, s % 3600 // 60)
+	if 60 <= s:
+		return "%dm%02ds" % (s // 60, s % 60)
+	return "%ds" % s
+
+def addPlanStep(plan, times, name, what, key, after):
+	# starts when the step it waits for (the latest of its inputs) ends
+	start = after['end'] if after else 0.0
+	estimate = getEstimate(times, key)
+	step = { 'name': name, 'what': what, 'estimate': estimate, 'drift': getDrift(times, key), 'start': start, 'end': start + (estimate or 0), 'after': after }
+	plan.append(step)
+	return step
+
+def getPlanCommits(c):
+	# what updateSource() would check out, as far as the mirrors know
+	# (they don't get fetched), None if that can't be told
+	commits = []
+	for (src, repo, branch) in c['git']:
+		if src == c['src'] and c['name'] in pins:
+			commits.append(pins[c['name']])
+			continue
+		ref = "refs/heads/" + branch if branch else "HEAD"
+		try:
+			out = subprocess.check_output("git rev-parse --verify -q " + ref + " 2>/dev/null", shell=True, cwd=getMirrorDir(repo))
+		except (subprocess.CalledProcessError, OSError):
+			return None
+		commits.append(out.decode().strip())
+	return commits
+
+def planBuild(components):
+	# the steps a build would run, and when, given as many job slots as
+	# components ready to build, with the times of earlier runs
+	times = loadTimes()
+	loadFingerprints()
+	plan = []
+	# the main thread's steps come one after the other...
+	setup = None
+	names = ["packages", "config.txt", "ldconfig", "coredumps", "debug-env"]
+	if CROSS:
+		names.insert(0, "host packages")
+	else:
+		names.insert(1, "firmware")
+	for name in names:
+		setup = addPlanStep(plan, times, name, "run", name, setup)
+	# ...while the mirrors get fetched, PREFETCH_JOBS at a time
+	repos = getRepos(components)
+	unpinned = getRepos([{ 'git': c['git'][1:] if c['name'] in pins else c['git'] } for c in components])
+	workers = [None] * min(PREFETCH_JOBS, len(repos))
+	fetched = {}
+	for repo in repos:
+		if repo not in unpinned and os.path.exists(getMirrorDir(repo)):
+			fetched[repo] = None
+			continue
+		worker = min(workers, key=lambda step: step['end'] if step else 0)
+		fetched[repo] = addPlanStep(plan, times, "fetch " + re.sub(r'\.git$', '', repo.rstrip('/').split('/')[-1]), "fetch", "fetch " + repo, worker)
+		workers[workers.index(worker)] = fetched[repo]
+	done = {}
+	pending = list(components)
+	while pending:
+		ready = [c for c in pending if all(dep in done for dep in c['deps'])]
+		if not ready:
+			raise Exception("Could not plan " + ", ".join([c['name'] for c in pending]))
+		c = ready[0]
+		pending.remove(c)
+		inputs = [setup] + [done[dep] for dep in c['deps']] + [fetched[repo] for (src, repo, branch) in c['git']]
+		after = max([step for step in inputs if step], key=lambda step: step['end'])
+		commits = getPlanCommits(c)
+		# dependents of a component that can't be told build as well
+		fingerprints[c['name']] = getFingerprint(c, commits) if commits else None
+		if commits and isUnchanged(c):
+			done[c['name']] = addPlanStep(plan, times, c['name'], "skip", "skip " + c['name'], after)
+		else:
+			done[c['name']] = addPlanStep(plan, times, c['name'], "build", c['name'], after)
+	return plan
+
+def printPlan(plan, total=None):
+	# total: key of the times of whole runs, to compare with
+	log("Sources as of their last fetch, times from " + TIMES_FILE)
+	log("%-28s %-6s %8s %8s %8s" % ("step", "", "takes", "starts", "ends"))
+	for step in sorted(plan, key=lambda step: (step['start'], step['end'])):
+		line = "%-28s %-6s %8s %8s %8s" % (step['name'][:28], step['what'], formatDuration(step['estimate']), formatDuration(step['start']), formatDuration(step['end']))
+		if step['drift'] is not None and PLAN_DRIFT < abs(step['drift']):
+			line = line + "  last run %+d%%" % (step['drift'] * 100)
+		log(line)
+	last = max(plan, key=lambda step: step['end'])
+	path = []
+	step = last
+	while step:
+		path.insert(0, step['name'])
+		step = step['after']
+	log("Critical path: " + " -> ".join(path))
+	unknown = [step['name'] for step in plan if step['estimate'] is None]
+	s = "Predicted total: " + formatDuration(last['end'])
+	if unknown:
+		s = s + ", plus " + str(len(unknown)) + " steps that never ran before"
+		if len(unknown) <= 10:
+			s = s + ": " + ", ".join(unknown)
+	log(s)
+	if total and loadTimes().get(total):
+		log("Recent runs took " + formatDuration(getEstimate(loadTimes(), total)) + ", the last one " + formatDuration(loadTimes()[total][-1]))
+
+
+if __name__ == "__main__":
+	if PLAN:
+		# only reads what earlier runs left behind
+		loadPins()
+		printPlan(planBuild(COMPONENTS), "build")
+		sys.exit(0)
+	checkRoot()
+	start = time.time()
+	try:
+		openStepLog(STEP_LOG)
+		loadPins()
+		if CROSS:
+			setupCross()
+		# network round-trips overlap with everything up to the builds
+		events = prefetchSources(COMPONENTS)
+		journal = loadJournal(JOURNAL_FILE)
+		packages = getPackages(COMPONENTS)
+		if CROSS:
+			runJournaled("host packages", sorted(getHostPackages()), installPackages, getHostPackages())
+		runJournaled("packages", sorted(set(packages)), installPackages, packages, ROOT)
+		if CROSS:
+			fixSysrootLinks()
+		# pinned commits (e.g. while bisecting) get built on a system an
+		# earlier build set up already, rpi-update would also change /boot
+		# under it
+		if not PIN_FILE:
+			if not CROSS:
+				# with --cross, rpi-update runs in the image when packaging
+				runJournaled("firmware", None, updateFirmware)
+			runJournaled("config.txt", None, updateConfigTxt)
+			runJournaled("ldconfig", None, updateLdConfig)
+			runJournaled("coredumps", None, enableCoredumps)
+			#updateRcLocalForLeds()
+			runJournaled("debug-env", None, enableDebugEnvVars)
+		if PERSISTENT_BUILD:
+			# make clean would throw away what we are keeping the build directories for
+			CLEANUP = 0
+		loadFingerprints()
+		loadHistory()
+		buildComponents(COMPONENTS, MAKE_JOBS, events)
+		buildIssueJson()
+		if not RESUME:
+			# a resumed run only did part of the work
+			addTime("build", time.time() - start)
+	finally:
+		writeTrace(TRACE_FILE)
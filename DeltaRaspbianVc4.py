@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# Script to update an installation with the changes between two overlays
+# Copyright (C) 2015 Gottfried Haider
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+
+import os
+import sys
+import json
+import hashlib
+import subprocess
+
+# name of the description inside a delta made by PackageRaspbianVc4.py
+DELTA_META = ".vc4-delta.json"
+# files users are expected to edit, these don't need to match the base,
+# and get left as they are when they don't
+CONFIG_FILES = ["boot/config.txt"]
+
+def getEntry(path):
+	# what the manifest says about a path: the SHA-256 of a file, "->"
+	# and the target of a symlink, or "/" for a directory
+	if os.path.islink(path):
+		return "->" + os.readlink(path)
+	if os.path.isdir(path):
+		return "/"
+	if not os.path.isfile(path):
+		return None
+	sha256 = hashlib.sha256()
+	with open(path, 'rb') as f:
+		while True:
+			chunk = f.read(1024 * 1024)
+			if not chunk:
+				break
+			sha256.update(chunk)
+	return sha256.hexdigest()
+
+def checkBase(root, files):
+	# paths that differ from the overlay the delta was made against,
+	# leaving out directories, whose permissions etc aren't recorded
+	return [name for name in sorted(files) if files[name] != "/" and getEntry(os.path.join(root, name)) != files[name]]
+
+def applyDelta(delta, root="/"):
+	meta = json.loads(subprocess.check_output(["tar", "xOf", delta, DELTA_META]).decode())
+	wrong = checkBase(root, meta['files'])
+	edited = [name for name in wrong if name in CONFIG_FILES]
+	wrong = [name for name in wrong if name not in CONFIG_FILES]
+	if wrong:
+		exit(root + " does not match " + meta['base'] + ", e.g. " + ", ".join(wrong[:10]))
+	for name in edited:
+		print("Leaving " + os.path.join(root, name) + " as it is, it was changed since " + meta['base'])
+	subprocess.check_call(["tar", "xpf", delta, "-C", root, "--anchored", "--exclude=" + DELTA_META] + ["--exclude=" + name for name in edited])
+	for name in meta['delete']:
+		path = os.path.join(root, name)
+		if os.path.isdir(path) and not os.path.islink(path):
+			try:
+				os.rmdir(path)
+			except OSError:
+				# still has files that weren't part of the overlay
+				pass
+		elif os.path.lexists(path):
+			os.remove(path)
+	if subprocess.call(["ldconfig", "-r", root]):
+		print("Run ldconfig inside " + root + " before using it")
+	print("Updated " + root + " from " + meta['base'] + " to " + meta['prefix'])
+
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2 or 3 < len(sys.argv):
+		exit("Usage: " + sys.argv[0] + " DELTA [ROOT]")
+	if os.geteuid() != 0:
+		exit("You need to have root privileges to run this script")
+	applyDelta(*sys.argv[1:])
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+
+# Helpers to modify Raspberry Pi disk images in place
+# Copyright (C) 2015 Gottfried Haider
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+
+import os
+import sys
+import struct
+import subprocess
+import json
+import hashlib
+import time
+import errno
+import zlib
+import zipfile
+import xml.etree.ElementTree as ElementTree
+try:
+	from urllib2 import urlopen, build_opener, Request, HTTPRedirectHandler, HTTPError
+except ImportError:
+	from urllib.request import urlopen, build_opener, Request, HTTPRedirectHandler
+	from urllib.error import HTTPError
+from BuildRaspbianVc4 import checkCall, call, log, file_get_contents, file_put_contents
+
+# the MBR counts in 512 byte sectors, whatever the medium
+SECTOR_SIZE = 512
+MBR_PARTITIONS = 0x1be
+MBR_SIGNATURE = 0x1fe
+# partition types
+TYPE_FAT32 = [0x0b, 0x0c]
+TYPE_LINUX = 0x83
+BASE_IMAGE_URL = "http://downloads.raspberrypi.org/raspbian_latest"
+# the last download, unzipped, resized and prepared, which every build
+# starts from as long as upstream doesn't change
+BASE_IMAGE_DIR = "/usr/local/src/raspbian"
+DOWNLOAD_CHUNK = 1024 * 1024
+# granularity of the block map
+BMAP_BLOCK_SIZE = 4096
+# deflate level of the zip archive, as with zip -9
+ZIP_LEVEL = 9
+# Python 2 lacks the constants for lseek(2)
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+def readPartitions(fn):
+	# primary partitions of a MBR partition table, in table order
+	with open(fn, 'rb') as f:
+		mbr = f.read(SECTOR_SIZE)
+	if len(mbr) < SECTOR_SIZE or mbr[MBR_SIGNATURE:MBR_SIGNATURE + 2] != b"\x55\xaa":
+		raise Exception(fn + " has no MBR partition table")
+	parts = []
+	for i in range(4):
+		entry = mbr[MBR_PARTITIONS + i * 16:MBR_PARTITIONS + (i + 1) * 16]
+		status, ptype, start, sectors = struct.unpack("<B3xB3xII", entry)
+		if ptype:
+			parts.append({ 'index': i, 'type': ptype, 'start': start, 'sectors': sectors })
+	return parts
+
+def getPartition(fn, types):
+	if not isinstance(types, list):
+		types = [types]
+	for part in readPartitions(fn):
+		if part['type'] in types:
+			return part
+	raise Exception(fn + " has no partition of type " + ", ".join(["0x%02x" % t for t in types]))
+
+def getPartitionOffset(fn, types):
+	# for mount -o offset=
+	return getPartition(fn, types)['start'] * SECTOR_SIZE
+
+def writePartitionSize(fn, index, sectors):
+	# only the size changes, the end CHS address gets set to the "use
+	# LBA" marker, as fdisk does for anything beyond 8 GB anyway
+	with open(fn, 'r+b') as f:
+		f.seek(MBR_PARTITIONS + index * 16 + 5)
+		f.write(b"\xfe\xff\xff")
+		f.seek(MBR_PARTITIONS + index * 16 + 12)
+		f.write(struct.pack("<I", sectors))
+
+def growImage(fn, bytesToAdd):
+	# makes the last partition, which has to hold an ext4 filesystem,
+	# bytesToAdd larger without copying anything: the file grows sparse,
+	# and e2fsck and resize2fs work on a loop device of just the partition
+	# (with e2fsprogs' file?offset= syntax, resize2fs truncates the file
+	# to the size of the filesystem, cutting off its end)
+	parts = readPartitions(fn)
+	last = max(parts, key=lambda p: p['start'])
+	if last['type'] != TYPE_LINUX:
+		raise Exception("Last partition of " + fn + " is not a Linux one")
+	size = os.path.getsize(fn) + bytesToAdd
+	size = size - size % SECTOR_SIZE
+	with open(fn, 'r+b') as f:
+		f.truncate(size)
+	sectors = size // SECTOR_SIZE - last['start']
+	writePartitionSize(fn, last['index'], sectors)
+	dev = subprocess.check_output(["losetup", "--find", "--show", "--offset", str(last['start'] * SECTOR_SIZE), "--sizelimit", str(sectors * SECTOR_SIZE), fn]).decode().strip()
+	try:
+		# 1 means errors got fixed
+		ret = call("e2fsck -f -p " + dev)
+		if ret & ~1:
+			raise subprocess.CalledProcessError(ret, "e2fsck -f -p " + dev)
+		checkCall("resize2fs " + dev)
+	finally:
+		checkCall("losetup -d " + dev)
+
+def mountImage(img, live):
+	checkCall("mkdir -p " + live)
+	checkCall("mount -o offset=" + str(getPartitionOffset(img, TYPE_LINUX)) + " -t ext4 " + img + " " + live)
+	checkCall("mount -o offset=" + str(getPartitionOffset(img, TYPE_FAT32)) + " -t vfat " + img + " " + live + "/boot")
+
+def trimImage(live):
+	# the loop device turns the discards into holes in the image file,
+	# so what isn't in use by the filesystems won't ever get read again
+	call("fstrim " + live)
+	# vfat supports this only since Linux 5.x
+	call("fstrim " + live + "/boot")
+
+def umountImage(live):
+	checkCall("umount " + live + "/boot")
+	checkCall("umount " + live)
+
+def cloneImage(src, dst):
+	# instant on btrfs or XFS, otherwise at least as sparse as the original
+	checkCall("cp --reflink=auto --sparse=always " + src + " " + dst)
+
+class HeadRedirectHandler(HTTPRedirectHandler):
+	# Python 2 turns a redirected HEAD into a GET of the whole file
+	def redirect_request(self, req, fp, code, msg, headers, newurl):
+		new = HTTPRedirectHandler.redirect_request(self, req, fp, code, msg, headers, newurl)
+		if new:
+			new.get_method = req.get_method
+		return new
+
+def getUrlInfo(url):
+	# follows redirects, e.g. from raspbian_latest to the current release
+	req = Request(url)
+	req.get_method = lambda: "HEAD"
+	r = build_opener(HeadRedirectHandler).open(req)
+	info = { 'url': r.geturl(), 'etag': r.info().get('ETag'), 'modified': r.info().get('Last-Modified'), 'length': r.info().get('Content-Length') }
+	r.close()
+	return info
+
+def download(url, fn, etag=None):
+	# continues where a previous attempt stopped, unless the server
+	# does not do ranges or the file changed in the meantime
+	have = 0
+	if os.path.exists(fn):
+		have = os.path.getsize(fn)
+	req = Request(url)
+	if have:
+		req.add_header("Range", "bytes=" + str(have) + "-")
+		if etag:
+			req.add_header("If-Range", etag)
+	try:
+		r = urlopen(req)
+	except HTTPError as e:
+		if have and e.code == 416:
+			# already complete
+			return
+		raise
+	if r.getcode() != 206:
+		have = 0
+	if have:
+		log("Resuming download of %s at %.1f MB" % (url, have / 1048576.0))
+	start = time.time()
+	size = 0
+	with open(fn, 'ab' if have else 'wb') as f:
+		while True:
+			chunk = r.read(DOWNLOAD_CHUNK)
+			if not chunk:
+				break
+			f.write(chunk)
+			size = size + len(chunk)
+	r.close()
+	log("Downloaded %.1f MB in %.1fs" % (size / 1048576.0, time.time() - start))
+
+def getSha256(fn):
+	sha256 = hashlib.sha256()
+	with open(fn, 'rb') as f:
+		while True:
+			chunk = f.read(DOWNLOAD_CHUNK)
+			if not chunk:
+				break
+			sha256.update(chunk)
+	return sha256.hexdigest()
+
+def getPublishedSha256(url):
+	# downloads.raspberrypi.org has one next to every image
+	try:
+		r = urlopen(url + ".sha256")
+		s = r.read().decode()
+		r.close()
+		return s.split()[0].lower()
+	except (HTTPError, IndexError):
+		return None
+
+def getBaseImage(prepare, bytesToAdd, options=None, url=BASE_IMAGE_URL):
+	# returns the cached image, after downloading and preparing a new
+	# one if upstream (or the options prepare depends on) changed,
+	# prepare gets called with the image file
+	checkCall("mkdir -p " + BASE_IMAGE_DIR)
+	index = {}
+	if os.path.exists(BASE_IMAGE_DIR + "/base.json"):
+		index = json.loads(file_get_contents(BASE_IMAGE_DIR + "/base.json"))
+	cached = index.get('image') and os.path.exists(index['image']) and index['options'] == [bytesToAdd, options]
+	try:
+		info = getUrlInfo(url)
+	except IOError as e:
+		# e.g. offline, what we have is better than nothing
+		if not cached:
+			raise
+		log("Could not reach " + url + " (" + str(e) + "), using cached " + index['image'])
+		return index['image']
+	key = [info['url'], info['etag'], info['modified']]
+	if cached and index['key'] == key:
+		log("Using cached " + index['image'])
+		return index['image']
+	zip = BASE_IMAGE_DIR + "/" + os.path.basename(info['url'])
+	# partial downloads of older releases won't ever get finished
+	call("find " + BASE_IMAGE_DIR + " -maxdepth 1 -name '*.part' ! -name '" + os.path.basename(zip) + ".part' -delete")
+	try:
+		download(info['url'], zip + ".part", info['etag'])
+	except IOError as e:
+		if not cached:
+			raise
+		# the next run continues the download
+		log("Download of " + info['url'] + " failed (" + str(e) + "), using cached " + index['image'])
+		return index['image']
+	if info['length'] and os.path.getsize(zip + ".part") != int(info['length']):
+		raise Exception("Download of " + info['url'] + " is incomplete")
+	sha256 = getSha256(zip + ".part")
+	expected = getPublishedSha256(info['url'])
+	if expected and expected != sha256:
+		os.remove(zip + ".part")
+		raise Exception("Download of " + info['url'] + " has the wrong checksum")
+	if cached and index['sha256'] == sha256:
+		# same file under a new ETag etc
+		os.remove(zip + ".part")
+		index['key'] = key
+		file_put_contents(BASE_IMAGE_DIR + "/base.json", json.dumps(index))
+		log("Using cached " + index['image'])
+		return index['image']
+	checkCall("rm -rf " + BASE_IMAGE_DIR + "/new")
+	checkCall("unzip -q " + zip + ".part -d " + BASE_IMAGE_DIR + "/new")
+	os.remove(zip + ".part")
+	imgs = [fn for fn in os.listdir(BASE_IMAGE_DIR + "/new") if fn.endswith(".img")]
+	if not imgs:
+		raise Exception(info['url'] + " contains no image")
+	img = BASE_IMAGE_DIR + "/new/" + imgs[0]
+	growImage(img, bytesToAdd)
+	prepare(img)
+	# only a completely prepared image goes into the cache
+	if index.get('image') and os.path.exists(index['image']):
+		os.remove(index['image'])
+	os.rename(img, BASE_IMAGE_DIR + "/" + imgs[0])
+	checkCall("rm -rf " + BASE_IMAGE_DIR + "/new")
+	index = { 'key': key, 'sha256': sha256, 'options': [bytesToAdd, options], 'image': BASE_IMAGE_DIR + "/" + imgs[0] }
+	file_put_contents(BASE_IMAGE_DIR + "/base.json", json.dumps(index))
+	return index['image']
+
+def getMappedRanges(fn):
+	# (start, end) of the parts of a sparse file that hold data
+	size = os.path.getsize(fn)
+	fd = os.open(fn, os.O_RDONLY)
+	ranges = []
+	try:
+		pos = 0
+		while pos < size:
+			try:
+				start = os.lseek(fd, pos, SEEK_DATA)
+			except OSError as e:
+				if e.errno == errno.ENXIO:
+					# only a hole left
+					break
+				if e.errno == errno.EINVAL and not ranges:
+					# no support by the filesystem, so it's all data
+					return [(0, size)]
+				raise
+			end = os.lseek(fd, start, SEEK_HOLE)
+			ranges.append((start, end))
+			pos = end
+	finally:
+		os.close(fd)
+	return ranges
+
+def writeBmap(img, fn):
+	# in the format of bmaptool, which can use it to flash the image
+	size = os.path.getsize(img)
+	blocks = []
+	for (start, end) in getMappedRanges(img):
+		first = start // BMAP_BLOCK_SIZE
+		last = (end - 1) // BMAP_BLOCK_SIZE
+		if blocks and blocks[-1][1] + 1 >= first:
+			blocks[-1] = (blocks[-1][0], last)
+		else:
+			blocks.append((first, last))
+	mapped = 0
+	lines = []
+	with open(img, 'rb') as f:
+		for (first, last) in blocks:
+			f.seek(first * BMAP_BLOCK_SIZE)
+			sha256 = hashlib.sha256()
+			remaining = min((last + 1) * BMAP_BLOCK_SIZE, size) - first * BMAP_BLOCK_SIZE
+			while remaining:
+				data = f.read(min(DOWNLOAD_CHUNK, remaining))
+				sha256.update(data)
+				remaining = remaining - len(data)
+			mapped = mapped + last - first + 1
+			lines.append('        <Range chksum="%s"> %d-%d </Range>\n' % (sha256.hexdigest(), first, last))
+	s = '<?xml version="1.0" ?>\n'
+	s = s + '<bmap version="2.0">\n'
+	s = s + '    <ImageSize> %d </ImageSize>\n' % size
+	s = s + '    <BlockSize> %d </BlockSize>\n' % BMAP_BLOCK_SIZE
+	s = s + '    <BlocksCount> %d </BlocksCount>\n' % ((size + BMAP_BLOCK_SIZE - 1) // BMAP_BLOCK_SIZE)
+	s = s + '    <MappedBlocksCount> %d </MappedBlocksCount>\n' % mapped
+	s = s + '    <ChecksumType> sha256 </ChecksumType>\n'
+	# gets calculated with the checksum itself zeroed
+	s = s + '    <BmapFileChecksum> %s </BmapFileChecksum>\n' % ("0" * 64)
+	s = s + '    <BlockMap>\n' + "".join(lines) + '    </BlockMap>\n'
+	s = s + '</bmap>\n'
+	s = s.replace("0" * 64, hashlib.sha256(s.encode()).hexdigest())
+	file_put_contents(fn, s)
+	log("Mapped %d of %d MB of %s" % (mapped * BMAP_BLOCK_SIZE / 1048576, size / 1048576, os.path.basename(img)))
+
+def getDosTime(t):
+	t = time.localtime(t)
+	return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def getCrcShift(length):
+	# zlib.crc32(b"\0" * length, crc) is affine in crc: the columns of
+	# its 32x32 bit matrix, and the constant
+	zero = b"\0" * length
+	constant = zlib.crc32(zero) & 0xffffffff
+	return [(zlib.crc32(zero, 1 << i) & 0xffffffff) ^ constant for i in range(32)], constant
+
+def shiftCrc(crc, shift):
+	# extends a checksum by the zeros of getCrcShift() without going
+	# through them
+	columns, out = shift
+	crc = crc & 0xffffffff
+	for column in columns:
+		if crc & 1:
+			out = out ^ column
+		crc = crc >> 1
+	return out
+
+def writeZip(imgs, fn):
+	# like zip -9, but only reads and compresses the parts of the images
+	# that hold data, a megabyte of a hole is the same deflate data each
+	# time, as long as the compressor gets flushed before it
+	start = time.time()
+	zero = b"\0" * DOWNLOAD_CHUNK
+	c = zlib.compressobj(ZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+	zeroDeflated = c.compress(zero) + c.flush(zlib.Z_FULL_FLUSH)
+	zeroShift = getCrcShift(DOWNLOAD_CHUNK)
+	entries = []
+	total = 0
+	mapped = 0
+	with open(fn, 'wb') as out:
+		for img in imgs:
+			name = os.path.basename(img).encode()
+			st = os.stat(img)
+			dosTime, dosDate = getDosTime(st.st_mtime)
+			offset = out.tell()
+			# with ZIP64 fields, which images larger than 4 GB need,
+			# checksum and sizes get filled in afterwards
+			out.write(struct.pack("<IHHHHHIIIHH", 0x04034b50, 45, 0, zipfile.ZIP_DEFLATED, dosTime, dosDate, 0, 0xffffffff, 0xffffffff, len(name), 20) + name)
+			out.write(struct.pack("<HHQQ", 1, 16, 0, 0))
+			c = zlib.compressobj(ZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+			crc = 0
+			csize = 0
+			pos = 0
+			with open(img, 'rb') as f:
+				for (first, end) in getMappedRanges(img) + [(st.st_size, st.st_size)]:
+					# the hole before
+					n = (first - pos) // DOWNLOAD_CHUNK
+					if n:
+						data = c.flush(zlib.Z_FULL_FLUSH)
+						out.write(data)
+						csize = csize + len(data)
+						for i in range(n):
+							out.write(zeroDeflated)
+							crc = shiftCrc(crc, zeroShift)
+						csize = csize + n * len(zeroDeflated)
+						pos = pos + n * DOWNLOAD_CHUNK
+					data = c.compress(zero[:first - pos])
+					crc = zlib.crc32(zero[:first - pos], crc)
+					f.seek(first)
+					pos = first
+					while pos < end:
+						chunk = f.read(min(DOWNLOAD_CHUNK, end - pos))
+						if not chunk:
+							raise Exception(img + " changed while compressing it")
+						crc = zlib.crc32(chunk, crc)
+						data = data + c.compress(chunk)
+						out.write(data)
+						csize = csize + len(data)
+						data = b""
+						pos = pos + len(chunk)
+					out.write(data)
+					csize = csize + len(data)
+					mapped = mapped + end - first
+			data = c.flush()
+			out.write(data)
+			csize = csize + len(data)
+			crc = crc & 0xffffffff
+			total = total + st.st_size
+			out.seek(offset + 14)
+			out.write(struct.pack("<I", crc))
+			out.seek(offset + 30 + len(name) + 4)
+			out.write(struct.pack("<QQ", st.st_size, csize))
+			out.seek(0, os.SEEK_END)
+			entries.append((name, st, dosTime, dosDate, crc, csize, offset))
+		cdOffset = out.tell()
+		for (name, st, dosTime, dosDate, crc, csize, offset) in entries:
+			out.write(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, (3 << 8) | 45, 45, 0, zipfile.ZIP_DEFLATED, dosTime, dosDate, crc, 0xffffffff, 0xffffffff, len(name), 28, 0, 0, 0, (st.st_mode & 0xffff) << 16, 0xffffffff) + name)
+			out.write(struct.pack("<HHQQQ", 1, 24, st.st_size, csize, offset))
+		cdSize = out.tell() - cdOffset
+		eocd64 = out.tell()
+		out.write(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0, len(entries), len(entries), cdSize, cdOffset))
+		out.write(struct.pack("<IIQI", 0x07064b50, 0, eocd64, 1))
+		out.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, len(entries), len(entries), 0xffffffff, 0xffffffff, 0))
+	log("Compressed %d MB of data of %d MB of images in %.1fs" % (mapped / 1048576, total / 1048576, time.time() - start))
+
+def readBmap(fn):
+	bmap = ElementTree.parse(fn).getroot()
+	blockSize = int(bmap.find('BlockSize').text)
+	size = int(bmap.find('ImageSize').text)
+	ranges = []
+	for r in bmap.find('BlockMap').findall('Range'):
+		first, _, last = r.text.strip().partition("-")
+		ranges.append((int(first), int(last or first), r.get('chksum')))
+	return blockSize, size, ranges
+
+def writeImage(src, bmap, dev):
+	# copies only the blocks in the map, e.g. onto a SD card, straight
+	# from the zip file if need be
+	blockSize, size, ranges = readBmap(bmap)
+	if src.endswith(".zip"):
+		zip = zipfile.ZipFile(src)
+		f = zip.open([name for name in zip.namelist() if name.endswith(".img")][0])
+	else:
+		zip = None
+		f = open(src, 'rb')
+	start = time.time()
+	pos = 0
+	written = 0
+	out = os.open(dev, os.O_WRONLY | os.O_CREAT, 0o644)
+	try:
+		for (first, last, chksum) in ranges:
+			offset = first * blockSize
+			end = min((last + 1) * blockSize, size)
+			# zip members can only be read front to back
+			if zip:
+				while pos < offset:
+					data = f.read(min(DOWNLOAD_CHUNK, offset - pos))
+					if not data:
+						raise Exception(src + " is shorter than its block map")
+					pos = pos + len(data)
+			else:
+				f.seek(offset)
+			os.lseek(out, offset, os.SEEK_SET)
+			sha256 = hashlib.sha256()
+			pos = offset
+			while pos < end:
+				data = f.read(min(DOWNLOAD_CHUNK, end - pos))
+				if not data:
+					raise Exception(src + " is shorter than its block map")
+				sha256.update(data)
+				os.write(out, data)
+				pos = pos + len(data)
+			if sha256.hexdigest() != chksum:
+				raise Exception("Blocks " + str(first) + "-" + str(last) + " of " + src + " have the wrong checksum")
+			written = written + end - offset
+		if os.path.isfile(dev):
+			os.ftruncate(out, size)
+		os.fsync(out)
+	finally:
+		os.close(out)
+		f.close()
+		if zip:
+			zip.close()
+	log("Wrote %d MB in %.1fs" % (written / 1048576, time.time() - start))
+
+
+if __name__ == "__main__":
+	if len(sys.argv) != 4:
+		exit("Usage: " + sys.argv[0] + " IMAGE.zip|IMAGE.img IMAGE.bmap DEVICE")
+	writeImage(sys.argv[1], sys.argv[2], sys.argv[3])
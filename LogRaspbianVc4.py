@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Script to read the output of single build steps
+# Copyright (C) 2015 Gottfried Haider
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+
+import sys
+import json
+import bz2
+from BuildRaspbianVc4 import file_get_contents, getStepLogIndex
+
+def readIndex(fn):
+	return json.loads(file_get_contents(getStepLogIndex(fn)))
+
+def writeStep(fn, entry, out):
+	# only this step's stream gets decompressed
+	decomp = bz2.BZ2Decompressor()
+	with open(fn, 'rb') as f:
+		f.seek(entry['offset'])
+		left = entry['length']
+		while left:
+			data = f.read(min(left, 1024 * 1024))
+			if not data:
+				raise Exception("Log is shorter than its index")
+			left = left - len(data)
+			out.write(decomp.decompress(data))
+
+def findSteps(steps, what):
+	# a step number, or all steps of a component
+	if what.isdigit():
+		return [s for s in steps if s['step'] == int(what)]
+	return [s for s in steps if s['component'] == what]
+
+def listSteps(steps):
+	for s in steps:
+		print("%4d %4s %8.1fs %-18s %s" % (s['step'], s['status'] or "", s['wall'], s['component'] or "", s['cmd'][:80]))
+
+def showFailed(steps):
+	for s in steps:
+		if not s['status']:
+			continue
+		print("Step %d (%s) failed with %d after %.1fs: %s" % (s['step'], s['component'] or "", s['status'], s['wall'], s['cmd']))
+		if s['errors']:
+			print("Errors:")
+			for line in s['errors']:
+				print("  " + line)
+		print("Last lines:")
+		for line in s['tail']:
+			print("  " + line)
+		print("")
+
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		exit("Usage: " + sys.argv[0] + " LOG [--failed | STEP | COMPONENT]\n(with just LOG, lists all steps)")
+	steps = readIndex(sys.argv[1])
+	if len(sys.argv) == 2:
+		listSteps(steps)
+	elif sys.argv[2] == "--failed":
+		showFailed(steps)
+	else:
+		found = findSteps(steps, sys.argv[2])
+		if not found:
+			exit("No step " + sys.argv[2])
+		out = getattr(sys.stdout, 'buffer', sys.stdout)
+		for s in found:
+			writeStep(sys.argv[1], s, out)
+		out.flush()
@@ -10,9 +10,32 @@
 
 
 import os
-import subprocess
 import re
+import sys
 import time
+import json
+import bz2
+import collections
+import multiprocessing
+import resource
+import subprocess
+import shutil
+import tarfile
+import glob
+import fnmatch
+import hashlib
+import io
+import traceback
+# shares the instrumented command wrappers with the build
+from BuildRaspbianVc4 import checkCall, call, log, installPackages, steps, getTraceEvents, TRACE_FILE
+from BuildRaspbianVc4 import STEP_LOG, getStepLogIndex, COMPONENTS, loadFileList
+from BuildRaspbianVc4 import loadJournal, saveJournal, getCheckpoint, setCheckpoint, RESUME
+from BuildRaspbianVc4 import CROSS, ROOT, PERSISTENT_BUILD, getSysrootBase, makeSysroot
+from BuildRaspbianVc4 import PLAN, planBuild, printPlan, addPlanStep, loadTimes, timed, addTime
+from DeltaRaspbianVc4 import DELTA_META
+from UploadRaspbianVc4 import upload, collectGarbage, LocalBackend, SshBackend
+from ResultsRaspbianVc4 import openDb, ingestIssue
+from ImageRaspbianVc4 import getBaseImage, cloneImage, mountImage, trimImage, umountImage, writeBmap, writeZip
 
 # assume BuildRaspbianVc4.py is in the same dir as this one 
 CUSTOM_KERNEL = 1
@@ -23,11 +46,38 @@ UPLOAD_HOST = "sukzessiv.net"
 UPLOAD_USER = "vc4-buildbot"
 UPLOAD_KEY = os.path.dirname(os.path.realpath(__file__)) + "/sukzessiv-net.pem"
 UPLOAD_PATH = "~/upload/"
+# "ssh" for UPLOAD_HOST, or "local" for UPLOAD_PATH on this machine
+UPLOAD_BACKEND = "ssh"
+UPLOAD_JOBS = 4
+# expire old builds on the server after uploading (see UploadRaspbianVc4.py)
+UPLOAD_GC = 1
 RASPBIAN_IMG_ENLARGE_BY_MB = 500
-# this can be determined from fdisk *.img
-RASPBIAN_IMG_BYTES_PER_SECTOR = 512
-RASPBIAN_IMG_START_SECTOR_VFAT = 8192
-RASPBIAN_IMG_START_SECTOR_EXT4 = 131072
+# format of the tarballs and logs: "bzip2" (compressed in blocks on all
+# cores, but still a regular .bz2 file), "xz" or "zstd" (both using
+# their own threads), and their level (zstd goes up to 19)
+COMPRESSION = "bzip2"
+COMPRESSION_LEVEL = 9
+# 0 for one per CPU
+COMPRESSION_JOBS = 0
+# input compressed as one bzip2 stream each
+COMPRESSION_BLOCK = 4 * 1024 * 1024
+# write the overlay into the image while packaging it, rather than
+# extracting the tarball into it afterwards
+STREAM_IMAGE = 1
+# overlay contents of the last builds, and whether to package the
+# changes since the previous one (or the one with PREFIX DELTA_BASE)
+MANIFEST_DIR = "/usr/local/src/manifest-vc4"
+MANIFEST_KEEP = 30
+DELTA = 1
+# also an overlay of each component on its own, e.g. to try just a newer
+# mesa
+COMPONENT_OVERLAYS = 0
+DELTA_BASE = None
+# steps completed by the last run, see --resume
+JOURNAL_FILE = "/tmp/PackageRaspbianVc4-journal.json"
+# the files of this and earlier runs that get uploaded (and deleted),
+# e.g. /tmp/20160501-2100-vc4-image.zip but not /tmp/bisect-vc4.log
+TEMP_FILES = "/tmp/" + "[0-9]" * 8 + "-" + "[0-9]" * 4 + "-vc4*"
 
 # helper functions
 def file_get_contents(fn):
@@ -43,157 +93,517 @@ def checkRoot():
 		exit("You need to have root privileges to run this script")
 
 def killHangingBuilds():
-	subprocess.call("pkill -f \"BuildRaspbianVc4\"", shell=True)
+	call("pkill -f \"BuildRaspbianVc4\"")
 
 def UploadTempFiles():
 	# XXX: disable host check? or http://serverfault.com/questions/132970/can-i-automatically-add-a-new-host-to-known-hosts
 	# XXX: add *.pem to .gitignore
-	ret = subprocess.call("scp -Bpq -i " + UPLOAD_KEY + " /tmp/*-vc4* " + UPLOAD_USER + "@" + UPLOAD_HOST + ":" + UPLOAD_PATH, shell=True)
+	if UPLOAD_BACKEND == "local":
+		backend = LocalBackend(UPLOAD_PATH)
+	else:
+		backend = SshBackend(UPLOAD_HOST, UPLOAD_USER, UPLOAD_KEY, UPLOAD_PATH)
+	ret = upload(sorted(glob.glob(TEMP_FILES)), backend, UPLOAD_JOBS)
+	if not ret and UPLOAD_GC:
+		try:
+			collectGarbage(backend)
+		except Exception:
+			# not worth failing the upload for, try again next time
+			traceback.print_exc()
 	return ret
 
 def DeleteTempFiles():
-	subprocess.call("rm -f /tmp/*-vc4*", shell=True)
+	call("rm -f " + TEMP_FILES)
+
+def GetCompressedName(fn):
+	suffixes = { 'bzip2': ".bz2", 'xz': ".xz", 'zstd': ".zst" }
+	if COMPRESSION not in suffixes:
+		raise Exception("Unknown compression " + COMPRESSION)
+	return fn + suffixes[COMPRESSION]
+
+class Bzip2Writer(object):
+	# like pbzip2: compresses blocks on all cores, which bzip2 reads back
+	# as one file as the streams are simply concatenated
+	def __init__(self, out):
+		self.out = out
+		self.jobs = COMPRESSION_JOBS or multiprocessing.cpu_count()
+		self.pool = multiprocessing.Pool(self.jobs)
+		self.pending = collections.deque()
+		self.buf = []
+		self.buffered = 0
+		self.blocks = 0
+
+	def write(self, data):
+		self.buf.append(data)
+		self.buffered = self.buffered + len(data)
+		if COMPRESSION_BLOCK <= self.buffered:
+			self.submit()
+
+	def submit(self):
+		block = b"".join(self.buf)
+		self.buf = []
+		self.buffered = 0
+		self.pending.append(self.pool.apply_async(bz2.compress, (block, COMPRESSION_LEVEL)))
+		self.blocks = self.blocks + 1
+		# only keep a few blocks in memory, rather than the whole file
+		while 2 * self.jobs < len(self.pending):
+			self.out.write(self.pending.popleft().get())
+
+	def close(self):
+		if self.buffered or not self.blocks:
+			self.submit()
+		while self.pending:
+			self.out.write(self.pending.popleft().get())
+		self.pool.close()
+		self.pool.join()
+		self.out.close()
+
+class ProcessWriter(object):
+	# feeds a command's stdin
+	def __init__(self, cmd, out=None):
+		self.cmd = cmd
+		self.p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=out)
+		if out:
+			out.close()
+
+	def write(self, data):
+		self.p.stdin.write(data)
+
+	def close(self):
+		self.p.stdin.close()
+		if self.p.wait():
+			raise subprocess.CalledProcessError(self.p.returncode, self.cmd)
+
+class TeeWriter(object):
+	def __init__(self, writers):
+		self.writers = writers
+
+	def write(self, data):
+		for w in self.writers:
+			w.write(data)
+
+	def close(self):
+		for w in self.writers:
+			w.close()
+
+class HashingReader(object):
+	# checksums a file while tarfile reads it
+	def __init__(self, f):
+		self.f = f
+		self.sha256 = hashlib.sha256()
+
+	def read(self, size=-1):
+		data = self.f.read(size)
+		self.sha256.update(data)
+		return data
+
+def OpenCompressor(fn):
+	out = open(fn, 'wb')
+	if COMPRESSION == "bzip2":
+		return Bzip2Writer(out)
+	elif COMPRESSION == "xz":
+		installPackages(["xz-utils"])
+		return ProcessWriter("xz -c -T" + str(COMPRESSION_JOBS) + " -" + str(COMPRESSION_LEVEL), out)
+	else:
+		installPackages(["zstd"])
+		return ProcessWriter("zstd -q -c -T" + str(COMPRESSION_JOBS) + " -" + str(COMPRESSION_LEVEL), out)
+
+def RecordCompression(out, size, start, ru):
+	# show up in the trace like the commands do
+	ru2 = resource.getrusage(resource.RUSAGE_CHILDREN)
+	wall = time.time() - start
+	steps.append({ 'cmd': "compress " + out, 'component': None, 'thread': "MainThread", 'start': start, 'wall': wall, 'user': ru2.ru_utime - ru.ru_utime, 'sys': ru2.ru_stime - ru.ru_stime, 'maxrss': ru2.ru_maxrss, 'status': 0 })
+	ratio = 100.0 * os.path.getsize(out) / max(size, 1)
+	log("Compressed %s: %d MB to %.1f%% in %.1fs (%.1f MB/s)" % (os.path.basename(out), size / 1048576, ratio, wall, size / 1048576.0 / max(wall, 0.001)))
+
+def Compress(fn):
+	# replaces fn with its compressed version, like bzip2 does
+	out = GetCompressedName(fn)
+	size = os.path.getsize(fn)
+	start = time.time()
+	ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+	w = OpenCompressor(out)
+	with open(fn, 'rb') as f:
+		shutil.copyfileobj(f, w, COMPRESSION_BLOCK)
+	w.close()
+	os.remove(fn)
+	RecordCompression(out, size, start, ru)
+	return out
+
+def AddToTar(tar, path, base, excludes, manifest, recursive=True):
+	for pattern in excludes:
+		if fnmatch.fnmatch(path, pattern):
+			return
+	info = tar.gettarinfo(path, os.path.relpath(path, base))
+	if info is None:
+		# sockets
+		return
+	if info.isreg():
+		with open(path, 'rb') as f:
+			reader = HashingReader(f)
+			tar.addfile(info, reader)
+		manifest[info.name] = reader.sha256.hexdigest()
+	else:
+		tar.addfile(info)
+		# see DeltaRaspbianVc4.getEntry()
+		if info.islnk():
+			manifest[info.name] = manifest[info.linkname]
+		elif info.issym():
+			manifest[info.name] = "->" + info.linkname
+		elif info.isdir():
+			manifest[info.name] = "/"
+	if info.isdir() and recursive:
+		for name in sorted(os.listdir(path)):
+			AddToTar(tar, os.path.join(path, name), base, excludes, manifest)
+
+def TarFiles(fn, paths, excludes=[], base="/", live=None, recursive=True):
+	# packs, compresses and checksums the files in a single pass, rather
+	# than writing and reading back a tar file in between, optionally
+	# also extracting them into the image mounted at live
+	out = GetCompressedName(fn)
+	start = time.time()
+	ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+	w = OpenCompressor(out)
+	if live:
+		w = TeeWriter([w, ProcessWriter("tar xpf - -C " + live)])
+	tar = tarfile.open(fileobj=w, mode="w|", format=tarfile.GNU_FORMAT)
+	manifest = {}
+	for path in paths:
+		if not recursive:
+			# exactly these, directories without their contents
+			if os.path.lexists(path):
+				AddToTar(tar, path, base, excludes, manifest, False)
+			continue
+		for match in sorted(glob.glob(path)):
+			AddToTar(tar, match, base, excludes, manifest)
+	size = tar.offset
+	tar.close()
+	w.close()
+	# in the format of sha256sum -c
+	file_put_contents(out + ".sha256", "".join([manifest[name] + "  " + name + "\n" for name in sorted(manifest) if len(manifest[name]) == 64]))
+	RecordCompression(out, size, start, ru)
+	return out, manifest
+
+def SaveManifest(manifest):
+	# for deltas of later builds against this one
+	checkCall("mkdir -p " + MANIFEST_DIR)
+	file_put_contents(MANIFEST_DIR + "/" + PREFIX + ".json", json.dumps(manifest, sort_keys=True))
+	manifests = sorted([fn for fn in os.listdir(MANIFEST_DIR) if fn.endswith(".json")])
+	for fn in manifests[:-MANIFEST_KEEP]:
+		os.remove(MANIFEST_DIR + "/" + fn)
+
+def TarDelta(manifest):
+	# the files that were added or changed since an earlier build, plus
+	# what DeltaRaspbianVc4.py needs to check and apply them
+	earlier = sorted([fn[:-5] for fn in os.listdir(MANIFEST_DIR) if fn.endswith(".json") and fn[:-5] < PREFIX])
+	base = DELTA_BASE
+	if not base and earlier:
+		base = earlier[-1]
+	if not base:
+		return None
+	if base not in earlier:
+		log("No manifest of " + base + " to make a delta against")
+		return None
+	old = json.loads(file_get_contents(MANIFEST_DIR + "/" + base + ".json"))
+	changed = [name for name in sorted(manifest) if old.get(name) != manifest[name]]
+	deleted = sorted([name for name in old if name not in manifest], reverse=True)
+	out = GetCompressedName("/tmp/" + PREFIX + "-delta-" + base + ".tar")
+	start = time.time()
+	ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+	w = OpenCompressor(out)
+	tar = tarfile.open(fileobj=w, mode="w|", format=tarfile.GNU_FORMAT)
+	# comes first, so that the base can be checked before extracting
+	meta = json.dumps({ 'base': base, 'prefix': PREFIX, 'files': old, 'delete': deleted }).encode()
+	info = tarfile.TarInfo(DELTA_META)
+	info.size = len(meta)
+	info.mtime = time.time()
+	tar.addfile(info, io.BytesIO(meta))
+	for name in changed:
+		info = tar.gettarinfo(ROOT + "/" + name, name)
+		if info.isreg():
+			with open(ROOT + "/" + name, 'rb') as f:
+				tar.addfile(info, f)
+		else:
+			tar.addfile(info)
+	size = tar.offset
+	tar.close()
+	w.close()
+	log("Delta against " + base + ": " + str(len(changed)) + " changed, " + str(len(deleted)) + " deleted")
+	RecordCompression(out, size, start, ru)
+	return out
+
+def BackupKernel():
+	# preserve original kernel and device tree on build machine
+	if not os.path.exists("/boot/kernel.img.orig"):
+		call("cp /boot/kernel.img /boot/kernel.img.orig")
+	if not os.path.exists("/boot/bcm2708-rpi-b.dtb.orig"):
+		call("cp /boot/bcm2708-rpi-b.dtb /boot/bcm2708-rpi-b.dtb.orig")
+	if not os.path.exists("/boot/bcm2708-rpi-b-plus.dtb.orig"):
+		call("cp /boot/bcm2708-rpi-b-plus.dtb /boot/bcm2708-rpi-b-plus.dtb.orig")
+	if not os.path.exists("/boot/bcm2708-rpi-cm.dtb.orig"):
+		call("cp /boot/bcm2708-rpi-cm.dtb /boot/bcm2708-rpi-cm.dtb.orig")
+	if not os.path.exists("/boot/kernel7.img.orig"):
+		call("cp /boot/kernel7.img /boot/kernel7.img.orig")
+	if not os.path.exists("/boot/bcm2709-rpi-2-b.dtb.orig"):
+		call("cp /boot/bcm2709-rpi-2-b.dtb /boot/bcm2709-rpi-2-b.dtb.orig")
+	if not os.path.exists("/boot/bcm2710-rpi-3-b.dtb.orig"):
+		call("cp /boot/bcm2710-rpi-3-b.dtb /boot/bcm2710-rpi-3-b.dtb.orig")
+	if not os.path.exists("/boot/overlays.orig"):
+		call("cp -r /boot/overlays /boot/overlays.orig")
+
+def RestoreKernel():
+	call("mv /boot/kernel.img.orig /boot/kernel.img")
+	call("mv /boot/bcm2708-rpi-b.dtb.orig /boot/bcm2708-rpi-b.dtb")
+	call("mv /boot/bcm2708-rpi-b-plus.dtb.orig /boot/bcm2708-rpi-b-plus.dtb")
+	call("mv /boot/bcm2708-rpi-cm.dtb.orig /boot/bcm2708-rpi-cm.dtb")
+	call("mv /boot/kernel7.img.orig /boot/kernel7.img")
+	call("mv /boot/bcm2709-rpi-2-b.dtb.orig /boot/bcm2709-rpi-2-b.dtb")
+	call("mv /boot/bcm2710-rpi-3-b.dtb.orig /boot/bcm2710-rpi-3-b.dtb")
+	call("rm -rf /boot/overlays")
+	call("mv /boot/overlays.orig /boot/overlays")
+	# the kernels in /boot are not ours anymore, BuildRaspbianVc4.py
+	# installs them again from their staged install if it skips them
 
 def BuildRaspbianVc4():
-	ret = subprocess.call(SCRIPT_DIR + "/BuildRaspbianVc4.py >/tmp/" + PREFIX + ".log 2>&1", shell=True)
+	call("rm -f " + TRACE_FILE + " " + STEP_LOG + " " + getStepLogIndex(STEP_LOG))
+	cmd = SCRIPT_DIR + "/BuildRaspbianVc4.py"
+	if RESUME:
+		cmd = cmd + " --resume"
+	if CROSS:
+		cmd = cmd + " --cross"
+	if PERSISTENT_BUILD:
+		cmd = cmd + " --persistent"
+	ret = call(cmd + " >/tmp/" + PREFIX + ".log 2>&1")
 	if not ret:
-		subprocess.call("mv /tmp/" + PREFIX + ".log /tmp/" + PREFIX + "-success.log", shell=True)
-		subprocess.call("bzip2 -9 /tmp/" + PREFIX + "-success.log", shell=True)
-		subprocess.call("cp /boot/issue-vc4.json /tmp/" + PREFIX + "-issue.json", shell=True)
+		call("mv /tmp/" + PREFIX + ".log /tmp/" + PREFIX + "-success.log")
+		Compress("/tmp/" + PREFIX + "-success.log")
+		call("cp " + ROOT + "/boot/issue-vc4.json /tmp/" + PREFIX + "-issue.json")
+		try:
+			with open(ROOT + "/boot/issue-vc4.json") as f:
+				ingestIssue(openDb(), json.load(f), PREFIX)
+		except Exception:
+			# the history is nice to have, but not worth failing over
+			traceback.print_exc()
 	else:
-		subprocess.call("mv /tmp/" + PREFIX + ".log /tmp/" + PREFIX + "-failure.log", shell=True)
-		subprocess.call("bzip2 -9 /tmp/" + PREFIX + "-failure.log", shell=True)
+		call("mv /tmp/" + PREFIX + ".log /tmp/" + PREFIX + "-failure.log")
+		Compress("/tmp/" + PREFIX + "-failure.log")
+	# the output of each step, already compressed
+	if os.path.exists(STEP_LOG):
+		call("mv " + STEP_LOG + " /tmp/" + PREFIX + "-steps.log.bz2")
+		call("mv " + getStepLogIndex(STEP_LOG) + " /tmp/" + PREFIX + "-steps.log.json")
 	return ret
 
-def TarRaspbianVc4():
+def GetComponentFiles(names):
+	# see BuildRaspbianVc4.mergeStage()
+	files = set()
+	for name in names:
+		listed = loadFileList(name)
+		if listed is None:
+			raise Exception("No list of the files installed by " + name)
+		files.update(listed)
+	return sorted(files)
+
+def TarRaspbianVc4(live=None):
 	# XXX: optionally include src
-	# XXX: better to temp. move original dir?
-	if CUSTOM_KERNEL:
-		subprocess.call("tar cfp /tmp/" + PREFIX + "-overlay.tar /boot/bcm2708-rpi-b.dtb /boot/bcm2708-rpi-b-plus.dtb /boot/bcm2708-rpi-cm.dtb /boot/bcm2709-rpi-2-b.dtb /boot/bcm2710-rpi-3-b.dtb /boot/config.txt /boot/issue-vc4.json /boot/kernel.img /boot/kernel.img-config /boot/kernel7.img /boot/kernel7.img-config /boot/overlays/*.dtbo /etc/ld.so.conf.d/01-libc.conf /etc/profile.d/graphics-debug.sh /etc/security/limits.d/coredump.conf /home/pi/processing-test3d.* /lib/modules/*-2708* /lib/modules/*-2709* /usr/local --exclude=\"/usr/local/bin/indiecity\" --exclude=\"/usr/local/games\" --exclude=\"/usr/local/lib/python*\" --exclude=\"/usr/local/lib/site_ruby\" --exclude=\"/usr/local/src\" --exclude=\"/usr/local/sbin\" --exclude=\"/usr/local/share/ca-certificates\" --exclude=\"/usr/local/share/fonts\" --exclude=\"/usr/local/share/sgml\" --exclude=\"/usr/local/share/xml\" >/dev/null", shell=True)
-	else:
-		subprocess.call("tar cfp /tmp/" + PREFIX + "-overlay.tar /boot/config.txt /boot/issue-vc4.json /etc/ld.so.conf.d/01-libc.conf /etc/profile.d/graphics-debug.sh /etc/security/limits.d/coredump.conf /home/pi/processing-test3d.* /usr/local --exclude=\"/usr/local/bin/indiecity\" --exclude=\"/usr/local/games\" --exclude=\"/usr/local/lib/python*\" --exclude=\"/usr/local/lib/site_ruby\" --exclude=\"/usr/local/src\" --exclude=\"/usr/local/sbin\" --exclude=\"/usr/local/share/ca-certificates\" --exclude=\"/usr/local/share/fonts\" --exclude=\"/usr/local/share/sgml\" --exclude=\"/usr/local/share/xml\" >/dev/null", shell=True)
-	subprocess.call("bzip2 -9 /tmp/" + PREFIX + "-overlay.tar", shell=True)
-	return "/tmp/" + PREFIX + "-overlay.tar.bz2"
+	names = [c['name'] for c in COMPONENTS if CUSTOM_KERNEL or not c['name'].startswith("linux-")]
+	# the system configuration BuildRaspbianVc4.py changed, and exactly
+	# what the components installed
+	files = ["/boot/config.txt", "/boot/issue-vc4.json", "/etc/ld.so.conf.d/01-libc.conf", "/etc/profile.d/graphics-debug.sh", "/etc/security/limits.d/coredump.conf"]
+	files = files + GetComponentFiles(names)
+	# with --cross, the same paths in the sysroot
+	out, manifest = TarFiles("/tmp/" + PREFIX + "-overlay.tar", [ROOT + fn for fn in files], [], ROOT or "/", live, False)
+	SaveManifest(manifest)
+	if DELTA:
+		TarDelta(manifest)
+	if COMPONENT_OVERLAYS:
+		for name in names:
+			TarFiles("/tmp/" + PREFIX + "-overlay-" + name + ".tar", [ROOT + fn for fn in GetComponentFiles([name])], [], ROOT or "/", None, False)
+	return out
 
 def TarProcessing():
-	os.chdir("/usr/local/lib")
-	subprocess.call("tar cfp /tmp/" + PREFIX + "-processing.tar processing-3.*", shell=True)
-	subprocess.call("bzip2 -9 /tmp/" + PREFIX + "-processing.tar", shell=True)
-	return "/tmp/" + PREFIX + "-processing.tar.bz2"
-
-def ResizeRaspbianImage(fn, mbToAdd):
-	subprocess.check_call("dd if=/dev/zero bs=1M count=" + str(mbToAdd) + " >>" + fn, shell=True)
-	subprocess.check_call("fdisk " + fn + " <<EOF\nd\n2\nn\np\n2\n" + str(RASPBIAN_IMG_START_SECTOR_EXT4) + "\n\nw\nEOF", shell=True)
-	subprocess.check_call("dd if=" + fn + " bs=" + str(RASPBIAN_IMG_BYTES_PER_SECTOR) + " count=" + str(RASPBIAN_IMG_START_SECTOR_EXT4) + " of=/tmp/part1", shell=True)
-	subprocess.check_call("dd if=" + fn + " bs=" + str(RASPBIAN_IMG_BYTES_PER_SECTOR) + " skip=" + str(RASPBIAN_IMG_START_SECTOR_EXT4) + " of=/tmp/part2", shell=True)
-	subprocess.check_call("e2fsck -f /tmp/part2", shell=True)
-	subprocess.check_call("resize2fs /tmp/part2", shell=True)
-	subprocess.check_call("cat /tmp/part1 /tmp/part2 > " + fn, shell=True)
-	subprocess.check_call("rm -f /tmp/part1 /tmp/part2", shell=True)
+	return TarFiles("/tmp/" + PREFIX + "-processing.tar", ["/usr/local/lib/processing-3.*"], [], "/usr/local/lib")[0]
 
-def BuildRaspbianImage(overlay):
-	subprocess.check_call("apt-get -y install zip", shell=True)
-	os.chdir("/tmp")
-	# make sure we have the latest version
-	subprocess.call("wget -N http://downloads.raspberrypi.org/raspbian_latest", shell=True)
-	subprocess.check_call("rm -Rf /tmp/raspbian-vc4", shell=True)
-	subprocess.check_call("mkdir /tmp/raspbian-vc4", shell=True)
-	os.chdir("/tmp/raspbian-vc4")
-	subprocess.check_call("unzip ../raspbian_latest", shell=True)
-	# this should yield one .img file inside /tmp/raspbian-vc4
-	files = os.listdir("/tmp/raspbian-vc4")
-	for fn in files:
-		if fn.endswith(".img"):
-			# make room for files we're adding to the image
-			ResizeRaspbianImage("/tmp/raspbian-vc4/" + fn, RASPBIAN_IMG_ENLARGE_BY_MB)
-			break
-	subprocess.check_call("mkdir /tmp/raspbian-vc4/live", shell=True)
-	subprocess.check_call("mount -o offset=" + str(RASPBIAN_IMG_START_SECTOR_EXT4 * RASPBIAN_IMG_BYTES_PER_SECTOR) + " -t ext4 *.img live", shell=True)
-	subprocess.check_call("mount -o offset=" + str(RASPBIAN_IMG_START_SECTOR_VFAT * RASPBIAN_IMG_BYTES_PER_SECTOR) + " -t vfat *.img live/boot", shell=True)
-	os.chdir("/tmp/raspbian-vc4/live")
+def PrepareRaspbianImage(img):
+	# everything that doesn't depend on the build, which is why the
+	# result gets cached (see getBaseImage)
+	live = "/tmp/raspbian-vc4/live"
+	mountImage(img, live)
 	# update firmware
-	subprocess.check_call("SKIP_BACKUP=1 SKIP_WARNING=1 PRUNE_MODULES=1 chroot /tmp/raspbian-vc4/live rpi-update", shell=True)
+	checkCall("SKIP_BACKUP=1 SKIP_WARNING=1 PRUNE_MODULES=1 chroot " + live + " rpi-update", live)
 	# change the default X server for startx
-	xserverrc = file_get_contents("/tmp/raspbian-vc4/live/etc/X11/xinit/xserverrc")
+	xserverrc = file_get_contents(live + "/etc/X11/xinit/xserverrc")
 	xserverrc = re.sub('/usr/bin/X', '/usr/local/bin/Xorg', xserverrc)
-	file_put_contents("/tmp/raspbian-vc4/live/etc/X11/xinit/xserverrc", xserverrc)
+	file_put_contents(live + "/etc/X11/xinit/xserverrc", xserverrc)
 	# change the default X server running after startup
-	lightdmconf = file_get_contents("/tmp/raspbian-vc4/live/etc/lightdm/lightdm.conf")
+	lightdmconf = file_get_contents(live + "/etc/lightdm/lightdm.conf")
 	lightdmconf = re.sub("#xserver-command=X", "xserver-command=/usr/local/bin/Xorg", lightdmconf)
-	file_put_contents("/tmp/raspbian-vc4/live/etc/lightdm/lightdm.conf", lightdmconf)
+	file_put_contents(live + "/etc/lightdm/lightdm.conf", lightdmconf)
 	if CUSTOM_KERNEL:
 		# remove obsolete overlay files
-		subprocess.check_call("rm -Rf /boot/overlays/*.dtb", shell=True)
-		subprocess.check_call("rm -Rf /boot/overlays/*.dtbo", shell=True)
+		checkCall("rm -Rf " + live + "/boot/overlays/*.dtb")
+		checkCall("rm -Rf " + live + "/boot/overlays/*.dtbo")
 		# remove obsolete kernel modules
-		subprocess.check_call("rm -Rf /tmp/raspbian-vc4/live/lib/modules/*", shell=True)
-	subprocess.check_call("tar vfxp " + overlay, shell=True)
+		checkCall("rm -Rf " + live + "/lib/modules/*")
+	trimImage(live)
+	umountImage(live)
+
+def PrepareSysroot():
+	# --cross builds against (and into) a copy of the image the overlay
+	# goes into, made again whenever that changed
+	# (chroots into ARM images run through qemu-arm-static)
+	installPackages(["qemu-user-static"])
+	try:
+		base = getBaseImage(PrepareRaspbianImage, RASPBIAN_IMG_ENLARGE_BY_MB * 1024 * 1024, CUSTOM_KERNEL)
+	except Exception:
+		# e.g. offline without a cached image, an existing sysroot still
+		# does for building
+		if getSysrootBase() is None:
+			raise
+		traceback.print_exc()
+		log("Building against the existing sysroot of " + getSysrootBase())
+		return
+	key = os.path.basename(base) + " " + str(os.path.getmtime(base))
+	if getSysrootBase() == key:
+		return
+	live = "/tmp/raspbian-vc4-sysroot"
+	# in case a previous run failed with the image mounted
+	call("umount " + live + "/boot")
+	call("umount " + live)
+	cloneImage(base, live + ".img")
+	mountImage(live + ".img", live)
+	try:
+		makeSysroot(live, key)
+	finally:
+		umountImage(live)
+		# UploadTempFiles() would pick it up otherwise
+		os.rmdir(live)
+		os.remove(live + ".img")
+
+def MountRaspbianImage():
+	# in case a previous run failed with the image mounted
+	call("umount /tmp/raspbian-vc4/live/boot")
+	call("umount /tmp/raspbian-vc4/live")
+	checkCall("rm -Rf /tmp/raspbian-vc4")
+	checkCall("mkdir /tmp/raspbian-vc4")
+	# make sure we have the latest version, but only download (and
+	# prepare) it when it changed, make room for files we're adding
+	base = getBaseImage(PrepareRaspbianImage, RASPBIAN_IMG_ENLARGE_BY_MB * 1024 * 1024, CUSTOM_KERNEL)
+	img = "/tmp/raspbian-vc4/" + os.path.basename(base)
+	cloneImage(base, img)
+	mountImage(img, "/tmp/raspbian-vc4/live")
+	return "/tmp/raspbian-vc4/live"
+
+def FinishRaspbianImage():
 	# install libglew1.7 needed for mesa-demos (seems to be installed by default in Jessie)
-	#subprocess.check_call("chroot /tmp/raspbian-vc4/live apt-get -y install libglew1.7", shell=True)
+	#checkCall("chroot /tmp/raspbian-vc4/live apt-get -y install libglew1.7")
 	# rebuild ld.so.cache
-	subprocess.check_call("ldconfig -r /tmp/raspbian-vc4/live", shell=True)
-	os.chdir("/tmp/raspbian-vc4")
-	subprocess.check_call("umount live/boot", shell=True)
-	subprocess.check_call("umount live", shell=True)
-	subprocess.check_call("zip -9 ../" + PREFIX +"-image.zip *.img", shell=True)
-	os.chdir("/tmp")
-	subprocess.check_call("rm -Rf /tmp/raspbian-vc4", shell=True)
-	# we keep raspbian_latest around for future invocations (although it looks like /tmp gets cleaned?)
+	checkCall("ldconfig -r /tmp/raspbian-vc4/live")
+	trimImage("/tmp/raspbian-vc4/live")
+	umountImage("/tmp/raspbian-vc4/live")
+	imgs = sorted(["/tmp/raspbian-vc4/" + fn for fn in os.listdir("/tmp/raspbian-vc4") if fn.endswith(".img")])
+	for img in imgs:
+		# lets bmaptool or ImageRaspbianVc4.py write only the blocks in use
+		writeBmap(img, "/tmp/" + PREFIX + "-image.bmap")
+	# compresses only those blocks as well
+	writeZip(imgs, "/tmp/" + PREFIX + "-image.zip")
+	checkCall("rm -Rf /tmp/raspbian-vc4")
 	return "/tmp/" + PREFIX + "-image.zip"
 
+def BuildRaspbianImage(overlay):
+	live = MountRaspbianImage()
+	checkCall("tar vfxp " + overlay, live)
+	return FinishRaspbianImage()
+
+def PlanPackage():
+	# the build's plan, followed by the steps that run after it
+	plan = planBuild(COMPONENTS)
+	times = loadTimes()
+	last = max(plan, key=lambda step: step['end'])
+	names = ["overlay", "image"]
+	if STREAM_IMAGE:
+		names.insert(0, "mount")
+	if not CROSS:
+		names.insert(names.index("image"), "processing")
+	if UPLOAD:
+		names.append("upload")
+	for name in names:
+		last = addPlanStep(plan, times, name, "run", name, last)
+	printPlan(plan, "package")
+
+def WriteTrace():
+	# one timeline for the build and the packaging, e.g. for ui.perfetto.dev
+	events = getTraceEvents(steps, "PackageRaspbianVc4")
+	if os.path.exists(TRACE_FILE):
+		events = events + json.loads(file_get_contents(TRACE_FILE))['traceEvents']
+	file_put_contents("/tmp/" + PREFIX + "-trace.json", json.dumps({ 'traceEvents': events }))
+	return "/tmp/" + PREFIX + "-trace.json"
+
 # XXX: pull latest vc4-buildbot script
 # XXX: umask?
 # XXX: prepopulate ssh host keys in known_hosts
+if PLAN:
+	# only reads what earlier runs left behind
+	PlanPackage()
+	sys.exit(0)
 checkRoot()
+start = time.time()
 killHangingBuilds()
-if UPLOAD:
+journal = loadJournal(JOURNAL_FILE)
+# a resumed run continues with the files of the one that failed
+PREFIX = journal.get('prefix', PREFIX)
+journal['prefix'] = PREFIX
+saveJournal(JOURNAL_FILE, journal)
+if UPLOAD and not RESUME:
 	UploadTempFiles()
 	DeleteTempFiles()
-# preserve original kernel and device tree on build machine
-
-if CUSTOM_KERNEL:
-	if not os.path.exists("/boot/kernel.img.orig"):
-		subprocess.call("cp /boot/kernel.img /boot/kernel.img.orig", shell=True)
-	if not os.path.exists("/boot/bcm2708-rpi-b.dtb.orig"):
-		subprocess.call("cp /boot/bcm2708-rpi-b.dtb /boot/bcm2708-rpi-b.dtb.orig", shell=True)
-	if not os.path.exists("/boot/bcm2708-rpi-b-plus.dtb.orig"):
-		subprocess.call("cp /boot/bcm2708-rpi-b-plus.dtb /boot/bcm2708-rpi-b-plus.dtb.orig", shell=True)
-	if not os.path.exists("/boot/bcm2708-rpi-cm.dtb.orig"):
-		subprocess.call("cp /boot/bcm2708-rpi-cm.dtb /boot/bcm2708-rpi-cm.dtb.orig", shell=True)
-	if not os.path.exists("/boot/kernel7.img.orig"):
-		subprocess.call("cp /boot/kernel7.img /boot/kernel7.img.orig", shell=True)
-	if not os.path.exists("/boot/bcm2709-rpi-2-b.dtb.orig"):
-		subprocess.call("cp /boot/bcm2709-rpi-2-b.dtb /boot/bcm2709-rpi-2-b.dtb.orig", shell=True)
-	if not os.path.exists("/boot/bcm2710-rpi-3-b.dtb.orig"):
-		subprocess.call("cp /boot/bcm2710-rpi-3-b.dtb /boot/bcm2710-rpi-3-b.dtb.orig", shell=True)
-	if not os.path.exists("/boot/overlays.orig"):
-		subprocess.call("cp -r /boot/overlays /boot/overlays.orig", shell=True)
-ret = BuildRaspbianVc4()
-if not ret:
-	# success
-	tar = TarRaspbianVc4()
-	TarProcessing()
-if CUSTOM_KERNEL:
-	# restore original kernel
-	subprocess.call("mv /boot/kernel.img.orig /boot/kernel.img", shell=True)
-	subprocess.call("mv /boot/bcm2708-rpi-b.dtb.orig /boot/bcm2708-rpi-b.dtb", shell=True)
-	subprocess.call("mv /boot/bcm2708-rpi-b-plus.dtb.orig /boot/bcm2708-rpi-b-plus.dtb", shell=True)
-	subprocess.call("mv /boot/bcm2708-rpi-cm.dtb.orig /boot/bcm2708-rpi-cm.dtb", shell=True)
-	subprocess.call("mv /boot/kernel7.img.orig /boot/kernel7.img", shell=True)
-	subprocess.call("mv /boot/bcm2709-rpi-2-b.dtb.orig /boot/bcm2709-rpi-2-b.dtb", shell=True)
-	subprocess.call("mv /boot/bcm2710-rpi-3-b.dtb.orig /boot/bcm2710-rpi-3-b.dtb", shell=True)
-	subprocess.call("rm -rf /boot/overlays", shell=True)
-	subprocess.call("mv /boot/overlays.orig /boot/overlays", shell=True)
+live = None
+outputs = [GetCompressedName("/tmp/" + PREFIX + "-overlay.tar")]
+if not CROSS:
+	outputs.append(GetCompressedName("/tmp/" + PREFIX + "-processing.tar"))
+done = getCheckpoint(journal, 'overlay', None, outputs)
+if done:
+	log("Skipping build (done before)")
+	ret = 0
+	tar = done['result']
+else:
+	# cross-compiled kernels go into the sysroot, not this machine's /boot
+	if CUSTOM_KERNEL and not CROSS:
+		BackupKernel()
+	try:
+		if CROSS:
+			PrepareSysroot()
+		ret = BuildRaspbianVc4()
+		if not ret:
+			# success
+			if STREAM_IMAGE:
+				live = timed("mount", MountRaspbianImage)
+			tar = timed("overlay", TarRaspbianVc4, live)
+			if not CROSS:
+				timed("processing", TarProcessing)
+	finally:
+		if CUSTOM_KERNEL and not CROSS:
+			RestoreKernel()
+	if not ret:
+		setCheckpoint(JOURNAL_FILE, journal, 'overlay', None, tar)
 if not ret:
-	BuildRaspbianImage(tar)
+	if getCheckpoint(journal, 'image', tar, ["/tmp/" + PREFIX + "-image.zip"]):
+		log("Skipping image (done before)")
+	else:
+		if live:
+			timed("image", FinishRaspbianImage)
+		else:
+			timed("image", BuildRaspbianImage, tar)
+		setCheckpoint(JOURNAL_FILE, journal, 'image', tar)
+WriteTrace()
+if not ret and not RESUME:
+	# a resumed run only did part of the work
+	addTime("package", time.time() - start)
 if UPLOAD:
-	ret = UploadTempFiles()
+	ret = timed("upload", UploadTempFiles)
 	if not ret:
 		DeleteTempFiles()
 #else:
 #	there might be a temporary connectivity issue
 #	in this case we'll try again next time this script is run
 
-# XXX: limit login to scp?
-# XXX: delete old builds on the server
+# XXX: limit login to the commands of SshBackend?
 # XXX: ~/.ssh mode 700?
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+# Database of build and test results, to spot regressions
+# Copyright (C) 2015 Gottfried Haider
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import hashlib
+import sqlite3
+
+RESULTS_DB = "/usr/local/src/results-vc4.db"
+# a build is compared against this many earlier ones
+REPORT_WINDOW = 5
+# flagged when this many standard errors worse, and by at least this
+# much (relative), standard deviations are taken to be at least NOISE
+REGRESSION_SCORE = 3.0
+REGRESSION_FPS = 0.05
+REGRESSION_TIME = 0.10
+NOISE = 0.02
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (id TEXT PRIMARY KEY, time REAL, commits TEXT);
+CREATE INDEX IF NOT EXISTS builds_commits ON builds (commits);
+CREATE TABLE IF NOT EXISTS components (build TEXT, name TEXT, commit_ TEXT, branch TEXT, url TEXT, skipped INTEGER, wall REAL, user REAL, sys REAL, maxrss INTEGER, PRIMARY KEY (build, name));
+CREATE INDEX IF NOT EXISTS components_commit ON components (name, commit_);
+CREATE TABLE IF NOT EXISTS steps (build TEXT, component TEXT, cmd TEXT, wall REAL, user REAL, sys REAL, maxrss INTEGER);
+CREATE INDEX IF NOT EXISTS steps_build ON steps (build, component);
+CREATE TABLE IF NOT EXISTS tests (build TEXT, sketch TEXT, result INTEGER, comment TEXT, fps_mean REAL, fps_p5 REAL, fps_p95 REAL, fps_samples TEXT, startup REAL, rss INTEGER, frames INTEGER, PRIMARY KEY (build, sketch));
+CREATE INDEX IF NOT EXISTS tests_sketch ON tests (sketch);
+"""
+
+def openDb(fn=RESULTS_DB):
+	db = sqlite3.connect(fn)
+	db.executescript(SCHEMA)
+	return db
+
+def getCommitsKey(issue):
+	# builds of the same commits are the same build, no matter which file
+	# they came from
+	commits = sorted([(name, issue[name]['commit']) for name in issue if isinstance(issue[name], dict) and 'commit' in issue[name]])
+	return hashlib.sha256(json.dumps(commits).encode()).hexdigest()
+
+def getBuildTime(build):
+	# from the prefix, e.g. 20160501-2100-vc4
+	m = re.match(r'^(\d{8}-\d{4})', build)
+	if m:
+		return time.mktime(time.strptime(m.group(1), "%Y%m%d-%H%M"))
+	return time.time()
+
+def getBuild(db, issue, build=None):
+	commits = getCommitsKey(issue)
+	if build is None:
+		row = db.execute("SELECT id FROM builds WHERE commits = ? ORDER BY time DESC LIMIT 1", (commits,)).fetchone()
+		if row:
+			return row[0]
+		build = commits[:12]
+	db.execute("INSERT OR REPLACE INTO builds VALUES (?, ?, ?)", (build, getBuildTime(build), commits))
+	return build
+
+def ingestIssue(db, issue, build=None):
+	build = getBuild(db, issue, build)
+	db.execute("DELETE FROM components WHERE build = ?", (build,))
+	db.execute("DELETE FROM steps WHERE build = ?", (build,))
+	for name in issue:
+		info = issue[name]
+		if not isinstance(info, dict) or 'commit' not in info:
+			continue
+		stats = info.get('stats', {})
+		db.execute("INSERT INTO components VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (build, name, info['commit'], info.get('branch'), info.get('url'), stats.get('skipped', 0), stats.get('wall'), stats.get('user'), stats.get('sys'), stats.get('maxrss')))
+		for step in stats.get('steps', []):
+			db.execute("INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?)", (build, name, step['cmd'], step['wall'], step['user'], step['sys'], step['maxrss']))
+	db.commit()
+	return build
+
+def ingestTests(db, data, build=None):
+	# processing-test3d.json, which has the issue of the system it ran on
+	if build is None and data.get('system') is None:
+		raise Exception("No build given, and no system in the test results")
+	if data.get('system') is not None:
+		build = ingestIssue(db, data['system'], build)
+	for row in data.get('tests', []):
+		if row.get('result') is None and row.get('benchmark') is None:
+			continue
+		bench = row.get('benchmark', {})
+		fps = bench.get('fps', {})
+		db.execute("INSERT OR REPLACE INTO tests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (build, row['sketch'], row.get('result'), row.get('comment'), fps.get('mean'), fps.get('p5'), fps.get('p95'), json.dumps(bench['samples']) if 'samples' in bench else None, bench.get('startup'), bench.get('rssKb'), bench.get('frames')))
+	db.commit()
+	return build
+
+def getBuilds(db):
+	return [row[0] for row in db.execute("SELECT id FROM builds ORDER BY time, id")]
+
+def getMeanSd(values):
+	mean = sum(values) / float(len(values))
+	sd = 0.0
+	if 1 < len(values):
+		sd = math.sqrt(sum([(v - mean) ** 2 for v in values]) / (len(values) - 1))
+	return mean, max(sd, NOISE * abs(mean))
+
+def getWelchScore(before, after):
+	# how many standard errors the means of two samples are apart
+	mb, sb = getMeanSd(before)
+	ma, sa = getMeanSd(after)
+	se = math.sqrt(sb ** 2 / len(before) + sa ** 2 / len(after))
+	if not se:
+		return 0.0
+	return (ma - mb) / se
+
+def getZScore(before, value):
+	# how unusual a single value is, compared to earlier ones
+	mean, sd = getMeanSd(before)
+	if not sd:
+		return 0.0
+	return (value - mean) / sd
+
+def getChangedComponents(db, base, new):
+	old = dict(db.execute("SELECT name, commit_ FROM components WHERE build = ?", (base,)).fetchall())
+	changed = []
+	for name, commit in db.execute("SELECT name, commit_ FROM components WHERE build = ? ORDER BY name", (new,)):
+		if old.get(name) != commit:
+			changed.append((name, old.get(name), commit))
+	return changed
+
+def getRegressions(db, base, new):
+	# (what, name, before, after, score)
+	builds = getBuilds(db)
+	window = builds[max(0, builds.index(base) - REPORT_WINDOW + 1):builds.index(base) + 1]
+	marks = ",".join("?" * len(window))
+	regressions = []
+	for sketch, mean, samples in db.execute("SELECT sketch, fps_mean, fps_samples FROM tests WHERE build = ? AND fps_mean IS NOT NULL", (new,)).fetchall():
+		row = db.execute("SELECT fps_mean, fps_samples FROM tests WHERE build = ? AND sketch = ? AND fps_mean IS NOT NULL", (base, sketch)).fetchone()
+		if not row:
+			continue
+		if samples and row[1] and 1 < len(json.loads(samples)) and 1 < len(json.loads(row[1])):
+			score = getWelchScore(json.loads(row[1]), json.loads(samples))
+		else:
+			before = [r[0] for r in db.execute("SELECT fps_mean FROM tests WHERE build IN (" + marks + ") AND sketch = ? AND fps_mean IS NOT NULL", window + [sketch])]
+			score = getZScore(before, mean)
+		if score < -REGRESSION_SCORE and mean < row[0] * (1 - REGRESSION_FPS):
+			regressions.append(("fps", sketch, row[0], mean, score))
+	for name, wall in db.execute("SELECT name, wall FROM components WHERE build = ? AND NOT skipped AND wall IS NOT NULL", (new,)).fetchall():
+		before = [r[0] for r in db.execute("SELECT wall FROM components WHERE build IN (" + marks + ") AND name = ? AND NOT skipped AND wall IS NOT NULL", window + [name])]
+		if not before:
+			continue
+		mean = sum(before) / len(before)
+		score = getZScore(before, wall)
+		if REGRESSION_SCORE < score and mean * (1 + REGRESSION_TIME) < wall:
+			regressions.append(("build time", name, mean, wall, score))
+	return regressions
+
+def report(db, base=None, new=None):
+	builds = getBuilds(db)
+	if not builds:
+		exit("No builds ingested yet")
+	for build in [base, new]:
+		if build is not None and build not in builds:
+			exit("Unknown build " + build)
+	if new is None:
+		new = builds[-1]
+	if base is None:
+		if builds.index(new) == 0:
+			print("Nothing to compare " + new + " with")
+			return 0
+		base = builds[builds.index(new) - 1]
+	print("Comparing " + new + " with " + base)
+	changed = getChangedComponents(db, base, new)
+	for (name, old, commit) in changed:
+		print("  changed " + name + ": " + str(old)[:12] + ".." + commit[:12])
+	regressions = getRegressions(db, base, new)
+	for (what, name, before, after, score) in regressions:
+		line = "  %s regression in %s: %.2f -> %.2f (%.1f standard errors)" % (what, name, before, after, score)
+		if what == "build time" and name in [c[0] for c in changed]:
+			line = line + ", its commit changed"
+		elif changed:
+			line = line + ", suspects: " + ", ".join([c[0] for c in changed])
+		print(line)
+	if not regressions:
+		print("  no regressions")
+	return len(regressions)
+
+
+if __name__ == "__main__":
+	if 3 <= len(sys.argv) <= 4 and sys.argv[1] == "ingest":
+		db = openDb()
+		with open(sys.argv[2]) as f:
+			data = json.load(f)
+		m = re.match(r'^(\d{8}-\d{4}-vc4)', os.path.basename(sys.argv[2]))
+		build = sys.argv[3] if len(sys.argv) == 4 else (m.group(1) if m else None)
+		if 'tests' in data:
+			print("Ingested tests of " + ingestTests(db, data, build))
+		else:
+			print("Ingested build " + ingestIssue(db, data, build))
+	elif 2 <= len(sys.argv) <= 4 and sys.argv[1] == "report":
+		base = None
+		new = None
+		if len(sys.argv) == 4:
+			base = sys.argv[2]
+		if 3 <= len(sys.argv):
+			new = sys.argv[-1]
+		# non-zero exit status on regressions
+		sys.exit(1 if report(openDb(), base, new) else 0)
+	elif 3 <= len(sys.argv) <= 4 and sys.argv[1] == "component":
+		query = "SELECT build, commit_, skipped, wall FROM components JOIN builds ON build = id WHERE name = ?"
+		args = sys.argv[2:]
+		if len(sys.argv) == 4:
+			query = query + " AND commit_ LIKE ? || '%'"
+		for row in openDb().execute(query + " ORDER BY time", args):
+			print("%s %s %s %s" % (row[0], row[1][:12], "skipped" if row[2] else "built", row[3]))
+	elif len(sys.argv) == 3 and sys.argv[1] == "sketch":
+		for row in openDb().execute("SELECT build, result, fps_mean, fps_p5, fps_p95, startup FROM tests JOIN builds ON build = id WHERE sketch = ? ORDER BY time", (sys.argv[2],)):
+			print("%s result %s fps %s (p5 %s, p95 %s) startup %s" % row)
+	else:
+		exit("Usage: " + sys.argv[0] + " ingest FILE [BUILD]\n       " + sys.argv[0] + " report [[BASE] BUILD]\n       " + sys.argv[0] + " component NAME [COMMIT]\n       " + sys.argv[0] + " sketch SKETCH")
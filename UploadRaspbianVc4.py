@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+
+# Helpers to upload and keep build artifacts
+# Copyright (C) 2015 Gottfried Haider
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import subprocess
+import threading
+import time
+import datetime
+import traceback
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+from BuildRaspbianVc4 import log
+
+# files get uploaded as chunks of this size, named after their SHA-256,
+# which are only put together at the destination once all of them are
+# there, so an interrupted upload resumes where it stopped
+UPLOAD_CHUNK = 8 * 1024 * 1024
+UPLOAD_JOBS = 4
+UPLOAD_RETRIES = 3
+# layout at the destination: every distinct file is stored once under
+# objects/ (by SHA-256), builds/<prefix>/ has hardlinks to the files of
+# a build under their usual names, and a manifest.json
+CHUNK_DIR = ".chunks"
+OBJECT_DIR = "objects"
+BUILD_DIR = "builds"
+# builds to keep: the last few, the last one of each recent week, and
+# all that got tagged (see tag below)
+KEEP_LAST = 7
+KEEP_WEEKS = 8
+KEEP_TAGS = ["good"]
+# objects and chunks younger than this are never collected, as they
+# might belong to an upload that is still going on
+GC_GRACE = 24 * 3600
+
+class LocalBackend(object):
+	# a directory on this machine, e.g. on the server itself, or for
+	# trying things out offline
+
+	def __init__(self, path):
+		self.path = os.path.expanduser(path)
+		self.chunks = os.path.join(self.path, CHUNK_DIR)
+
+	def getObject(self, sha256):
+		return os.path.join(self.path, OBJECT_DIR, sha256[:2], sha256)
+
+	def listChunks(self):
+		if not os.path.isdir(self.chunks):
+			os.makedirs(self.chunks)
+		return set(os.listdir(self.chunks))
+
+	def putChunk(self, name, data):
+		tmp = os.path.join(self.chunks, name + ".tmp")
+		with open(tmp, 'wb') as f:
+			f.write(data)
+		if getSha256(tmp) != name:
+			raise Exception("Chunk " + name + " got corrupted")
+		os.rename(tmp, os.path.join(self.chunks, name))
+
+	def touchObject(self, sha256):
+		# also keeps the garbage collector away from an object that is
+		# about to be used again
+		try:
+			os.utime(self.getObject(sha256), None)
+			return True
+		except OSError:
+			return False
+
+	def assemble(self, sha256, chunks):
+		obj = self.getObject(sha256)
+		if not os.path.isdir(os.path.dirname(obj)):
+			os.makedirs(os.path.dirname(obj))
+		with open(obj + ".tmp", 'wb') as f:
+			for name in chunks:
+				with open(os.path.join(self.chunks, name), 'rb') as c:
+					shutil.copyfileobj(c, f)
+		if getSha256(obj + ".tmp") != sha256:
+			raise Exception("Object " + sha256 + " got corrupted")
+		os.rename(obj + ".tmp", obj)
+
+	def writeBuild(self, prefix, manifest):
+		build = os.path.join(self.path, BUILD_DIR, prefix)
+		if not os.path.isdir(build):
+			os.makedirs(build)
+		for name in manifest['files']:
+			if os.path.lexists(os.path.join(build, name)):
+				os.remove(os.path.join(build, name))
+			os.link(self.getObject(manifest['files'][name]['sha256']), os.path.join(build, name))
+		with open(os.path.join(build, "manifest.json.tmp"), 'w') as f:
+			f.write(json.dumps(manifest, sort_keys=True))
+		os.rename(os.path.join(build, "manifest.json.tmp"), os.path.join(build, "manifest.json"))
+
+	def readBuilds(self):
+		builds = {}
+		if os.path.isdir(os.path.join(self.path, BUILD_DIR)):
+			for prefix in os.listdir(os.path.join(self.path, BUILD_DIR)):
+				fn = os.path.join(self.path, BUILD_DIR, prefix, "manifest.json")
+				if os.path.exists(fn):
+					with open(fn) as f:
+						builds[prefix] = json.loads(f.read())
+		return builds
+
+	def removeBuild(self, prefix):
+		shutil.rmtree(os.path.join(self.path, BUILD_DIR, prefix))
+
+	def listObjects(self):
+		# SHA-256 and mtime
+		objects = {}
+		for root, dirs, files in os.walk(os.path.join(self.path, OBJECT_DIR)):
+			for fn in files:
+				if not fn.endswith(".tmp"):
+					objects[fn] = os.path.getmtime(os.path.join(root, fn))
+		return objects
+
+	def removeObjects(self, shas):
+		for sha256 in shas:
+			os.remove(self.getObject(sha256))
+
+	def cleanChunks(self, age=GC_GRACE):
+		if not os.path.isdir(self.chunks):
+			return
+		for fn in os.listdir(self.chunks):
+			if age <= time.time() - os.path.getmtime(os.path.join(self.chunks, fn)):
+				os.remove(os.path.join(self.chunks, fn))
+
+class SshBackend(object):
+	# a directory on a remote host, all commands share one connection
+
+	def __init__(self, host, user, key, path):
+		self.ssh = ["ssh", "-i", key, "-o", "BatchMode=yes", "-o", "ControlMaster=auto", "-o", "ControlPath=/tmp/vc4-upload-%r@%h:%p", "-o", "ControlPersist=60", user + "@" + host]
+		# left unquoted so that the remote shell expands ~
+		self.path = path.rstrip("/")
+		self.chunks = self.path + "/" + CHUNK_DIR
+
+	def run(self, cmd, data=None, check=True):
+		p = subprocess.Popen(self.ssh + [cmd], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+		out = p.communicate(data)[0]
+		if check and p.returncode:
+			raise subprocess.CalledProcessError(p.returncode, cmd)
+		return p.returncode, out.decode()
+
+	def getObject(self, sha256):
+		return self.path + "/" + OBJECT_DIR + "/" + sha256[:2] + "/" + sha256
+
+	def listChunks(self):
+		return set(self.run("mkdir -p " + self.chunks + " && ls " + self.chunks)[1].split())
+
+	def putChunk(self, name, data):
+		tmp = self.chunks + "/" + name + ".tmp"
+		self.run("cat > " + tmp + " && test \"$(sha256sum < " + tmp + " | cut -c1-64)\" = " + name + " && mv " + tmp + " " + self.chunks + "/" + name, data)
+
+	def touchObject(self, sha256):
+		return not self.run("touch -c " + self.getObject(sha256) + " && test -e " + self.getObject(sha256), check=False)[0]
+
+	def assemble(self, sha256, chunks):
+		obj = self.getObject(sha256)
+		self.run("mkdir -p " + os.path.dirname(obj) + " && cd " + self.chunks + " && cat " + " ".join(chunks) + " > " + obj + ".tmp && test \"$(sha256sum < " + obj + ".tmp | cut -c1-64)\" = " + sha256 + " && mv " + obj + ".tmp " + obj)
+
+	def writeBuild(self, prefix, manifest):
+		build = self.path + "/" + BUILD_DIR + "/" + prefix
+		cmd = "mkdir -p " + build
+		for name in manifest['files']:
+			cmd = cmd + " && ln -f " + self.getObject(manifest['files'][name]['sha256']) + " " + build + "/" + name
+		cmd = cmd + " && cat > " + build + "/manifest.json.tmp && mv " + build + "/manifest.json.tmp " + build + "/manifest.json"
+		self.run(cmd, json.dumps(manifest, sort_keys=True).encode())
+
+	def readBuilds(self):
+		# one manifest per line
+		out = self.run("for f in " + self.path + "/" + BUILD_DIR + "/*/manifest.json; do test -e $f && cat $f && echo; done; true")[1]
+		builds = {}
+		for line in out.splitlines():
+			if line.strip():
+				manifest = json.loads(line)
+				builds[manifest['prefix']] = manifest
+		return builds
+
+	def removeBuild(self, prefix):
+		self.run("rm -rf " + self.path + "/" + BUILD_DIR + "/" + prefix)
+
+	def listObjects(self):
+		out = self.run("mkdir -p " + self.path + "/" + OBJECT_DIR + " && find " + self.path + "/" + OBJECT_DIR + " -type f ! -name '*.tmp' -printf '%f %T@\\n'")[1]
+		objects = {}
+		for line in out.splitlines():
+			sha256, mtime = line.split()
+			objects[sha256] = float(mtime)
+		return objects
+
+	def removeObjects(self, shas):
+		shas = list(shas)
+		while shas:
+			self.run("rm -f " + " ".join([self.getObject(sha256) for sha256 in shas[:200]]))
+			shas = shas[200:]
+
+	def cleanChunks(self, age=GC_GRACE):
+		self.run("test ! -d " + self.chunks + " || find " + self.chunks + " -type f -mmin +" + str(age // 60) + " -delete")
+
+def getSha256(fn):
+	sha256 = hashlib.sha256()
+	with open(fn, 'rb') as f:
+		while True:
+			chunk = f.read(1024 * 1024)
+			if not chunk:
+				break
+			sha256.update(chunk)
+	return sha256.hexdigest()
+
+def getChunks(fn):
+	# (offset, size, SHA-256) of each chunk, and of the whole file
+	chunks = []
+	sha256 = hashlib.sha256()
+	with open(fn, 'rb') as f:
+		offset = 0
+		while True:
+			data = f.read(UPLOAD_CHUNK)
+			if not data and offset:
+				break
+			sha256.update(data)
+			chunks.append((offset, len(data), hashlib.sha256(data).hexdigest()))
+			offset = offset + len(data)
+			if not data:
+				break
+	return chunks, sha256.hexdigest()
+
+def getPrefix(fn):
+	# the build a file belongs to, e.g. 20160501-2100-vc4
+	m = re.match(r'^(\d{8}-\d{4}-vc4)', os.path.basename(fn))
+	if m:
+		return m.group(1)
+	return "misc"
+
+def uploadWorker(backend, todo, failed):
+	while True:
+		try:
+			fn, offset, size, name = todo.get_nowait()
+		except queue.Empty:
+			return
+		with open(fn, 'rb') as f:
+			f.seek(offset)
+			data = f.read(size)
+		for attempt in range(UPLOAD_RETRIES):
+			try:
+				backend.putChunk(name, data)
+				break
+			except Exception:
+				traceback.print_exc()
+		else:
+			failed.append(name)
+
+def upload(files, backend, jobs=UPLOAD_JOBS):
+	# returns 0 on success, like scp
+	start = time.time()
+	try:
+		have = backend.listChunks()
+		todo = queue.Queue()
+		queued = set()
+		pending = []
+		builds = {}
+		sent = 0
+		# e.g. a directory left behind by a failed run shouldn't keep the
+		# rest from getting uploaded
+		for fn in [fn for fn in files if not os.path.isfile(fn)]:
+			log("Not uploading " + fn + ", not a regular file")
+		for fn in [fn for fn in files if os.path.isfile(fn)]:
+			chunks, sha256 = getChunks(fn)
+			builds.setdefault(getPrefix(fn), {})[os.path.basename(fn)] = { 'sha256': sha256, 'size': os.path.getsize(fn) }
+			# the same file from another night
+			if backend.touchObject(sha256):
+				continue
+			pending.append((chunks, sha256))
+			for (offset, size, name) in chunks:
+				# already there from an earlier attempt, or another file
+				if name not in have and name not in queued:
+					todo.put((fn, offset, size, name))
+					queued.add(name)
+					sent = sent + size
+		failed = []
+		threads = [threading.Thread(target=uploadWorker, args=(backend, todo, failed), name="upload-" + str(i)) for i in range(jobs)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		if failed:
+			log("Failed uploading " + str(len(failed)) + " chunks")
+			return 1
+		for chunks, sha256 in pending:
+			if not backend.touchObject(sha256):
+				backend.assemble(sha256, [name for (offset, size, name) in chunks])
+		existing = backend.readBuilds()
+		for prefix in builds:
+			# a build can get uploaded in several goes
+			manifest = existing.get(prefix, { 'prefix': prefix, 'files': {}, 'tags': [] })
+			manifest['files'].update(builds[prefix])
+			for fn in files:
+				if getPrefix(fn) == prefix and fn.endswith("-issue.json"):
+					with open(fn) as f:
+						manifest['issue'] = json.loads(f.read())
+			backend.writeBuild(prefix, manifest)
+		# the chunks stay until collectGarbage() removes them after
+		# GC_GRACE, another upload that is still going on might need
+		# some of the same ones
+	except Exception:
+		traceback.print_exc()
+		return 1
+	log("Uploaded %.1f MB of %d files in %.1fs" % (sent / 1048576.0, len(files), time.time() - start))
+	return 0
+
+def getExpiredBuilds(builds, now=None):
+	# everything the retention policy doesn't keep
+	if now is None:
+		now = datetime.datetime.now()
+	dated = []
+	for prefix in builds:
+		try:
+			dated.append((datetime.datetime.strptime(prefix[:13], "%Y%m%d-%H%M"), prefix))
+		except ValueError:
+			pass
+	dated.sort()
+	keep = set([prefix for (date, prefix) in dated[-KEEP_LAST:]])
+	weeks = {}
+	for (date, prefix) in dated:
+		if now - date < datetime.timedelta(weeks=KEEP_WEEKS):
+			# the last one of the week wins
+			weeks[date.isocalendar()[:2]] = prefix
+	keep.update(weeks.values())
+	for (date, prefix) in dated:
+		if set(builds[prefix].get('tags', [])) & set(KEEP_TAGS):
+			keep.add(prefix)
+	return [prefix for (date, prefix) in dated if prefix not in keep]
+
+def collectGarbage(backend):
+	# mark and sweep: expired builds go first, then the objects no
+	# remaining build refers to, but only once they are older than
+	# GC_GRACE, so that uploads can go on at the same time
+	builds = backend.readBuilds()
+	for prefix in getExpiredBuilds(builds):
+		log("Removing build " + prefix)
+		backend.removeBuild(prefix)
+		del builds[prefix]
+	marked = set()
+	for prefix in builds:
+		for name in builds[prefix]['files']:
+			marked.add(builds[prefix]['files'][name]['sha256'])
+	now = time.time()
+	sweep = [sha256 for (sha256, mtime) in backend.listObjects().items() if sha256 not in marked and GC_GRACE < now - mtime]
+	backend.removeObjects(sweep)
+	backend.cleanChunks(GC_GRACE)
+	log("Kept %d builds, removed %d objects" % (len(builds), len(sweep)))
+
+def tagBuild(backend, prefix, tag):
+	builds = backend.readBuilds()
+	if prefix not in builds:
+		exit("No build " + prefix)
+	if tag not in builds[prefix]['tags']:
+		builds[prefix]['tags'].append(tag)
+	backend.writeBuild(prefix, builds[prefix])
+
+
+if __name__ == "__main__":
+	# e.g. on the server, in the directory UPLOAD_PATH points to
+	if 4 <= len(sys.argv) and sys.argv[1] == "upload":
+		sys.exit(upload(sys.argv[3:], LocalBackend(sys.argv[2])))
+	elif len(sys.argv) == 5 and sys.argv[1] == "tag":
+		tagBuild(LocalBackend(sys.argv[2]), sys.argv[3], sys.argv[4])
+	elif len(sys.argv) == 3 and sys.argv[1] == "gc":
+		collectGarbage(LocalBackend(sys.argv[2]))
+	else:
+		exit("Usage: " + sys.argv[0] + " upload DIRECTORY FILE...\n       " + sys.argv[0] + " tag DIRECTORY PREFIX TAG\n       " + sys.argv[0] + " gc DIRECTORY")
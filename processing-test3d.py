@@ -10,11 +10,51 @@
 
 
 import os
+import sys
 import subprocess
 import json
+import shutil
+import hashlib
+import multiprocessing
+import pipes
+import distutils.spawn
+import signal
+import tempfile
+import threading
+import time
+import Queue
 
-EXAMPLES_DIR = "/usr/local/lib/processing/modes/java/examples"
+PROCESSING_DIR = "/usr/local/lib/processing"
+EXAMPLES_DIR = os.environ.get("EXAMPLES_DIR", PROCESSING_DIR + "/modes/java/examples")
+# looked up on the PATH, so a fake one can stand in for testing
 PROCESSING_CMD = "processing-java"
+# --batch runs every sketch for this many seconds and measures it,
+# instead of asking
+BATCH = "--batch" in sys.argv[1:]
+BENCHMARK_SECONDS = 30
+# sketches that didn't draw their first frame by then are given up
+BENCHMARK_STARTUP_SECONDS = 120
+# sketches get exported ahead of time, so that running them doesn't
+# need to wait for javac, each job is a JVM of its own
+PRECOMPILE = 1
+PRECOMPILE_JOBS = 2
+CACHE_DIR = os.path.expanduser("~/.cache/processing-test3d")
+# added to a copy of each sketch, prints a line every second
+BENCHMARK_TAB = """
+public class Vc4Benchmark {
+	int last = -1;
+	Vc4Benchmark(PApplet sketch) {
+		sketch.registerMethod("post", this);
+	}
+	public void post() {
+		if (last == -1 || 1000 <= millis() - last) {
+			last = millis();
+			System.out.println("VC4BENCH " + frameCount + " " + last);
+		}
+	}
+}
+Vc4Benchmark vc4Benchmark = new Vc4Benchmark(this);
+"""
 
 def default_input(message, defaultVal):
 	if defaultVal:
@@ -22,6 +62,183 @@ def default_input(message, defaultVal):
 	else:
 		return raw_input("%s: " % (message))
 
+def getPercentile(values, p):
+	# nearest rank
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def getTreeRss(pid):
+	# resident memory of a process and all its descendants, in kB
+	children = {}
+	rss = {}
+	for entry in os.listdir("/proc"):
+		if not entry.isdigit():
+			continue
+		try:
+			with open("/proc/" + entry + "/status") as f:
+				status = dict([line.split(":", 1) for line in f.read().splitlines() if ":" in line])
+		except IOError:
+			continue
+		children.setdefault(int(status["PPid"]), []).append(int(entry))
+		rss[int(entry)] = int(status.get("VmRSS", "0 kB").split()[0])
+	total = 0
+	todo = [pid]
+	while todo:
+		pid = todo.pop()
+		total = total + rss.get(pid, 0)
+		todo.extend(children.get(pid, []))
+	return total
+
+def getProcessingVersion():
+	try:
+		with open(PROCESSING_DIR + "/lib/version.txt") as f:
+			return f.read().strip()
+	except IOError:
+		# e.g. a fake one for testing
+		cmd = os.path.realpath(distutils.spawn.find_executable(PROCESSING_CMD) or PROCESSING_CMD)
+		return cmd + " " + str(os.path.getmtime(cmd))
+
+def getSketchKey(sketch, version):
+	# changes with the sketch's source, the benchmark tab and Processing
+	sha256 = hashlib.sha256()
+	sha256.update(version + "\0" + BENCHMARK_TAB)
+	for root, dirs, files in os.walk(EXAMPLES_DIR + "/" + sketch):
+		dirs.sort()
+		for fn in sorted(files):
+			sha256.update("\0" + os.path.relpath(os.path.join(root, fn), EXAMPLES_DIR) + "\0")
+			with open(os.path.join(root, fn), "rb") as f:
+				sha256.update(f.read())
+	return sha256.hexdigest()
+
+def prepareSketch(sketch, tmp):
+	# the folder needs to keep the name of the sketch
+	copy = tmp + "/" + os.path.basename(sketch)
+	shutil.copytree(EXAMPLES_DIR + "/" + sketch, copy)
+	with open(copy + "/vc4benchmark.pde", "w") as f:
+		f.write(BENCHMARK_TAB)
+	return copy
+
+def getLauncher(sketch, key):
+	# the script Processing exports along with the sketch
+	for root, dirs, files in os.walk(CACHE_DIR + "/" + key):
+		if os.path.basename(sketch) in files and os.access(os.path.join(root, os.path.basename(sketch)), os.X_OK):
+			return os.path.join(root, os.path.basename(sketch))
+	return None
+
+def precompileSketch(args):
+	sketch, key = args
+	if getLauncher(sketch, key):
+		return sketch, True, ""
+	tmp = tempfile.mkdtemp(prefix="processing-test3d-")
+	try:
+		copy = prepareSketch(sketch, tmp)
+		p = subprocess.Popen([PROCESSING_CMD, "--sketch=" + copy, "--output=" + tmp + "/export", "--force", "--export", "--no-java"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		out = p.communicate()[0]
+		if p.returncode or not os.path.isdir(tmp + "/export"):
+			return sketch, False, out
+		if not os.path.isdir(CACHE_DIR):
+			try:
+				os.makedirs(CACHE_DIR)
+			except OSError:
+				pass
+		shutil.move(tmp + "/export", CACHE_DIR + "/" + key)
+		return sketch, getLauncher(sketch, key) is not None, out
+	finally:
+		shutil.rmtree(tmp)
+
+def precompileSketches(sketches):
+	# returns the launcher of each sketch that could be exported
+	version = getProcessingVersion()
+	keys = dict([(sketch, getSketchKey(sketch, version)) for sketch in sketches])
+	start = time.time()
+	pool = multiprocessing.Pool(PRECOMPILE_JOBS)
+	launchers = {}
+	with open("processing-test3d.out", "a") as out:
+		for sketch, ok, output in pool.imap_unordered(precompileSketch, keys.items()):
+			out.write("Precompiling " + sketch + "\n" + output)
+			if ok:
+				launchers[sketch] = getLauncher(sketch, keys[sketch])
+			else:
+				print "Precompiling " + sketch + " failed, running it from source"
+	pool.close()
+	pool.join()
+	print "Precompiled " + str(len(launchers)) + " of " + str(len(sketches)) + " sketches in " + str(int(time.time() - start)) + "s"
+	return launchers
+
+def readLines(f, lines):
+	for line in iter(f.readline, ""):
+		lines.put((time.time(), line))
+	lines.put((time.time(), None))
+
+def runSketch(sketch, seconds, launcher=None):
+	tmp = tempfile.mkdtemp(prefix="processing-test3d-")
+	try:
+		if launcher:
+			cmd = [launcher]
+			cwd = os.path.dirname(launcher)
+		else:
+			cmd = [PROCESSING_CMD, "--sketch=" + prepareSketch(sketch, tmp), "--run"]
+			cwd = None
+		start = time.time()
+		p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+		lines = Queue.Queue()
+		t = threading.Thread(target=readLines, args=(p.stdout, lines))
+		t.daemon = True
+		t.start()
+		samples = []
+		first = None
+		rss = 0
+		polled = 0
+		with open("processing-test3d.out", "a") as out:
+			out.write("Running " + sketch + "\n")
+			while True:
+				if 0.5 <= time.time() - polled:
+					rss = max(rss, getTreeRss(p.pid))
+					polled = time.time()
+				if first is None and BENCHMARK_STARTUP_SECONDS < time.time() - start:
+					break
+				if first is not None and seconds < time.time() - first:
+					break
+				try:
+					when, line = lines.get(timeout=0.5)
+				except Queue.Empty:
+					continue
+				if line is None:
+					break
+				out.write(line)
+				if line.startswith("VC4BENCH "):
+					frames, millis = [int(x) for x in line.split()[1:3]]
+					if first is None:
+						first = when
+					samples.append((frames, millis))
+		if p.poll() is None:
+			os.killpg(p.pid, signal.SIGTERM)
+			for i in range(10):
+				if p.poll() is not None:
+					break
+				time.sleep(0.5)
+			else:
+				os.killpg(p.pid, signal.SIGKILL)
+		p.wait()
+	finally:
+		shutil.rmtree(tmp)
+	result = { 'rssKb': rss, 'frames': 0 }
+	if first is None:
+		result['returncode'] = p.returncode
+		return result
+	result['startup'] = round(first - start, 2)
+	result['frames'] = samples[-1][0]
+	# frames per second over each interval, the first one is startup
+	fps = []
+	for i in range(1, len(samples)):
+		if samples[i][1] != samples[i-1][1]:
+			fps.append((samples[i][0] - samples[i-1][0]) * 1000.0 / (samples[i][1] - samples[i-1][1]))
+	if fps:
+		result['fps'] = { 'mean': round(sum(fps) / len(fps), 2), 'p5': round(getPercentile(fps, 5), 2), 'p95': round(getPercentile(fps, 95), 2) }
+		# for ResultsRaspbianVc4.py to tell noise from regressions
+		result['samples'] = [round(x, 2) for x in fps]
+	return result
+
 # XXX: --redo flag
 
 with open("processing-test3d.json") as f:
@@ -29,26 +246,56 @@ with open("processing-test3d.json") as f:
 
 try:
 	with open("/boot/issue-vc4.json") as f:
-		sys = json.load(f)
+		issue = json.load(f)
 	if data.get("system") is None:
-		data["system"] = sys
+		data["system"] = issue
 except IOError:
 	pass
 
-print "Press CTRL+C to terminate one of the tests and proceed to the next one..."
+if BATCH:
+	print "Running each test for " + str(BENCHMARK_SECONDS) + " seconds..."
+else:
+	print "Press CTRL+C to terminate one of the tests and proceed to the next one..."
+
+launchers = {}
+if PRECOMPILE:
+	if BATCH:
+		todo = [row.get("sketch") for row in data.get("tests", []) if row.get("ignore", 0) is not 1 and row.get("benchmark") is None]
+	else:
+		todo = [row.get("sketch") for row in data.get("tests", []) if row.get("ignore", 0) is not 1 and row.get("result") is None]
+	launchers = precompileSketches(todo)
 
 for row in data.get("tests", []):
 	sketch = row.get("sketch")
 	ignore = row.get("ignore", 0)
 	result = row.get("result")
+	if BATCH:
+		if ignore is 1:
+			print "Skipping " + sketch + " (ignored)"
+		elif row.get("benchmark") is not None:
+			print "Skipping " + sketch + " (already done)"
+		else:
+			print "Running " + sketch
+			row["benchmark"] = runSketch(sketch, BENCHMARK_SECONDS, launchers.get(sketch))
+			if row["benchmark"]["frames"] == 0 and result is None:
+				row["result"] = 0
+				row["comment"] = "no frame drawn"
+			print json.dumps(row["benchmark"], sort_keys=True)
+			with open("processing-test3d.json", "w") as f:
+				json.dump(data, f, indent=4, separators=(',', ': '))
+		continue
 	if result is not None:
 		print "Skipping " + sketch + " (already done)"
 	if ignore is 1:
 		print "Skipping " + sketch + " (ignored)"
 		row["result"] = -1
 	if ignore is not 1 and result is None:
+		if sketch in launchers:
+			cmd = "cd " + pipes.quote(os.path.dirname(launchers[sketch])) + " && " + pipes.quote(launchers[sketch])
+		else:
+			cmd = PROCESSING_CMD + " --sketch=\"" + EXAMPLES_DIR + "/" + sketch + "\" --run"
 		try:
-			retval = subprocess.call("echo Running " + sketch + " | tee -a processing-test3d.out && " + PROCESSING_CMD + " --sketch=\"" + EXAMPLES_DIR + "/" + sketch + "\" --run 2>&1 | tee -a processing-test3d.out", shell=True)
+			retval = subprocess.call("echo Running " + sketch + " | tee -a processing-test3d.out && (" + cmd + ") 2>&1 | tee -a processing-test3d.out", shell=True)
 		except KeyboardInterrupt:
 			retval = 0
 		if retval is not 0:
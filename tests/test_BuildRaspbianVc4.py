@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+# Tests of the build script's helpers, offline against local repositories
+# Copyright (C) 2015 Gottfried Haider
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/..")
+import BuildRaspbianVc4
+
+def git(args, cwd=None):
+	env = dict(os.environ)
+	env.update({ 'GIT_AUTHOR_NAME': "test", 'GIT_AUTHOR_EMAIL': "test@localhost", 'GIT_COMMITTER_NAME': "test", 'GIT_COMMITTER_EMAIL': "test@localhost" })
+	return subprocess.check_output(["git"] + args, cwd=cwd, env=env).decode().strip()
+
+class MirrorTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix="test-build-")
+		self.mirrorDir = BuildRaspbianVc4.MIRROR_DIR
+		BuildRaspbianVc4.MIRROR_DIR = self.tmp + "/mirror"
+		# stands in for e.g. anongit.freedesktop.org
+		self.repo = self.tmp + "/upstream.git"
+		git(["init", "-q", "--bare", self.repo])
+		git(["symbolic-ref", "HEAD", "refs/heads/master"], self.repo)
+		self.work = self.tmp + "/work"
+		git(["init", "-q", self.work])
+		git(["checkout", "-q", "-b", "master"], self.work)
+
+	def tearDown(self):
+		BuildRaspbianVc4.MIRROR_DIR = self.mirrorDir
+		shutil.rmtree(self.tmp)
+
+	def commit(self, content, branch="master"):
+		with open(self.work + "/file", "w") as f:
+			f.write(content)
+		git(["add", "file"], self.work)
+		git(["commit", "-q", "-m", content], self.work)
+		git(["push", "-q", self.repo, "HEAD:refs/heads/" + branch], self.work)
+		return git(["rev-parse", "HEAD"], self.work)
+
+	def getFile(self, src):
+		with open(src + "/file") as f:
+			return f.read()
+
+	def testClonesFromMirror(self):
+		first = self.commit("first")
+		BuildRaspbianVc4.updateMirror(self.repo)
+		mirror = BuildRaspbianVc4.getMirrorDir(self.repo)
+		self.assertEqual(git(["rev-parse", "--is-bare-repository"], mirror), "true")
+		src = self.tmp + "/src"
+		self.assertEqual(BuildRaspbianVc4.updateSource(src, self.repo, None), first)
+		self.assertEqual(self.getFile(src), "first")
+		# --shared: the objects stay in the mirror
+		with open(src + "/.git/objects/info/alternates") as f:
+			self.assertEqual(os.path.realpath(f.read().strip()), os.path.realpath(mirror + "/objects"))
+		self.assertEqual(git(["config", "remote.origin.url"], src), self.repo)
+
+	def testFollowsMirrorUpdates(self):
+		first = self.commit("first")
+		BuildRaspbianVc4.updateMirror(self.repo)
+		src = self.tmp + "/src"
+		BuildRaspbianVc4.updateSource(src, self.repo, None)
+		second = self.commit("second")
+		# the working tree only sees what the mirror fetched
+		self.assertEqual(BuildRaspbianVc4.updateSource(src, self.repo, None), first)
+		BuildRaspbianVc4.updateMirror(self.repo)
+		self.assertEqual(BuildRaspbianVc4.updateSource(src, self.repo, None), second)
+		self.assertEqual(self.getFile(src), "second")
+		# pinned to a commit, e.g. while bisecting
+		self.assertEqual(BuildRaspbianVc4.updateSource(src, self.repo, None, first), first)
+		self.assertEqual(self.getFile(src), "first")
+		self.assertEqual(git(["rev-parse", "--abbrev-ref", "HEAD"], src), "master")
+
+	def testChecksOutBranch(self):
+		self.commit("first")
+		other = self.commit("other", "next")
+		BuildRaspbianVc4.updateMirror(self.repo)
+		src = self.tmp + "/src"
+		self.assertEqual(BuildRaspbianVc4.updateSource(src, self.repo, "next"), other)
+		self.assertEqual(git(["rev-parse", "--abbrev-ref", "HEAD"], src), "next")
+
+# stand-ins for dpkg-query and apt-get, with the list of installed
+# packages in $DPKG_DIR/installed, and every call logged
+DPKG_QUERY = """#!/bin/sh
+printf "%s\\n" "$*" >> "$DPKG_DIR/dpkg-query.log"
+ret=0
+for arg in "$@"; do
+	case "$arg" in
+		--admindir=*) test "${arg#--admindir=}" = "$DPKG_DIR" || exit 2 ;;
+		-*) ;;
+		*) if grep -qx "$arg" "$DPKG_DIR/installed"; then echo "$arg install ok installed"; else echo "dpkg-query: no packages found matching $arg" >&2; ret=1; fi ;;
+	esac
+done
+exit $ret
+"""
+APT_GET = """#!/bin/sh
+printf "%s\\n" "$*" >> "$DPKG_DIR/apt-get.log"
+if [ "$2" = install ]; then
+	shift 2
+	for p in "$@"; do echo "$p" >> "$DPKG_DIR/installed"; done
+	touch "$DPKG_DIR/status"
+fi
+"""
+
+class InstallPackagesTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix="test-build-")
+		self.dpkg = self.tmp + "/dpkg"
+		os.mkdir(self.dpkg)
+		os.mkdir(self.tmp + "/bin")
+		for name, script in [("dpkg-query", DPKG_QUERY), ("apt-get", APT_GET)]:
+			with open(self.tmp + "/bin/" + name, "w") as f:
+				f.write(script)
+			os.chmod(self.tmp + "/bin/" + name, 0o755)
+		with open(self.dpkg + "/installed", "w") as f:
+			f.write("bc\n")
+		with open(self.dpkg + "/status", "w") as f:
+			f.write("")
+		self.environ = dict(os.environ)
+		os.environ['PATH'] = self.tmp + "/bin" + os.pathsep + os.environ['PATH']
+		os.environ['DPKG_DIR'] = self.dpkg
+		self.paths = (BuildRaspbianVc4.APT_FILE, BuildRaspbianVc4.DPKG_STATUS)
+		BuildRaspbianVc4.APT_FILE = self.tmp + "/apt-vc4.json"
+		BuildRaspbianVc4.DPKG_STATUS = self.dpkg + "/status"
+
+	def tearDown(self):
+		os.environ.clear()
+		os.environ.update(self.environ)
+		BuildRaspbianVc4.APT_FILE, BuildRaspbianVc4.DPKG_STATUS = self.paths
+		shutil.rmtree(self.tmp)
+
+	def getCalls(self, name):
+		if not os.path.exists(self.dpkg + "/" + name + ".log"):
+			return []
+		with open(self.dpkg + "/" + name + ".log") as f:
+			return f.read().splitlines()
+
+	def testInstallsMissingInOneGo(self):
+		BuildRaspbianVc4.installPackages(["flex", "bc", "bison", "flex"])
+		self.assertEqual(len(self.getCalls("dpkg-query")), 1)
+		self.assertEqual(self.getCalls("apt-get"), ["-y update", "-y install bison flex"])
+
+	def testSkipsDpkgWhileStatusUnchanged(self):
+		BuildRaspbianVc4.installPackages(["bc", "flex"])
+		BuildRaspbianVc4.installPackages(["flex", "bc"])
+		self.assertEqual(len(self.getCalls("dpkg-query")), 1)
+		self.assertEqual(len(self.getCalls("apt-get")), 2)
+		# e.g. something got removed in the meantime
+		st = os.stat(self.dpkg + "/status")
+		os.utime(self.dpkg + "/status", (st.st_atime, st.st_mtime + 10))
+		BuildRaspbianVc4.installPackages(["bc", "flex"])
+		self.assertEqual(len(self.getCalls("dpkg-query")), 2)
+		self.assertEqual(len(self.getCalls("apt-get")), 2)
+
+	def testSkipsAptWhenAllInstalled(self):
+		BuildRaspbianVc4.installPackages(["bc"])
+		self.assertEqual(len(self.getCalls("dpkg-query")), 1)
+		self.assertEqual(self.getCalls("apt-get"), [])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Tests of applying deltas between two overlays
+# Copyright (C) 2015 Gottfried Haider
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+
+import os
+import sys
+import io
+import json
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/..")
+import DeltaRaspbianVc4
+
+class ApplyDeltaTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix="test-delta-")
+		# the installation, as the earlier overlay left it
+		self.root = self.tmp + "/root"
+		self.put("boot/config.txt", "dtoverlay=vc4-kms-v3d\n")
+		self.put("usr/local/lib/libfoo.so.1", "old")
+		self.put("usr/local/lib/libbar.so.1", "bar")
+		os.symlink("libfoo.so.1", self.root + "/usr/local/lib/libfoo.so")
+		self.files = {}
+		for name in ["boot", "boot/config.txt", "usr", "usr/local", "usr/local/lib", "usr/local/lib/libfoo.so.1", "usr/local/lib/libbar.so.1", "usr/local/lib/libfoo.so"]:
+			self.files[name] = DeltaRaspbianVc4.getEntry(self.root + "/" + name)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def put(self, name, content):
+		if not os.path.isdir(os.path.dirname(self.root + "/" + name)):
+			os.makedirs(os.path.dirname(self.root + "/" + name))
+		with open(self.root + "/" + name, "w") as f:
+			f.write(content)
+
+	def get(self, name):
+		with open(self.root + "/" + name) as f:
+			return f.read()
+
+	def makeDelta(self, changed, deleted=[]):
+		# like PackageRaspbianVc4.TarDelta()
+		fn = self.tmp + "/delta.tar"
+		tar = tarfile.open(fn, "w")
+		for name, content in [(DeltaRaspbianVc4.DELTA_META, json.dumps({ 'base': "earlier", 'prefix': "later", 'files': self.files, 'delete': deleted }))] + sorted(changed.items()):
+			info = tarfile.TarInfo(name)
+			info.size = len(content.encode())
+			info.mode = 0o644
+			tar.addfile(info, io.BytesIO(content.encode()))
+		tar.close()
+		return fn
+
+	def testUpdatesMatchingRoot(self):
+		delta = self.makeDelta({ "usr/local/lib/libfoo.so.1": "new" }, ["usr/local/lib/libbar.so.1"])
+		DeltaRaspbianVc4.applyDelta(delta, self.root)
+		self.assertEqual(self.get("usr/local/lib/libfoo.so.1"), "new")
+		self.assertFalse(os.path.exists(self.root + "/usr/local/lib/libbar.so.1"))
+		self.assertFalse(os.path.exists(self.root + "/" + DeltaRaspbianVc4.DELTA_META))
+
+	def testRefusesChangedFiles(self):
+		self.put("usr/local/lib/libfoo.so.1", "modified")
+		delta = self.makeDelta({ "usr/local/lib/libfoo.so.1": "new" })
+		with self.assertRaises(SystemExit):
+			DeltaRaspbianVc4.applyDelta(delta, self.root)
+		self.assertEqual(self.get("usr/local/lib/libfoo.so.1"), "modified")
+
+	def testKeepsEditedConfigFiles(self):
+		self.put("boot/config.txt", "dtoverlay=vc4-kms-v3d\ngpu_mem=256\n")
+		delta = self.makeDelta({ "boot/config.txt": "dtoverlay=vc4-kms-v3d\navoid_warnings=2\n", "usr/local/lib/libfoo.so.1": "new" })
+		DeltaRaspbianVc4.applyDelta(delta, self.root)
+		self.assertEqual(self.get("boot/config.txt"), "dtoverlay=vc4-kms-v3d\ngpu_mem=256\n")
+		self.assertEqual(self.get("usr/local/lib/libfoo.so.1"), "new")
+
+	def testUpdatesUneditedConfigFiles(self):
+		delta = self.makeDelta({ "boot/config.txt": "dtoverlay=vc4-kms-v3d\navoid_warnings=2\n" })
+		DeltaRaspbianVc4.applyDelta(delta, self.root)
+		self.assertEqual(self.get("boot/config.txt"), "dtoverlay=vc4-kms-v3d\navoid_warnings=2\n")
+
+	def testIgnoresDirectories(self):
+		# e.g. an empty one that got removed by hand
+		self.files["usr/local/share"] = "/"
+		delta = self.makeDelta({ "usr/local/lib/libfoo.so.1": "new" })
+		DeltaRaspbianVc4.applyDelta(delta, self.root)
+		self.assertEqual(self.get("usr/local/lib/libfoo.so.1"), "new")
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+# Tests of the base image download and cache, against a local HTTP server
+# Copyright (C) 2015 Gottfried Haider
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+
+import os
+import sys
+import io
+import re
+import shutil
+import struct
+import subprocess
+import hashlib
+import tempfile
+import threading
+import unittest
+import zipfile
+try:
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+	from http.server import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import ImageRaspbianVc4
+
+class StandInHandler(BaseHTTPRequestHandler):
+	# serves server.files ({ path: data }) with an ETag, and byte ranges
+	# like downloads.raspberrypi.org, remembering every request
+	def do_HEAD(self):
+		self.respond(False)
+
+	def do_GET(self):
+		self.respond(True)
+
+	def respond(self, body):
+		self.server.requests.append((self.command, self.path, self.headers.get("Range")))
+		data = self.server.files.get(self.path)
+		if data is None:
+			self.send_error(404)
+			return
+		etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+		start = 0
+		rng = self.headers.get("Range")
+		if rng and self.headers.get("If-Range") in (None, etag):
+			start = int(rng.split("=")[1].split("-")[0])
+			if len(data) <= start:
+				self.send_error(416)
+				return
+			self.send_response(206)
+			self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(data) - 1, len(data)))
+		else:
+			self.send_response(200)
+		self.send_header("ETag", etag)
+		self.send_header("Content-Length", str(len(data) - start))
+		self.end_headers()
+		if body:
+			self.wfile.write(data[start:])
+
+	def log_message(self, format, *args):
+		pass
+
+def makeZip(img):
+	buf = io.BytesIO()
+	with zipfile.ZipFile(buf, "w") as z:
+		z.writestr("raspbian.img", img)
+	return buf.getvalue()
+
+class BaseImageTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix="test-image-")
+		self.server = HTTPServer(("127.0.0.1", 0), StandInHandler)
+		self.server.files = {}
+		self.server.requests = []
+		t = threading.Thread(target=self.server.serve_forever)
+		t.daemon = True
+		t.start()
+		self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+		self.baseImageDir = ImageRaspbianVc4.BASE_IMAGE_DIR
+		self.growImage = ImageRaspbianVc4.growImage
+		ImageRaspbianVc4.BASE_IMAGE_DIR = self.tmp + "/raspbian"
+		# needs a real partition table and e2fsprogs
+		ImageRaspbianVc4.growImage = lambda fn, bytesToAdd: None
+
+	def tearDown(self):
+		ImageRaspbianVc4.BASE_IMAGE_DIR = self.baseImageDir
+		ImageRaspbianVc4.growImage = self.growImage
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.tmp)
+
+	def getRequests(self, method, path):
+		return [r for r in self.server.requests if r[0] == method and r[1] == path]
+
+	def testResumesTruncatedDownload(self):
+		data = os.urandom(300 * 1024)
+		self.server.files["/image.zip"] = data
+		fn = self.tmp + "/image.zip.part"
+		with open(fn, "wb") as f:
+			f.write(data[:100 * 1024])
+		info = ImageRaspbianVc4.getUrlInfo(self.url + "/image.zip")
+		ImageRaspbianVc4.download(info['url'], fn, info['etag'])
+		with open(fn, "rb") as f:
+			self.assertEqual(f.read(), data)
+		self.assertEqual(self.getRequests("GET", "/image.zip")[-1][2], "bytes=102400-")
+
+	def testRejectsWrongChecksum(self):
+		self.server.files["/image.zip"] = makeZip(b"image")
+		self.server.files["/image.zip.sha256"] = ("0" * 64 + "  image.zip\n").encode()
+		prepared = []
+		with self.assertRaises(Exception) as cm:
+			ImageRaspbianVc4.getBaseImage(prepared.append, 0, None, self.url + "/image.zip")
+		self.assertIn("wrong checksum", str(cm.exception))
+		self.assertEqual(prepared, [])
+		self.assertFalse(os.path.exists(ImageRaspbianVc4.BASE_IMAGE_DIR + "/image.zip.part"))
+		self.assertFalse(os.path.exists(ImageRaspbianVc4.BASE_IMAGE_DIR + "/base.json"))
+
+	def testReusesCachedImage(self):
+		data = makeZip(b"image")
+		self.server.files["/image.zip"] = data
+		self.server.files["/image.zip.sha256"] = (hashlib.sha256(data).hexdigest() + "  image.zip\n").encode()
+		prepared = []
+		img = ImageRaspbianVc4.getBaseImage(prepared.append, 0, None, self.url + "/image.zip")
+		self.assertEqual(len(prepared), 1)
+		with open(img, "rb") as f:
+			self.assertEqual(f.read(), b"image")
+		again = ImageRaspbianVc4.getBaseImage(prepared.append, 0, None, self.url + "/image.zip")
+		self.assertEqual(again, img)
+		self.assertEqual(len(prepared), 1)
+		# only the HEAD request the second time
+		self.assertEqual(len(self.getRequests("GET", "/image.zip")), 1)
+		# different options need a different preparation
+		ImageRaspbianVc4.getBaseImage(prepared.append, 0, 1, self.url + "/image.zip")
+		self.assertEqual(len(prepared), 2)
+	def testFallsBackToCachedImageOffline(self):
+		data = makeZip(b"image")
+		self.server.files["/image.zip"] = data
+		img = ImageRaspbianVc4.getBaseImage(lambda fn: None, 0, None, self.url + "/image.zip")
+		# nothing listens there anymore
+		self.server.shutdown()
+		self.server.server_close()
+		self.assertEqual(ImageRaspbianVc4.getBaseImage(lambda fn: None, 0, None, self.url + "/image.zip"), img)
+		# but a cached image for other options doesn't do
+		with self.assertRaises(IOError):
+			ImageRaspbianVc4.getBaseImage(lambda fn: None, 0, 1, self.url + "/image.zip")
+
+
+def canGrowImages():
+	# growImage() needs e2fsprogs, and root for a loop device
+	path = os.environ.get("PATH", "").split(os.pathsep)
+	tools = ["mkfs.ext4", "dumpe2fs", "e2fsck", "resize2fs", "losetup"]
+	return os.geteuid() == 0 and all([any([os.path.exists(os.path.join(d, tool)) for d in path]) for tool in tools])
+
+def makeImage(fn, bootSectors, rootSectors):
+	# a FAT partition (only in the table) followed by an ext4 one, like
+	# Raspbian's
+	bootStart = 8192
+	rootStart = bootStart + bootSectors
+	mbr = bytearray(512)
+	for i, (ptype, start, sectors) in enumerate([(0x0c, bootStart, bootSectors), (0x83, rootStart, rootSectors)]):
+		mbr[0x1be + i * 16:0x1be + (i + 1) * 16] = struct.pack("<B3sB3sII", 0, b"\0" * 3, ptype, b"\0" * 3, start, sectors)
+	mbr[0x1fe:0x200] = b"\x55\xaa"
+	with open(fn, "wb") as f:
+		f.write(mbr)
+		f.truncate((rootStart + rootSectors) * 512)
+	subprocess.check_call(["mkfs.ext4", "-q", "-F", "-b", "4096", "-E", "offset=" + str(rootStart * 512), fn, str(rootSectors * 512 // 4096)])
+	return rootStart
+
+def getBlockCount(fs):
+	out = subprocess.check_output(["dumpe2fs", "-h", fs], stderr=subprocess.STDOUT).decode()
+	return int(re.search(r'^Block count:\s+(\d+)', out, re.MULTILINE).group(1))
+
+class GrowImageTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix="test-image-")
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	@unittest.skipUnless(canGrowImages(), "needs e2fsprogs and root")
+	def testGrowsLastPartition(self):
+		fn = self.tmp + "/raspbian.img"
+		rootStart = makeImage(fn, 2048, 16384)
+		ImageRaspbianVc4.growImage(fn, 4 * 1048576)
+		# resize2fs on file?offset= cut the image down to the size of
+		# the filesystem
+		self.assertEqual(os.path.getsize(fn), (rootStart + 16384) * 512 + 4 * 1048576)
+		parts = ImageRaspbianVc4.readPartitions(fn)
+		self.assertEqual([(p['type'], p['start'], p['sectors']) for p in parts], [(0x0c, 8192, 2048), (0x83, rootStart, 16384 + 8192)])
+		self.assertEqual(getBlockCount(fn + "?offset=" + str(rootStart * 512)), (16384 + 8192) * 512 // 4096)
+		# still consistent
+		with open(os.devnull, "w") as null:
+			self.assertEqual(subprocess.call(["e2fsck", "-f", "-n", fn + "?offset=" + str(rootStart * 512)], stdout=null, stderr=null), 0)
+
+	def testRejectsImageWithoutLinuxPartition(self):
+		fn = self.tmp + "/raspbian.img"
+		mbr = bytearray(512)
+		mbr[0x1be:0x1ce] = struct.pack("<B3sB3sII", 0, b"\0" * 3, 0x0c, b"\0" * 3, 8192, 2048)
+		mbr[0x1fe:0x200] = b"\x55\xaa"
+		with open(fn, "wb") as f:
+			f.write(mbr)
+			f.truncate(10240 * 512)
+		with self.assertRaises(Exception) as cm:
+			ImageRaspbianVc4.growImage(fn, 1048576)
+		self.assertIn("not a Linux one", str(cm.exception))
+
+
+class WriteImageTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix="test-image-")
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def testRejectsShortZip(self):
+		# the mapped blocks start past the end of the image, which needs
+		# to fail rather than skip ahead forever
+		with open(self.tmp + "/image.zip", "wb") as f:
+			f.write(makeZip(b"\0" * 4096))
+		with open(self.tmp + "/image.bmap", "w") as f:
+			f.write('<?xml version="1.0" ?>\n<bmap version="2.0">\n'
+				'<ImageSize> 16384 </ImageSize>\n<BlockSize> 4096 </BlockSize>\n'
+				'<BlockMap>\n<Range chksum="%s"> 2-3 </Range>\n</BlockMap>\n</bmap>\n' % ("0" * 64))
+		with self.assertRaises(Exception) as cm:
+			ImageRaspbianVc4.writeImage(self.tmp + "/image.zip", self.tmp + "/image.bmap", self.tmp + "/out.img")
+		self.assertIn("shorter than its block map", str(cm.exception))
+
+	def makeSparseImage(self, fn):
+		# data in the first block, straddling a megabyte boundary, and at
+		# the very end, with holes of several megabytes in between
+		size = 9 * 1024 * 1024 + 512
+		with open(fn, "wb") as f:
+			f.truncate(size)
+			for offset in [0, 3 * 1024 * 1024 - 5000, size - 700]:
+				f.seek(offset)
+				f.write(os.urandom(10000)[:min(10000, size - offset)])
+		with open(fn, "rb") as f:
+			return f.read()
+
+	def testZipsSparseImage(self):
+		content = self.makeSparseImage(self.tmp + "/raspbian.img")
+		ImageRaspbianVc4.writeZip([self.tmp + "/raspbian.img"], self.tmp + "/image.zip")
+		zip = zipfile.ZipFile(self.tmp + "/image.zip")
+		self.assertEqual(zip.namelist(), ["raspbian.img"])
+		self.assertIsNone(zip.testzip())
+		self.assertEqual(zip.getinfo("raspbian.img").file_size, len(content))
+		self.assertEqual(zip.read("raspbian.img"), content)
+		zip.close()
+		# the holes barely take up space
+		self.assertTrue(os.path.getsize(self.tmp + "/image.zip") < 100000)
+		try:
+			# Info-ZIP's reading of the ZIP64 fields
+			subprocess.check_output(["unzip", "-t", self.tmp + "/image.zip"])
+		except OSError:
+			pass
+
+	def testWritesZippedImage(self):
+		content = self.makeSparseImage(self.tmp + "/raspbian.img")
+		ImageRaspbianVc4.writeBmap(self.tmp + "/raspbian.img", self.tmp + "/image.bmap")
+		ImageRaspbianVc4.writeZip([self.tmp + "/raspbian.img"], self.tmp + "/image.zip")
+		ImageRaspbianVc4.writeImage(self.tmp + "/image.zip", self.tmp + "/image.bmap", self.tmp + "/out.img")
+		with open(self.tmp + "/out.img", "rb") as f:
+			self.assertEqual(f.read(), content)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+# Tests of the benchmark runner, with a stand-in for processing-java
+# Copyright (C) 2015 Gottfried Haider
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+SCRIPT = os.path.dirname(os.path.realpath(__file__)) + "/../processing-test3d.py"
+
+# frames drawn and millis() as printed by the benchmark tab, one line a
+# second, fps over the intervals is 30, 30, 20, 30, 30
+SAMPLES = [(10, 1000), (40, 2000), (70, 3000), (90, 4000), (120, 5000), (150, 6000)]
+BENCH = "sleep 0.3\n" + "".join(["echo VC4BENCH %d %d\nsleep 0.1\n" % sample for sample in SAMPLES])
+
+# stand-in for processing-java, sketches named NoExport fail to export,
+# and ones named Broken don't draw anything
+PROCESSING_JAVA = """#!/bin/sh
+printf "%s\\n" "$*" >> "$HOME/processing-java.log"
+for arg in "$@"; do
+	case "$arg" in
+		--sketch=*) sketch="${arg#--sketch=}" ;;
+		--output=*) output="${arg#--output=}" ;;
+	esac
+done
+name=$(basename "$sketch")
+test -f "$sketch/vc4benchmark.pde" || exit 3
+case "$name" in
+	Broken) echo "error: broken"; exit 1 ;;
+esac
+case "$*" in
+	*--export*)
+		test "$name" = NoExport && exit 1
+		mkdir -p "$output/lib"
+		printf "#!/bin/sh\\n%s" "$BENCH" > "$output/$name"
+		chmod +x "$output/$name"
+		;;
+	*--run*)
+		eval "$BENCH"
+		;;
+esac
+"""
+
+# well below the script's BENCHMARK_STARTUP_SECONDS
+STARTUP_LIMIT = 30
+
+def getPython2():
+	# the script is Python 2 only
+	if sys.version_info[0] == 2:
+		return sys.executable
+	for cmd in ["python2", "python2.7"]:
+		try:
+			if subprocess.check_output([cmd, "-c", "import sys; print(sys.version_info[0])"], stderr=subprocess.STDOUT).decode().strip() == "2":
+				return cmd
+		except (OSError, subprocess.CalledProcessError):
+			pass
+	return None
+
+PYTHON2 = getPython2()
+
+@unittest.skipUnless(PYTHON2, "needs a Python 2 interpreter")
+class BatchTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix="test-processing-")
+		os.mkdir(self.tmp + "/bin")
+		with open(self.tmp + "/bin/processing-java", "w") as f:
+			f.write(PROCESSING_JAVA)
+		os.chmod(self.tmp + "/bin/processing-java", 0o755)
+		for sketch in ["Basics/Export", "Basics/NoExport", "Basics/Broken"]:
+			os.makedirs(self.tmp + "/examples/" + sketch)
+			with open(self.tmp + "/examples/" + sketch + "/" + os.path.basename(sketch) + ".pde", "w") as f:
+				f.write("void draw() {\n}\n")
+		self.env = dict(os.environ)
+		self.env.update({ 'PATH': self.tmp + "/bin" + os.pathsep + os.environ['PATH'], 'EXAMPLES_DIR': self.tmp + "/examples", 'HOME': self.tmp, 'BENCH': BENCH })
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def runBatch(self, tests):
+		with open(self.tmp + "/processing-test3d.json", "w") as f:
+			json.dump({ 'tests': tests }, f)
+		subprocess.check_output([PYTHON2, SCRIPT, "--batch"], cwd=self.tmp, env=self.env)
+		with open(self.tmp + "/processing-test3d.json") as f:
+			return dict([(row['sketch'], row) for row in json.load(f)['tests']])
+
+	def getCalls(self):
+		with open(self.tmp + "/processing-java.log") as f:
+			return f.read().splitlines()
+
+	def checkBenchmark(self, bench):
+		self.assertEqual(bench['frames'], 150)
+		self.assertEqual(bench['samples'], [30.0, 30.0, 20.0, 30.0, 30.0])
+		self.assertEqual(bench['fps'], { 'mean': 28.0, 'p5': 20.0, 'p95': 30.0 })
+		self.assertTrue(0.3 <= bench['startup'] < STARTUP_LIMIT)
+		self.assertTrue(0 < bench['rssKb'])
+
+	def testMeasuresExportedSketch(self):
+		rows = self.runBatch([{ 'sketch': "Basics/Export", 'ignore': 0 }])
+		self.checkBenchmark(rows["Basics/Export"]['benchmark'])
+		self.assertNotIn('result', rows["Basics/Export"])
+		calls = self.getCalls()
+		self.assertEqual(len(calls), 1)
+		self.assertIn("--export", calls[0])
+		# exported once, and reused while the sketch is unchanged
+		del rows["Basics/Export"]['benchmark']
+		rows = self.runBatch(list(rows.values()))
+		self.checkBenchmark(rows["Basics/Export"]['benchmark'])
+		self.assertEqual(len(self.getCalls()), 1)
+
+	def testFallsBackToRunningFromSource(self):
+		rows = self.runBatch([{ 'sketch': "Basics/NoExport", 'ignore': 0 }])
+		self.checkBenchmark(rows["Basics/NoExport"]['benchmark'])
+		calls = self.getCalls()
+		self.assertEqual(len(calls), 2)
+		self.assertIn("--run", calls[1])
+
+	def testRecordsSketchesThatDrawNothing(self):
+		rows = self.runBatch([{ 'sketch': "Basics/Broken", 'ignore': 0 }, { 'sketch': "Basics/Export", 'ignore': 1 }])
+		self.assertEqual(rows["Basics/Broken"]['benchmark']['frames'], 0)
+		self.assertEqual(rows["Basics/Broken"]['benchmark']['returncode'], 1)
+		self.assertEqual(rows["Basics/Broken"]['result'], 0)
+		self.assertEqual(rows["Basics/Broken"]['comment'], "no frame drawn")
+		self.assertNotIn('benchmark', rows["Basics/Export"])
+
+
+if __name__ == "__main__":
+	unittest.main()